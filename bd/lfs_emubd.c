@@ -113,6 +113,7 @@ int lfs_emubd_create(const struct lfs_config *cfg,
             bdcfg->badblock_behavior, bdcfg->power_cycles,
             bdcfg->powerloss_behavior, (void*)(uintptr_t)bdcfg->powerloss_cb,
             bdcfg->powerloss_data, bdcfg->track_branches);
+    LFS_EMUBD_TRACEOP('c', bdcfg->erase_count, 0, bdcfg->erase_size);
     lfs_emubd_t *bd = cfg->context;
     bd->cfg = bdcfg;
 
@@ -289,6 +290,7 @@ int lfs_emubd_read(const struct lfs_config *cfg, lfs_block_t block,
     LFS_EMUBD_TRACE("lfs_emubd_read(%p, "
                 "0x%"PRIx32", %"PRIu32", %p, %"PRIu32")",
             (void*)cfg, block, off, buffer, size);
+    LFS_EMUBD_TRACEOP('r', block, off, size);
     lfs_emubd_t *bd = cfg->context;
 
     // check if read is valid
@@ -339,6 +341,7 @@ int lfs_emubd_prog(const struct lfs_config *cfg, lfs_block_t block,
     LFS_EMUBD_TRACE("lfs_emubd_prog(%p, "
                 "0x%"PRIx32", %"PRIu32", %p, %"PRIu32")",
             (void*)cfg, block, off, buffer, size);
+    LFS_EMUBD_TRACEOP('p', block, off, size);
     lfs_emubd_t *bd = cfg->context;
 
     // check if write is valid
@@ -431,6 +434,8 @@ int lfs_emubd_prog(const struct lfs_config *cfg, lfs_block_t block,
 int lfs_emubd_erase(const struct lfs_config *cfg, lfs_block_t block) {
     LFS_EMUBD_TRACE("lfs_emubd_erase(%p, 0x%"PRIx32" (%"PRIu32"))",
             (void*)cfg, block, ((lfs_emubd_t*)cfg->context)->cfg->erase_size);
+    LFS_EMUBD_TRACEOP('e', block, 0,
+            ((lfs_emubd_t*)cfg->context)->cfg->erase_size);
     lfs_emubd_t *bd = cfg->context;
 
     // check if erase is valid
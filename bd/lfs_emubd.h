@@ -29,6 +29,15 @@ extern "C"
 #endif
 #endif
 
+// Compact block device tracing, this is called with the op ('c', 'r', 'p',
+// or 'e'), block, off, and size of every create/read/prog/erase, and lets
+// runners write traces without formatting text
+//
+// note create passes the erase_count and erase_size as block and size
+#ifndef LFS_EMUBD_TRACEOP
+#define LFS_EMUBD_TRACEOP(op, block, off, size)
+#endif
+
 // Mode determining how "bad-blocks" behave during testing. This simulates
 // some real-world circumstances such as progs not sticking (prog-noop),
 // a readonly disk (erase-noop), and ECC failures (read-error).
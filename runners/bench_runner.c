@@ -13,6 +13,7 @@
 
 #include <getopt.h>
 #include <sys/types.h>
+#include <sys/wait.h>
 #include <errno.h>
 #include <setjmp.h>
 #include <fcntl.h>
@@ -51,16 +52,16 @@ void *mappend(void **p,
 }
 
 // a quick self-terminating text-safe varint scheme
-static void leb16_print(uintmax_t x) {
+static void leb16_print(FILE *f, uintmax_t x) {
     // allow 'w' to indicate negative numbers
     if ((intmax_t)x < 0) {
-        printf("w");
+        fprintf(f, "w");
         x = -x;
     }
 
     while (true) {
         char nibble = (x & 0xf) | (x > 0xf ? 0x10 : 0);
-        printf("%c", (nibble < 10) ? '0'+nibble : 'a'+nibble-10);
+        fprintf(f, "%c", (nibble < 10) ? '0'+nibble : 'a'+nibble-10);
         if (x <= 0xf) {
             break;
         }
@@ -427,6 +428,7 @@ size_t bench_step_step = 1;
 const char *bench_disk_path = NULL;
 const char *bench_trace_path = NULL;
 bool bench_trace_backtrace = false;
+bool bench_trace_binary = false;
 uint32_t bench_trace_period = 0;
 uint32_t bench_trace_freq = 0;
 FILE *bench_trace_file = NULL;
@@ -437,6 +439,16 @@ lfs_emubd_sleep_t bench_read_sleep = 0.0;
 lfs_emubd_sleep_t bench_prog_sleep = 0.0;
 lfs_emubd_sleep_t bench_erase_sleep = 0.0;
 
+// status line formats, kv appends the permutation's defines to status
+// lines so they don't need to be queried separately
+enum bench_status_format {
+    BENCH_STATUS_TEXT = 0,
+    BENCH_STATUS_KV   = 1,
+};
+uint8_t bench_status_format = BENCH_STATUS_TEXT;
+int bench_status_fd = -1;
+FILE *bench_status = NULL;
+
 // this determines both the backtrace buffer and the trace printf buffer, if
 // trace ends up interleaved or truncated this may need to be increased
 #ifndef BENCH_TRACE_BACKTRACE_BUFFER_SIZE
@@ -445,68 +457,90 @@ lfs_emubd_sleep_t bench_erase_sleep = 0.0;
 void *bench_trace_backtrace_buffer[
     BENCH_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*)];
 
-// trace printing
-void bench_trace(const char *fmt, ...) {
-    if (bench_trace_path) {
-        // sample at a specific period?
-        if (bench_trace_period) {
-            if (bench_trace_cycles % bench_trace_period != 0) {
-                bench_trace_cycles += 1;
-                return;
-            }
+// binary trace records are built here so each record is written with a
+// single write, a record is a 28-byte header followed by up to one 64-bit
+// address per backtrace frame
+#define BENCH_TRACE_RECORD_SIZE (28 \
+    + 8*(BENCH_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*)))
+uint8_t bench_trace_record_buffer[BENCH_TRACE_RECORD_SIZE];
+
+// sample and open the trace file, returns false if we should skip this
+// trace
+static bool bench_trace_sample(void) {
+    // sample at a specific period?
+    if (bench_trace_period) {
+        if (bench_trace_cycles % bench_trace_period != 0) {
             bench_trace_cycles += 1;
+            return false;
         }
+        bench_trace_cycles += 1;
+    }
 
-        // sample at a specific frequency?
-        if (bench_trace_freq) {
-            struct timespec t;
-            clock_gettime(CLOCK_MONOTONIC, &t);
-            uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
-                    + (uint64_t)t.tv_nsec;
-            if (now - bench_trace_time < (1000*1000*1000) / bench_trace_freq) {
-                return;
-            }
-            bench_trace_time = now;
+    // sample at a specific frequency?
+    if (bench_trace_freq) {
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
+                + (uint64_t)t.tv_nsec;
+        if (now - bench_trace_time < (1000*1000*1000) / bench_trace_freq) {
+            return false;
         }
+        bench_trace_time = now;
+    }
 
-        if (!bench_trace_file) {
-            // Tracing output is heavy and trying to open every trace
-            // call is slow, so we only try to open the trace file every
-            // so often. Note this doesn't affect successfully opened files
-            struct timespec t;
-            clock_gettime(CLOCK_MONOTONIC, &t);
-            uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
-                    + (uint64_t)t.tv_nsec;
-            if (now - bench_trace_open_time < 100*1000*1000) {
-                return;
+    if (!bench_trace_file) {
+        // Tracing output is heavy and trying to open every trace
+        // call is slow, so we only try to open the trace file every
+        // so often. Note this doesn't affect successfully opened files
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
+                + (uint64_t)t.tv_nsec;
+        if (now - bench_trace_open_time < 100*1000*1000) {
+            return false;
+        }
+        bench_trace_open_time = now;
+
+        // try to open the trace file
+        int fd;
+        if (strcmp(bench_trace_path, "-") == 0) {
+            fd = dup(1);
+            if (fd < 0) {
+                return false;
             }
-            bench_trace_open_time = now;
-
-            // try to open the trace file
-            int fd;
-            if (strcmp(bench_trace_path, "-") == 0) {
-                fd = dup(1);
-                if (fd < 0) {
-                    return;
-                }
-            } else {
-                fd = open(
-                        bench_trace_path,
-                        O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK,
-                        0666);
-                if (fd < 0) {
-                    return;
-                }
-                int err = fcntl(fd, F_SETFL, O_WRONLY | O_CREAT | O_APPEND);
-                assert(!err);
+        } else {
+            fd = open(
+                    bench_trace_path,
+                    O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK,
+                    0666);
+            if (fd < 0) {
+                return false;
             }
-
-            FILE *f = fdopen(fd, "a");
-            assert(f);
-            int err = setvbuf(f, NULL, _IOFBF,
-                    BENCH_TRACE_BACKTRACE_BUFFER_SIZE);
+            int err = fcntl(fd, F_SETFL, O_WRONLY | O_CREAT | O_APPEND);
             assert(!err);
-            bench_trace_file = f;
+        }
+
+        FILE *f = fdopen(fd, "a");
+        assert(f);
+        // binary records must fit in the buffer, otherwise stdio may
+        // split them across multiple writes
+        int err = setvbuf(f, NULL, _IOFBF,
+                (bench_trace_binary)
+                    ? BENCH_TRACE_RECORD_SIZE
+                    : BENCH_TRACE_BACKTRACE_BUFFER_SIZE);
+        assert(!err);
+        bench_trace_file = f;
+    }
+
+    return true;
+}
+
+// trace printing
+void bench_trace(const char *fmt, ...) {
+    // binary traces only contain block device operations
+    if (bench_trace_path && !bench_trace_binary) {
+        if (!bench_trace_sample()) {
+            return;
         }
 
         // print trace
@@ -542,6 +576,60 @@ void bench_trace(const char *fmt, ...) {
     }
 }
 
+// binary trace records, these are much cheaper to write and parse than
+// text, each record is a native-endian header:
+//
+// [ 'b' | 'd' | op  |  0  |  block  |   off   |  size   |  count  | anchor ]
+//    8     8     8     8      32        32        32        32       64
+//
+// followed by count 64-bit backtrace addresses. anchor is the runtime
+// address of lfs_emubd_read, which lets scripts undo ASLR, note the 0 byte
+// is never valid in text traces
+void bench_trace_op(char op, uint32_t block, uint32_t off, uint32_t size) {
+    if (bench_trace_path && bench_trace_binary) {
+        if (!bench_trace_sample()) {
+            return;
+        }
+
+        // find backtrace
+        size_t count = 0;
+        if (bench_trace_backtrace) {
+            count = backtrace(
+                    bench_trace_backtrace_buffer,
+                    BENCH_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*));
+            // note we skip our own stack frame
+            count = (count > 0) ? count-1 : 0;
+        }
+
+        // build the record
+        uint8_t *record = bench_trace_record_buffer;
+        record[0] = 'b';
+        record[1] = 'd';
+        record[2] = op;
+        record[3] = 0;
+        uint32_t count32 = count;
+        uint64_t anchor = (uintptr_t)lfs_emubd_read;
+        memcpy(&record[4], &block, sizeof(uint32_t));
+        memcpy(&record[8], &off, sizeof(uint32_t));
+        memcpy(&record[12], &size, sizeof(uint32_t));
+        memcpy(&record[16], &count32, sizeof(uint32_t));
+        memcpy(&record[20], &anchor, sizeof(uint64_t));
+        for (size_t i = 0; i < count; i++) {
+            uint64_t addr = (uintptr_t)bench_trace_backtrace_buffer[i+1];
+            memcpy(&record[28 + 8*i], &addr, sizeof(uint64_t));
+        }
+
+        // write and flush immediately, the record fits in our stdio
+        // buffer, so this is a single write
+        if (fwrite(record, 28 + 8*count, 1, bench_trace_file) != 1
+                || fflush(bench_trace_file) != 0) {
+            fclose(bench_trace_file);
+            bench_trace_file = NULL;
+            return;
+        }
+    }
+}
+
 
 // bench prng
 uint32_t bench_prng(uint32_t *state) {
@@ -574,6 +662,36 @@ void bench_reset(void) {
     bench_last_erased = 0;
 }
 
+// optionally log BENCH_START/BENCH_STOP timestamps to the file in
+// PERF_MARKERS, perf.py sets this when recording so it can attribute
+// samples to the measured windows
+//
+// note we open with O_APPEND so lines from forked workers don't interleave
+static int bench_markers_fd = -2;
+
+static void bench_mark(const char *op) {
+    if (bench_markers_fd == -2) {
+        const char *path = getenv("PERF_MARKERS");
+        bench_markers_fd = (path)
+                ? open(path, O_WRONLY | O_APPEND | O_CREAT, 0666)
+                : -1;
+    }
+
+    if (bench_markers_fd >= 0) {
+        // this needs to match perf's clock, perf.py records with
+        // --clockid=monotonic
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        char buf[64];
+        int len = snprintf(buf, sizeof(buf), "%d %s %"PRIu64"\n",
+                (int)getpid(),
+                op,
+                (uint64_t)t.tv_sec*1000*1000*1000 + (uint64_t)t.tv_nsec);
+        ssize_t res = write(bench_markers_fd, buf, len);
+        (void)res;
+    }
+}
+
 void bench_start(void) {
     assert(bench_cfg);
     lfs_emubd_sio_t readed = lfs_emubd_readed(bench_cfg);
@@ -586,10 +704,14 @@ void bench_start(void) {
     bench_last_readed = readed;
     bench_last_proged = proged;
     bench_last_erased = erased;
+
+    bench_mark("start");
 }
 
 void bench_stop(void) {
     assert(bench_cfg);
+    bench_mark("stop");
+
     lfs_emubd_sio_t readed = lfs_emubd_readed(bench_cfg);
     assert(readed >= 0);
     lfs_emubd_sio_t proged = lfs_emubd_proged(bench_cfg);
@@ -604,24 +726,78 @@ void bench_stop(void) {
 
 
 // encode our permutation into a reusable id
-static void perm_printid(
+static void perm_printid(FILE *f,
         const struct bench_suite *suite,
         const struct bench_case *case_) {
     (void)suite;
     // case[:permutation]
-    printf("%s:", case_->name);
+    fprintf(f, "%s:", case_->name);
     for (size_t d = 0;
             d < lfs_max(
                 suite->define_count,
                 BENCH_IMPLICIT_DEFINE_COUNT);
             d++) {
         if (bench_define_ispermutation(d)) {
-            leb16_print(d);
-            leb16_print(BENCH_DEFINE(d));
+            leb16_print(f, d);
+            leb16_print(f, BENCH_DEFINE(d));
+        }
+    }
+}
+
+// print the permutation's explicit defines as key=value pairs
+static void perm_printdefines(FILE *f,
+        const struct bench_suite *suite,
+        const struct bench_case *case_) {
+    (void)case_;
+    for (size_t d = 0;
+            d < lfs_max(
+                suite->define_count,
+                BENCH_IMPLICIT_DEFINE_COUNT);
+            d++) {
+        const char *name = bench_define_name(d);
+        if (name && bench_define_ispermutation(d)) {
+            fprintf(f, " %s=%jd", name, BENCH_DEFINE(d));
         }
     }
 }
 
+// start a status line
+//
+// with --status-fd, status lines go to their own fd so stdout can be
+// treated as an opaque stream, ops are also shortened to their first
+// letter since no one is reading these by hand
+static void status_printop(const char *op) {
+    if (bench_status_fd >= 0) {
+        // make sure any output from the previous op lands first
+        fflush(stdout);
+        fprintf(bench_status, "%c", op[0]);
+    } else {
+        fprintf(bench_status, "%s ", op);
+    }
+}
+
+// print a status line, op id[ define=value...]
+static void perm_printstatus(
+        const char *op,
+        const struct bench_suite *suite,
+        const struct bench_case *case_) {
+    status_printop(op);
+    perm_printid(bench_status, suite, case_);
+    if (bench_status_format == BENCH_STATUS_KV) {
+        perm_printdefines(bench_status, suite, case_);
+    }
+    fprintf(bench_status, "\n");
+
+    // stdout and the status fd aren't ordered, so also mark where each
+    // permutation starts in stdout, this lets scripts find a failing
+    // permutation's output
+    if (bench_status_fd >= 0 && strcmp(op, "running") == 0) {
+        printf("running ");
+        perm_printid(stdout, suite, case_);
+        printf("\n");
+    }
+}
+
 // a quick trie for keeping track of permutations we've seen
 typedef struct bench_seen {
     struct bench_seen_branch *branches;
@@ -1299,9 +1475,7 @@ void perm_run(
 
     // filter?
     if (case_->filter && !case_->filter()) {
-        printf("skipped ");
-        perm_printid(suite, case_);
-        printf("\n");
+        perm_printstatus("skipped", suite, case_);
         return;
     }
 
@@ -1349,19 +1523,29 @@ void perm_run(
     // run the bench
     bench_cfg = &cfg;
     bench_reset();
-    printf("running ");
-    perm_printid(suite, case_);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     case_->run(&cfg);
 
-    printf("finished ");
-    perm_printid(suite, case_);
-    printf(" %"PRIu64" %"PRIu64" %"PRIu64,
-        bench_readed,
-        bench_proged,
-        bench_erased);
-    printf("\n");
+    status_printop("finished");
+    perm_printid(bench_status, suite, case_);
+    if (bench_status_format == BENCH_STATUS_KV) {
+        perm_printdefines(bench_status, suite, case_);
+    }
+    // counts are always kv on a status fd
+    if (bench_status_format == BENCH_STATUS_KV || bench_status_fd >= 0) {
+        fprintf(bench_status,
+                " readed=%"PRIu64" proged=%"PRIu64" erased=%"PRIu64,
+                bench_readed,
+                bench_proged,
+                bench_erased);
+    } else {
+        fprintf(bench_status, " %"PRIu64" %"PRIu64" %"PRIu64,
+                bench_readed,
+                bench_proged,
+                bench_erased);
+    }
+    fprintf(bench_status, "\n");
 
     // cleanup
     err = lfs_emubd_destroy(&cfg);
@@ -1402,6 +1586,69 @@ static void run(void) {
 }
 
 
+// run step ranges as they are requested over stdin
+//
+// each request is a line containing start,stop, which we run in a forked
+// child so permutations stay isolated without paying for a new process. Once
+// the child is done we report its exit status, or the negated signal if it
+// was killed, with an exited line.
+static void worker(void) {
+    // ignore disconnected pipes
+    signal(SIGPIPE, SIG_IGN);
+
+    char line[256];
+    while (fgets(line, sizeof(line), stdin)) {
+        char *parsed = NULL;
+        size_t start = strtoumax(line, &parsed, 0);
+        if (parsed == line || *parsed != ',') {
+            goto request_unknown;
+        }
+        char *stop_ = parsed+1;
+        size_t stop = strtoumax(stop_, &parsed, 0);
+        if (parsed == stop_) {
+            goto request_unknown;
+        }
+        parsed += strspn(parsed, " \r\n");
+        if (*parsed != '\0') {
+            goto request_unknown;
+        }
+
+        // flush before forking so buffered output isn't duplicated
+        fflush(stdout);
+        fflush(stderr);
+        fflush(bench_status);
+        pid_t pid = fork();
+        if (pid < 0) {
+            perror("fork");
+            exit(-1);
+        }
+
+        if (pid == 0) {
+            bench_step_start = start;
+            bench_step_stop = stop;
+            run();
+            exit(0);
+        }
+
+        int status;
+        if (waitpid(pid, &status, 0) < 0) {
+            perror("waitpid");
+            exit(-1);
+        }
+
+        status_printop("exited");
+        fprintf(bench_status, "%d\n",
+                (WIFSIGNALED(status)) ? -WTERMSIG(status)
+                    : WEXITSTATUS(status));
+        fflush(bench_status);
+        continue;
+
+request_unknown:
+        fprintf(stderr, "error: invalid worker request: %s", line);
+        exit(-1);
+    }
+}
+
 
 // option handling
 enum opt_flags {
@@ -1426,6 +1673,10 @@ enum opt_flags {
     OPT_READ_SLEEP               = 10,
     OPT_PROG_SLEEP               = 11,
     OPT_ERASE_SLEEP              = 12,
+    OPT_STATUS_FORMAT            = 13,
+    OPT_WORKER                   = 14,
+    OPT_STATUS_FD                = 15,
+    OPT_TRACE_BINARY             = 16,
 };
 
 const char *short_opts = "hYlLD:G:s:d:t:";
@@ -1451,9 +1702,13 @@ const struct option long_opts[] = {
     {"trace-backtrace",  no_argument,       NULL, OPT_TRACE_BACKTRACE},
     {"trace-period",     required_argument, NULL, OPT_TRACE_PERIOD},
     {"trace-freq",       required_argument, NULL, OPT_TRACE_FREQ},
+    {"trace-binary",     no_argument,       NULL, OPT_TRACE_BINARY},
     {"read-sleep",       required_argument, NULL, OPT_READ_SLEEP},
     {"prog-sleep",       required_argument, NULL, OPT_PROG_SLEEP},
     {"erase-sleep",      required_argument, NULL, OPT_ERASE_SLEEP},
+    {"status-format",    required_argument, NULL, OPT_STATUS_FORMAT},
+    {"worker",           no_argument,       NULL, OPT_WORKER},
+    {"status-fd",        required_argument, NULL, OPT_STATUS_FD},
     {NULL, 0, NULL, 0},
 };
 
@@ -1476,9 +1731,13 @@ const char *const help_text[] = {
     "Include a backtrace with every trace statement.",
     "Sample trace output at this period in cycles.",
     "Sample trace output at this frequency in hz.",
+    "Write block device operations to the trace in a compact binary format.",
     "Artificial read delay in seconds.",
     "Artificial prog delay in seconds.",
     "Artificial erase delay in seconds.",
+    "Format of status lines, either text or kv. kv includes defines.",
+    "Run step ranges read from stdin, forking for each range.",
+    "Write status lines to this fd in a compact format instead of stdout.",
 };
 
 int main(int argc, char **argv) {
@@ -1910,6 +2169,9 @@ step_unknown:
             case OPT_TRACE_BACKTRACE:
                 bench_trace_backtrace = true;
                 break;
+            case OPT_TRACE_BINARY:
+                bench_trace_binary = true;
+                break;
             case OPT_TRACE_PERIOD: {
                 char *parsed = NULL;
                 bench_trace_period = strtoumax(optarg, &parsed, 0);
@@ -1958,6 +2220,29 @@ step_unknown:
                 bench_erase_sleep = erase_sleep*1.0e9;
                 break;
             }
+            case OPT_STATUS_FORMAT:
+                if (strcmp(optarg, "text") == 0) {
+                    bench_status_format = BENCH_STATUS_TEXT;
+                } else if (strcmp(optarg, "kv") == 0) {
+                    bench_status_format = BENCH_STATUS_KV;
+                } else {
+                    fprintf(stderr, "error: unknown status format: %s\n",
+                            optarg);
+                    exit(-1);
+                }
+                break;
+            case OPT_WORKER:
+                op = worker;
+                break;
+            case OPT_STATUS_FD: {
+                char *parsed = NULL;
+                bench_status_fd = strtol(optarg, &parsed, 0);
+                if (parsed == optarg || bench_status_fd < 0) {
+                    fprintf(stderr, "error: invalid status-fd: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            }
             // done parsing
             case -1:
                 goto getopt_done;
@@ -2035,6 +2320,22 @@ getopt_done: ;
         };
     }
 
+    // where do status lines go?
+    if (bench_status_fd >= 0) {
+        bench_status = fdopen(bench_status_fd, "w");
+        if (!bench_status) {
+            fprintf(stderr, "error: could not open status-fd %d: %s\n",
+                    bench_status_fd, strerror(errno));
+            exit(-1);
+        }
+        setvbuf(bench_status, NULL, _IOLBF, 0);
+        // stdout is now likely a pipe, line-buffer it so a crashing
+        // permutation doesn't lose its output
+        setvbuf(stdout, NULL, _IOLBF, 0);
+    } else {
+        bench_status = stdout;
+    }
+
     // do the thing
     op();
 
@@ -18,6 +18,8 @@ void bench_trace(const char *fmt, ...);
         __VA_ARGS__)
 #define LFS_TRACE(...) LFS_TRACE_(__VA_ARGS__, "")
 #define LFS_EMUBD_TRACE(...) LFS_TRACE_(__VA_ARGS__, "")
+#define LFS_EMUBD_TRACEOP(op, block, off, size) \
+    bench_trace_op(op, block, off, size)
 
 // provide BENCH_START/BENCH_STOP macros
 void bench_start(void);
@@ -31,6 +33,9 @@ void bench_stop(void);
 #include "bd/lfs_emubd.h"
 #include <stdio.h>
 
+// binary block device traces, see LFS_EMUBD_TRACEOP
+void bench_trace_op(char op, uint32_t block, uint32_t off, uint32_t size);
+
 // give source a chance to define feature macros
 #undef _FEATURES_H
 #undef _STDIO_H
@@ -13,6 +13,7 @@
 
 #include <getopt.h>
 #include <sys/types.h>
+#include <sys/wait.h>
 #include <errno.h>
 #include <setjmp.h>
 #include <fcntl.h>
@@ -51,16 +52,16 @@ void *mappend(void **p,
 }
 
 // a quick self-terminating text-safe varint scheme
-static void leb16_print(uintmax_t x) {
+static void leb16_print(FILE *f, uintmax_t x) {
     // allow 'w' to indicate negative numbers
     if ((intmax_t)x < 0) {
-        printf("w");
+        fprintf(f, "w");
         x = -x;
     }
 
     while (true) {
         char nibble = (x & 0xf) | (x > 0xf ? 0x10 : 0);
-        printf("%c", (nibble < 10) ? '0'+nibble : 'a'+nibble-10);
+        fprintf(f, "%c", (nibble < 10) ? '0'+nibble : 'a'+nibble-10);
         if (x <= 0xf) {
             break;
         }
@@ -443,6 +444,7 @@ size_t test_step_step = 1;
 const char *test_disk_path = NULL;
 const char *test_trace_path = NULL;
 bool test_trace_backtrace = false;
+bool test_trace_binary = false;
 uint32_t test_trace_period = 0;
 uint32_t test_trace_freq = 0;
 FILE *test_trace_file = NULL;
@@ -453,6 +455,16 @@ lfs_emubd_sleep_t test_read_sleep = 0.0;
 lfs_emubd_sleep_t test_prog_sleep = 0.0;
 lfs_emubd_sleep_t test_erase_sleep = 0.0;
 
+// status line formats, kv appends the permutation's defines to status
+// lines so they don't need to be queried separately
+enum test_status_format {
+    TEST_STATUS_TEXT = 0,
+    TEST_STATUS_KV   = 1,
+};
+uint8_t test_status_format = TEST_STATUS_TEXT;
+int test_status_fd = -1;
+FILE *test_status = NULL;
+
 // this determines both the backtrace buffer and the trace printf buffer, if
 // trace ends up interleaved or truncated this may need to be increased
 #ifndef TEST_TRACE_BACKTRACE_BUFFER_SIZE
@@ -461,68 +473,90 @@ lfs_emubd_sleep_t test_erase_sleep = 0.0;
 void *test_trace_backtrace_buffer[
     TEST_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*)];
 
-// trace printing
-void test_trace(const char *fmt, ...) {
-    if (test_trace_path) {
-        // sample at a specific period?
-        if (test_trace_period) {
-            if (test_trace_cycles % test_trace_period != 0) {
-                test_trace_cycles += 1;
-                return;
-            }
+// binary trace records are built here so each record is written with a
+// single write, a record is a 28-byte header followed by up to one 64-bit
+// address per backtrace frame
+#define TEST_TRACE_RECORD_SIZE (28 \
+    + 8*(TEST_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*)))
+uint8_t test_trace_record_buffer[TEST_TRACE_RECORD_SIZE];
+
+// sample and open the trace file, returns false if we should skip this
+// trace
+static bool test_trace_sample(void) {
+    // sample at a specific period?
+    if (test_trace_period) {
+        if (test_trace_cycles % test_trace_period != 0) {
             test_trace_cycles += 1;
+            return false;
         }
+        test_trace_cycles += 1;
+    }
 
-        // sample at a specific frequency?
-        if (test_trace_freq) {
-            struct timespec t;
-            clock_gettime(CLOCK_MONOTONIC, &t);
-            uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
-                    + (uint64_t)t.tv_nsec;
-            if (now - test_trace_time < (1000*1000*1000) / test_trace_freq) {
-                return;
+    // sample at a specific frequency?
+    if (test_trace_freq) {
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
+                + (uint64_t)t.tv_nsec;
+        if (now - test_trace_time < (1000*1000*1000) / test_trace_freq) {
+            return false;
+        }
+        test_trace_time = now;
+    }
+
+    if (!test_trace_file) {
+        // Tracing output is heavy and trying to open every trace
+        // call is slow, so we only try to open the trace file every
+        // so often. Note this doesn't affect successfully opened files
+        struct timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
+                + (uint64_t)t.tv_nsec;
+        if (now - test_trace_open_time < 100*1000*1000) {
+            return false;
+        }
+        test_trace_open_time = now;
+
+        // try to open the trace file
+        int fd;
+        if (strcmp(test_trace_path, "-") == 0) {
+            fd = dup(1);
+            if (fd < 0) {
+                return false;
             }
-            test_trace_time = now;
-        }
-
-        if (!test_trace_file) {
-            // Tracing output is heavy and trying to open every trace
-            // call is slow, so we only try to open the trace file every
-            // so often. Note this doesn't affect successfully opened files
-            struct timespec t;
-            clock_gettime(CLOCK_MONOTONIC, &t);
-            uint64_t now = (uint64_t)t.tv_sec*1000*1000*1000
-                    + (uint64_t)t.tv_nsec;
-            if (now - test_trace_open_time < 100*1000*1000) {
-                return;
+        } else {
+            fd = open(
+                    test_trace_path,
+                    O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK,
+                    0666);
+            if (fd < 0) {
+                return false;
             }
-            test_trace_open_time = now;
+            int err = fcntl(fd, F_SETFL, O_WRONLY | O_CREAT | O_APPEND);
+            assert(!err);
+        }
 
-            // try to open the trace file
-            int fd;
-            if (strcmp(test_trace_path, "-") == 0) {
-                fd = dup(1);
-                if (fd < 0) {
-                    return;
-                }
-            } else {
-                fd = open(
-                        test_trace_path,
-                        O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK,
-                        0666);
-                if (fd < 0) {
-                    return;
-                }
-                int err = fcntl(fd, F_SETFL, O_WRONLY | O_CREAT | O_APPEND);
-                assert(!err);
-            }
+        FILE *f = fdopen(fd, "a");
+        assert(f);
+        // binary records must fit in the buffer, otherwise stdio may
+        // split them across multiple writes
+        int err = setvbuf(f, NULL, _IOFBF,
+                (test_trace_binary)
+                    ? TEST_TRACE_RECORD_SIZE
+                    : TEST_TRACE_BACKTRACE_BUFFER_SIZE);
+        assert(!err);
+        test_trace_file = f;
+    }
 
-            FILE *f = fdopen(fd, "a");
-            assert(f);
-            int err = setvbuf(f, NULL, _IOFBF,
-                    TEST_TRACE_BACKTRACE_BUFFER_SIZE);
-            assert(!err);
-            test_trace_file = f;
+    return true;
+}
+
+// trace printing
+void test_trace(const char *fmt, ...) {
+    // binary traces only contain block device operations
+    if (test_trace_path && !test_trace_binary) {
+        if (!test_trace_sample()) {
+            return;
         }
 
         // print trace
@@ -558,6 +592,60 @@ void test_trace(const char *fmt, ...) {
     }
 }
 
+// binary trace records, these are much cheaper to write and parse than
+// text, each record is a native-endian header:
+//
+// [ 'b' | 'd' | op  |  0  |  block  |   off   |  size   |  count  | anchor ]
+//    8     8     8     8      32        32        32        32       64
+//
+// followed by count 64-bit backtrace addresses. anchor is the runtime
+// address of lfs_emubd_read, which lets scripts undo ASLR, note the 0 byte
+// is never valid in text traces
+void test_trace_op(char op, uint32_t block, uint32_t off, uint32_t size) {
+    if (test_trace_path && test_trace_binary) {
+        if (!test_trace_sample()) {
+            return;
+        }
+
+        // find backtrace
+        size_t count = 0;
+        if (test_trace_backtrace) {
+            count = backtrace(
+                    test_trace_backtrace_buffer,
+                    TEST_TRACE_BACKTRACE_BUFFER_SIZE / sizeof(void*));
+            // note we skip our own stack frame
+            count = (count > 0) ? count-1 : 0;
+        }
+
+        // build the record
+        uint8_t *record = test_trace_record_buffer;
+        record[0] = 'b';
+        record[1] = 'd';
+        record[2] = op;
+        record[3] = 0;
+        uint32_t count32 = count;
+        uint64_t anchor = (uintptr_t)lfs_emubd_read;
+        memcpy(&record[4], &block, sizeof(uint32_t));
+        memcpy(&record[8], &off, sizeof(uint32_t));
+        memcpy(&record[12], &size, sizeof(uint32_t));
+        memcpy(&record[16], &count32, sizeof(uint32_t));
+        memcpy(&record[20], &anchor, sizeof(uint64_t));
+        for (size_t i = 0; i < count; i++) {
+            uint64_t addr = (uintptr_t)test_trace_backtrace_buffer[i+1];
+            memcpy(&record[28 + 8*i], &addr, sizeof(uint64_t));
+        }
+
+        // write and flush immediately, the record fits in our stdio
+        // buffer, so this is a single write
+        if (fwrite(record, 28 + 8*count, 1, test_trace_file) != 1
+                || fflush(test_trace_file) != 0) {
+            fclose(test_trace_file);
+            test_trace_file = NULL;
+            return;
+        }
+    }
+}
+
 
 // test prng
 uint32_t test_prng(uint32_t *state) {
@@ -573,34 +661,89 @@ uint32_t test_prng(uint32_t *state) {
 
 
 // encode our permutation into a reusable id
-static void perm_printid(
+static void perm_printid(FILE *f,
         const struct test_suite *suite,
         const struct test_case *case_,
         const lfs_emubd_powercycles_t *cycles,
         size_t cycle_count) {
     (void)suite;
     // case[:permutation[:powercycles]]
-    printf("%s:", case_->name);
+    fprintf(f, "%s:", case_->name);
     for (size_t d = 0;
             d < lfs_max(
                 suite->define_count,
                 TEST_IMPLICIT_DEFINE_COUNT);
             d++) {
         if (test_define_ispermutation(d)) {
-            leb16_print(d);
-            leb16_print(TEST_DEFINE(d));
+            leb16_print(f, d);
+            leb16_print(f, TEST_DEFINE(d));
         }
     }
 
     // only print power-cycles if any occured
     if (cycles) {
-        printf(":");
+        fprintf(f, ":");
         for (size_t i = 0; i < cycle_count; i++) {
-            leb16_print(cycles[i]);
+            leb16_print(f, cycles[i]);
+        }
+    }
+}
+
+
+// print the permutation's explicit defines as key=value pairs
+static void perm_printdefines(FILE *f,
+        const struct test_suite *suite,
+        const struct test_case *case_) {
+    (void)case_;
+    for (size_t d = 0;
+            d < lfs_max(
+                suite->define_count,
+                TEST_IMPLICIT_DEFINE_COUNT);
+            d++) {
+        const char *name = test_define_name(d);
+        if (name && test_define_ispermutation(d)) {
+            fprintf(f, " %s=%jd", name, TEST_DEFINE(d));
         }
     }
 }
 
+// start a status line
+//
+// with --status-fd, status lines go to their own fd so stdout can be
+// treated as an opaque stream, ops are also shortened to their first
+// letter since no one is reading these by hand
+static void status_printop(const char *op) {
+    if (test_status_fd >= 0) {
+        // make sure any output from the previous op lands first
+        fflush(stdout);
+        fprintf(test_status, "%c", op[0]);
+    } else {
+        fprintf(test_status, "%s ", op);
+    }
+}
+
+// print a status line, op id[ define=value...]
+static void perm_printstatus(
+        const char *op,
+        const struct test_suite *suite,
+        const struct test_case *case_) {
+    status_printop(op);
+    perm_printid(test_status, suite, case_, NULL, 0);
+    if (test_status_format == TEST_STATUS_KV) {
+        perm_printdefines(test_status, suite, case_);
+    }
+    fprintf(test_status, "\n");
+
+    // stdout and the status fd aren't ordered, so also mark where each
+    // permutation starts in stdout, this lets scripts find a failing
+    // permutation's output
+    if (test_status_fd >= 0 && strcmp(op, "running") == 0) {
+        printf("running ");
+        perm_printid(stdout, suite, case_, NULL, 0);
+        printf("\n");
+    }
+}
+
 
 // a quick trie for keeping track of permutations we've seen
 typedef struct test_seen {
@@ -1375,15 +1518,11 @@ static void run_powerloss_none(
     }
 
     // run the test
-    printf("running ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     case_->run(&cfg);
 
-    printf("finished ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("finished", suite, case_);
 
     // cleanup
     err = lfs_emubd_destroy(&cfg);
@@ -1458,9 +1597,7 @@ static void run_powerloss_linear(
     }
 
     // run the test, increasing power-cycles as power-loss events occur
-    printf("running ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     while (true) {
         if (!setjmp(powerloss_jmp)) {
@@ -1470,21 +1607,19 @@ static void run_powerloss_linear(
         }
 
         // power-loss!
-        printf("powerloss ");
-        perm_printid(suite, case_, NULL, 0);
-        printf(":");
+        status_printop("powerloss");
+        perm_printid(test_status, suite, case_, NULL, 0);
+        fprintf(test_status, ":");
         for (lfs_emubd_powercycles_t j = 1; j <= i; j++) {
-            leb16_print(j);
+            leb16_print(test_status, j);
         }
-        printf("\n");
+        fprintf(test_status, "\n");
 
         i += 1;
         lfs_emubd_setpowercycles(&cfg, i);
     }
 
-    printf("finished ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("finished", suite, case_);
 
     // cleanup
     err = lfs_emubd_destroy(&cfg);
@@ -1554,9 +1689,7 @@ static void run_powerloss_log(
     }
 
     // run the test, increasing power-cycles as power-loss events occur
-    printf("running ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     while (true) {
         if (!setjmp(powerloss_jmp)) {
@@ -1566,21 +1699,19 @@ static void run_powerloss_log(
         }
 
         // power-loss!
-        printf("powerloss ");
-        perm_printid(suite, case_, NULL, 0);
-        printf(":");
+        status_printop("powerloss");
+        perm_printid(test_status, suite, case_, NULL, 0);
+        fprintf(test_status, ":");
         for (lfs_emubd_powercycles_t j = 1; j <= i; j *= 2) {
-            leb16_print(j);
+            leb16_print(test_status, j);
         }
-        printf("\n");
+        fprintf(test_status, "\n");
 
         i *= 2;
         lfs_emubd_setpowercycles(&cfg, i);
     }
 
-    printf("finished ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("finished", suite, case_);
 
     // cleanup
     err = lfs_emubd_destroy(&cfg);
@@ -1648,9 +1779,7 @@ static void run_powerloss_cycles(
     }
 
     // run the test, increasing power-cycles as power-loss events occur
-    printf("running ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     while (true) {
         if (!setjmp(powerloss_jmp)) {
@@ -1661,18 +1790,16 @@ static void run_powerloss_cycles(
 
         // power-loss!
         assert(i <= cycle_count);
-        printf("powerloss ");
-        perm_printid(suite, case_, cycles, i+1);
-        printf("\n");
+        status_printop("powerloss");
+        perm_printid(test_status, suite, case_, cycles, i+1);
+        fprintf(test_status, "\n");
 
         i += 1;
         lfs_emubd_setpowercycles(&cfg,
                 (i < cycle_count) ? cycles[i] : 0);
     }
 
-    printf("finished ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("finished", suite, case_);
 
     // cleanup
     err = lfs_emubd_destroy(&cfg);
@@ -1765,9 +1892,10 @@ static void run_powerloss_exhaustive_layer(
         }
         *cycle = i+1;
 
-        printf("powerloss ");
-        perm_printid(suite, case_, cycles->cycles, cycles->cycle_count);
-        printf("\n");
+        status_printop("powerloss");
+        perm_printid(test_status,
+                suite, case_, cycles->cycles, cycles->cycle_count);
+        fprintf(test_status, "\n");
 
         // now recurse
         cfg->context = &state.branches[i];
@@ -1839,9 +1967,7 @@ static void run_powerloss_exhaustive(
     }
 
     // run the test, increasing power-cycles as power-loss events occur
-    printf("running ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("running", suite, case_);
 
     // recursively exhaust each layer of powerlosses
     run_powerloss_exhaustive_layer(
@@ -1849,9 +1975,7 @@ static void run_powerloss_exhaustive(
             suite, case_,
             &cfg, &bdcfg, cycle_count);
 
-    printf("finished ");
-    perm_printid(suite, case_, NULL, 0);
-    printf("\n");
+    perm_printstatus("finished", suite, case_);
 }
 
 
@@ -1929,9 +2053,7 @@ void perm_run(
 
     // filter?
     if (case_->filter && !case_->filter()) {
-        printf("skipped ");
-        perm_printid(suite, case_, NULL, 0);
-        printf("\n");
+        perm_printstatus("skipped", suite, case_);
         return;
     }
 
@@ -1973,6 +2095,69 @@ static void run(void) {
 }
 
 
+// run step ranges as they are requested over stdin
+//
+// each request is a line containing start,stop, which we run in a forked
+// child so permutations stay isolated without paying for a new process. Once
+// the child is done we report its exit status, or the negated signal if it
+// was killed, with an exited line.
+static void worker(void) {
+    // ignore disconnected pipes
+    signal(SIGPIPE, SIG_IGN);
+
+    char line[256];
+    while (fgets(line, sizeof(line), stdin)) {
+        char *parsed = NULL;
+        size_t start = strtoumax(line, &parsed, 0);
+        if (parsed == line || *parsed != ',') {
+            goto request_unknown;
+        }
+        char *stop_ = parsed+1;
+        size_t stop = strtoumax(stop_, &parsed, 0);
+        if (parsed == stop_) {
+            goto request_unknown;
+        }
+        parsed += strspn(parsed, " \r\n");
+        if (*parsed != '\0') {
+            goto request_unknown;
+        }
+
+        // flush before forking so buffered output isn't duplicated
+        fflush(stdout);
+        fflush(stderr);
+        fflush(test_status);
+        pid_t pid = fork();
+        if (pid < 0) {
+            perror("fork");
+            exit(-1);
+        }
+
+        if (pid == 0) {
+            test_step_start = start;
+            test_step_stop = stop;
+            run();
+            exit(0);
+        }
+
+        int status;
+        if (waitpid(pid, &status, 0) < 0) {
+            perror("waitpid");
+            exit(-1);
+        }
+
+        status_printop("exited");
+        fprintf(test_status, "%d\n",
+                (WIFSIGNALED(status)) ? -WTERMSIG(status)
+                    : WEXITSTATUS(status));
+        fflush(test_status);
+        continue;
+
+request_unknown:
+        fprintf(stderr, "error: invalid worker request: %s", line);
+        exit(-1);
+    }
+}
+
 
 // option handling
 enum opt_flags {
@@ -1999,6 +2184,10 @@ enum opt_flags {
     OPT_READ_SLEEP               = 11,
     OPT_PROG_SLEEP               = 12,
     OPT_ERASE_SLEEP              = 13,
+    OPT_STATUS_FORMAT            = 14,
+    OPT_WORKER                   = 15,
+    OPT_STATUS_FD                = 16,
+    OPT_TRACE_BINARY             = 17,
 };
 
 const char *short_opts = "hYlLD:G:P:s:d:t:";
@@ -2026,9 +2215,13 @@ const struct option long_opts[] = {
     {"trace-backtrace",  no_argument,       NULL, OPT_TRACE_BACKTRACE},
     {"trace-period",     required_argument, NULL, OPT_TRACE_PERIOD},
     {"trace-freq",       required_argument, NULL, OPT_TRACE_FREQ},
+    {"trace-binary",     no_argument,       NULL, OPT_TRACE_BINARY},
     {"read-sleep",       required_argument, NULL, OPT_READ_SLEEP},
     {"prog-sleep",       required_argument, NULL, OPT_PROG_SLEEP},
     {"erase-sleep",      required_argument, NULL, OPT_ERASE_SLEEP},
+    {"status-format",    required_argument, NULL, OPT_STATUS_FORMAT},
+    {"worker",           no_argument,       NULL, OPT_WORKER},
+    {"status-fd",        required_argument, NULL, OPT_STATUS_FD},
     {NULL, 0, NULL, 0},
 };
 
@@ -2053,9 +2246,13 @@ const char *const help_text[] = {
     "Include a backtrace with every trace statement.",
     "Sample trace output at this period in cycles.",
     "Sample trace output at this frequency in hz.",
+    "Write block device operations to the trace in a compact binary format.",
     "Artificial read delay in seconds.",
     "Artificial prog delay in seconds.",
     "Artificial erase delay in seconds.",
+    "Format of status lines, either text or kv. kv includes defines.",
+    "Run step ranges read from stdin, forking for each range.",
+    "Write status lines to this fd in a compact format instead of stdout.",
 };
 
 int main(int argc, char **argv) {
@@ -2627,6 +2824,9 @@ step_unknown:
             case OPT_TRACE_BACKTRACE:
                 test_trace_backtrace = true;
                 break;
+            case OPT_TRACE_BINARY:
+                test_trace_binary = true;
+                break;
             case OPT_TRACE_PERIOD: {
                 char *parsed = NULL;
                 test_trace_period = strtoumax(optarg, &parsed, 0);
@@ -2675,6 +2875,29 @@ step_unknown:
                 test_erase_sleep = erase_sleep*1.0e9;
                 break;
             }
+            case OPT_STATUS_FORMAT:
+                if (strcmp(optarg, "text") == 0) {
+                    test_status_format = TEST_STATUS_TEXT;
+                } else if (strcmp(optarg, "kv") == 0) {
+                    test_status_format = TEST_STATUS_KV;
+                } else {
+                    fprintf(stderr, "error: unknown status format: %s\n",
+                            optarg);
+                    exit(-1);
+                }
+                break;
+            case OPT_WORKER:
+                op = worker;
+                break;
+            case OPT_STATUS_FD: {
+                char *parsed = NULL;
+                test_status_fd = strtol(optarg, &parsed, 0);
+                if (parsed == optarg || test_status_fd < 0) {
+                    fprintf(stderr, "error: invalid status-fd: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            }
             // done parsing
             case -1:
                 goto getopt_done;
@@ -2783,6 +3006,22 @@ getopt_done: ;
         };
     }
 
+    // where do status lines go?
+    if (test_status_fd >= 0) {
+        test_status = fdopen(test_status_fd, "w");
+        if (!test_status) {
+            fprintf(stderr, "error: could not open status-fd %d: %s\n",
+                    test_status_fd, strerror(errno));
+            exit(-1);
+        }
+        setvbuf(test_status, NULL, _IOLBF, 0);
+        // stdout is now likely a pipe, line-buffer it so a crashing
+        // permutation doesn't lose its output
+        setvbuf(stdout, NULL, _IOLBF, 0);
+    } else {
+        test_status = stdout;
+    }
+
     // do the thing
     op();
 
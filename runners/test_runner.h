@@ -18,12 +18,17 @@ void test_trace(const char *fmt, ...);
         __VA_ARGS__)
 #define LFS_TRACE(...) LFS_TRACE_(__VA_ARGS__, "")
 #define LFS_EMUBD_TRACE(...) LFS_TRACE_(__VA_ARGS__, "")
+#define LFS_EMUBD_TRACEOP(op, block, off, size) \
+    test_trace_op(op, block, off, size)
 
 
 // note these are indirectly included in any generated files
 #include "bd/lfs_emubd.h"
 #include <stdio.h>
 
+// binary block device traces, see LFS_EMUBD_TRACEOP
+void test_trace_op(char op, uint32_t block, uint32_t off, uint32_t size);
+
 // give source a chance to define feature macros
 #undef _FEATURES_H
 #undef _STDIO_H
@@ -11,17 +11,21 @@
 
 import collections as co
 import csv
-import errno
 import glob
+import hashlib
+import io
 import itertools as it
 import math as m
+import multiprocessing as mp
 import os
-import pty
+import pickle
 import re
+import selectors
 import shlex
 import shutil
 import signal
 import subprocess as sp
+import tempfile
 import threading as th
 import time
 import toml
@@ -45,6 +49,44 @@ def openio(path, mode='r', buffering=-1):
     else:
         return open(path, mode, buffering)
 
+# permutations are kept as a list of products, one per set of defines,
+# this lets us count and index permutations without materializing
+# every combination
+class BenchPermutations:
+    def __init__(self):
+        self.products = []
+
+    def append(self, defines):
+        # defines is a list of (name, values) pairs
+        self.products.append(defines)
+
+    def __len__(self):
+        return sum(m.prod(len(vs) for _, vs in defines)
+            for defines in self.products)
+
+    def __iter__(self):
+        for defines in self.products:
+            for perm in it.product(*(
+                    [(k, v) for v in vs]
+                    for k, vs in defines)):
+                yield dict(perm)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        for defines in self.products:
+            n = m.prod(len(vs) for _, vs in defines)
+            if i < n:
+                # decode i as a mixed-radix number, the last define
+                # changes fastest, matching it.product
+                perm = []
+                for k, vs in reversed(defines):
+                    i, j = divmod(i, len(vs))
+                    perm.append((k, vs[j]))
+                return dict(reversed(perm))
+            i -= n
+        raise IndexError('permutation index out of range')
+
 class BenchCase:
     # create a BenchCase object from a config
     def __init__(self, config, args={}):
@@ -62,7 +104,7 @@ class BenchCase:
 
         # figure out defines and build possible permutations
         self.defines = set()
-        self.permutations = []
+        self.permutations = BenchPermutations()
 
         # defines can be a dict or a list or dicts
         suite_defines = config.pop('suite_defines', {})
@@ -128,9 +170,9 @@ class BenchCase:
             self.defines |= suite_defines_.keys()
             for defines_ in defines:
                 self.defines |= defines_.keys()
-                self.permutations.extend(dict(perm) for perm in it.product(*(
-                    [(k, v) for v in parse_define(vs)]
-                    for k, vs in sorted((suite_defines_ | defines_).items()))))
+                self.permutations.append([
+                    (k, list(parse_define(vs)))
+                    for k, vs in sorted((suite_defines_ | defines_).items())])
 
         for k in config.keys():
             print('%swarning:%s in %s, found unused key %r' % (
@@ -222,6 +264,111 @@ class BenchSuite:
 
 
 
+# parsed suites are cached keyed by a hash of the toml file and this
+# script, toml parsing dominates compile time otherwise
+def load_suite(path, args={}):
+    cache_path = None
+    if args.get('cache'):
+        name = os.path.basename(path)
+        if name.endswith('.toml'):
+            name = name[:-len('.toml')]
+        cache_path = os.path.join(args['cache'], '%s.b.suite' % name)
+
+        hash = hashlib.sha1()
+        for path_ in [__file__, path]:
+            hash.update(path_.encode())
+            with open(path_, 'rb') as f:
+                hash.update(f.read())
+        hash = hash.hexdigest()
+
+        try:
+            with open(cache_path, 'rb') as f:
+                hash_, suite = pickle.load(f)
+            if hash_ == hash:
+                return suite
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    suite = BenchSuite(path, args)
+
+    if cache_path:
+        # write to a temporary file first, other compiles may be loading
+        # the same suite in parallel
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb',
+                dir=os.path.dirname(cache_path) or '.',
+                prefix=os.path.basename(cache_path)+'.',
+                delete=False) as f:
+            pickle.dump((hash, suite), f)
+        os.replace(f.name, cache_path)
+
+    return suite
+
+def load_suites(paths, **args):
+    # parse suites in parallel?
+    jobs = args.get('jobs', 1)
+    if jobs == 0:
+        jobs = len(os.sched_getaffinity(0))
+    if jobs > 1 and len(paths) > 1:
+        with mp.Pool(min(jobs, len(paths))) as p:
+            return p.starmap(load_suite,
+                [(path, args) for path in paths])
+    else:
+        return [load_suite(path, args) for path in paths]
+
+
+# hash everything that can change the generated source, including this
+# script, so we can skip regenerating sources when nothing changed
+def compile_hash(paths, **args):
+    hash = hashlib.sha1()
+    hash.update(repr(sys.argv[1:]).encode())
+    for path in [__file__] + paths + (
+            [args['source']] if args.get('source') else []):
+        hash.update(path.encode())
+        with open(path, 'rb') as f:
+            hash.update(f.read())
+    return hash.hexdigest()
+
+def compile_cached(path, hash):
+    # the hash is stored in the header of the generated source
+    try:
+        with open(path) as f:
+            for line in it.islice(f, 8):
+                if line == '// input hash: %s\n' % hash:
+                    return True
+    except FileNotFoundError:
+        pass
+    return False
+
+def compile_write(path, source):
+    if path == '-':
+        with openio(path, 'w') as f:
+            f.write(source)
+        return
+
+    # if only the hash changed, we still update the hash but leave the
+    # mtime alone, this keeps make from rebuilding anything that depends
+    # on the generated source
+    def strip_hash(source):
+        return [line for line in source.splitlines()
+            if not line.startswith('// input hash: ')]
+
+    try:
+        with open(path) as f:
+            old = f.read()
+        st = os.stat(path)
+    except FileNotFoundError:
+        old = None
+
+    if old == source:
+        return
+
+    with openio(path, 'w') as f:
+        f.write(source)
+
+    if old is not None and strip_hash(old) == strip_hash(source):
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
 def compile(bench_paths, **args):
     # find .toml files
     paths = []
@@ -236,8 +383,15 @@ def compile(bench_paths, **args):
         print('no bench suites found in %r?' % bench_paths)
         sys.exit(-1)
 
+    # nothing changed since we last generated our output?
+    hash = None
+    if args.get('output', '-') != '-':
+        hash = compile_hash(paths, **args)
+        if compile_cached(args['output'], hash):
+            return
+
     # load the suites
-    suites = [BenchSuite(path, args) for path in paths]
+    suites = load_suites(paths, **args)
     suites.sort(key=lambda s: s.name)
 
     # check for name conflicts, these will cause ambiguity problems later
@@ -278,7 +432,7 @@ def compile(bench_paths, **args):
 
     # write generated bench source
     if 'output' in args:
-        with openio(args['output'], 'w') as f:
+        with io.StringIO() as f:
             _write = f.write
             def write(s):
                 f.lineno += s.count('\n')
@@ -295,6 +449,9 @@ def compile(bench_paths, **args):
             f.writeln("//")
             f.writeln("// %s" % ' '.join(sys.argv))
             f.writeln("//")
+            if hash is not None:
+                f.writeln("// input hash: %s" % hash)
+                f.writeln("//")
             f.writeln()
 
             # include bench_runner.h in every generated file
@@ -493,6 +650,9 @@ def compile(bench_paths, **args):
                                     f.writeln('#endif')
                                 f.writeln()
 
+            # only write if something changed
+            compile_write(args['output'], f.getvalue())
+
 def find_runner(runner, **args):
     cmd = runner.copy()
 
@@ -535,6 +695,8 @@ def find_runner(runner, **args):
         cmd.append('--trace-period=%s' % args['trace_period'])
     if args.get('trace_freq'):
         cmd.append('--trace-freq=%s' % args['trace_freq'])
+    if args.get('trace_binary'):
+        cmd.append('--trace-binary')
     if args.get('read_sleep'):
         cmd.append('--read-sleep=%s' % args['read_sleep'])
     if args.get('prog_sleep'):
@@ -677,9 +839,9 @@ def find_path(runner_, id, **args):
 
     return path
 
-def find_defines(runner_, id, **args):
+def find_defines(runner_, ids=[], **args):
     # query permutation defines from runner
-    cmd = runner_ + ['--list-permutation-defines', id]
+    cmd = runner_ + ['--list-permutation-defines'] + ids
     if args.get('verbose'):
         print(' '.join(shlex.quote(c) for c in cmd))
     proc = sp.Popen(cmd,
@@ -705,41 +867,129 @@ def find_defines(runner_, id, **args):
 
     return defines
 
+# parse a status record from the runner's status fd, returning op, id, and
+# any key=value fields, or None if the record isn't understood
+#
+# ops are shortened to their first letter on the status fd
+STATUS_OPS = {
+    'r': 'running',
+    'f': 'finished',
+    's': 'skipped',
+    'e': 'exited'}
+
+def parse_status(record):
+    op = STATUS_OPS.get(record[:1])
+    if op is None:
+        return None
+    fields_ = record[1:].split()
+    if not fields_:
+        return None
+    fields = {}
+    for field in fields_[1:]:
+        k, eq, v = field.partition('=')
+        if not eq:
+            return None
+        fields[k] = v
+    return op, fields_[0], fields
+
+# find the last assert in some runner output, we only need to look for these
+# after a failure
+ASSERT_PATTERN = re.compile(
+    '^(?P<path>[^:]+):(?P<lineno>\d+):assert: *(?P<message>.*)$')
+
+def find_assert(lines):
+    for line in reversed(lines):
+        if ':assert:' in line:
+            m = ASSERT_PATTERN.match(line.rstrip('\n'))
+            if m:
+                return (
+                    m.group('path'),
+                    int(m.group('lineno')),
+                    m.group('message'))
+    return None
+
+# spawn a runner with stdout/stderr merged into one pipe and status
+# reported on a separate pipe
+#
+# the status pipe needs to be inheritable, so we serialize spawns to keep
+# it from leaking into other runners
+spawn_lock = th.Lock()
+
+def spawn_runner(cmd, **kwargs):
+    out_r, out_w = os.pipe()
+    status_r, status_w = os.pipe()
+    with spawn_lock:
+        os.set_inheritable(status_w, True)
+        try:
+            proc = sp.Popen(cmd + ['--status-fd=%d' % status_w],
+                stdout=out_w,
+                stderr=out_w,
+                close_fds=False,
+                **kwargs)
+        finally:
+            os.close(out_w)
+            os.close(status_w)
+    # we read stdout whenever it's available, and drain it before some
+    # status records, so this must not block
+    os.set_blocking(out_r, False)
+    return proc, out_r, status_r
 
-# Thread-safe CSV writer
+
+# Thread-safe streaming CSV writer
+#
+# Rows are written out immediately and not kept in memory, so the expected
+# columns should be provided up front. If a row introduces a new column, we
+# append it to the on-disk columns and rewrite the file once on close.
 class BenchOutput:
     def __init__(self, path, head=None, tail=None):
-        self.f = openio(path, 'w+', 1)
+        self.path = path
+        self.f = openio(path, 'w', 1)
         self.lock = th.Lock()
         self.head = head or []
         self.tail = tail or []
-        self.writer = csv.DictWriter(self.f, self.head + self.tail)
-        self.rows = []
+        self.fields = self.head + self.tail
+        self.seen = set(self.fields)
+        self.dirty = False
+        self.writer = csv.DictWriter(self.f, self.fields)
+        self.writer.writeheader()
 
     def close(self):
         self.f.close()
 
+        # found new columns? rewrite the file with the correct header
+        if self.dirty and self.path != '-':
+            dir = os.path.dirname(self.path) or '.'
+            with open(self.path) as rf, \
+                    tempfile.NamedTemporaryFile('w',
+                        dir=dir, delete=False) as wf:
+                reader = csv.reader(rf)
+                # skip the old header
+                next(reader)
+                writer = csv.DictWriter(wf, self.head + self.tail)
+                writer.writeheader()
+                for row in reader:
+                    # rows written before a column was found are shorter
+                    writer.writerow(dict(zip(self.fields, row)))
+            shutil.copymode(self.path, wf.name)
+            os.replace(wf.name, self.path)
+
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        self.f.close()
+        self.close()
 
     def writerow(self, row):
         with self.lock:
-            self.rows.append(row)
-            if all(k in self.head or k in self.tail for k in row.keys()):
-                # can simply append
-                self.writer.writerow(row)
-            else:
-                # need to rewrite the file
-                self.head.extend(row.keys() - (self.head + self.tail))
-                self.f.seek(0)
-                self.f.truncate()
-                self.writer = csv.DictWriter(self.f, self.head + self.tail)
-                self.writer.writeheader()
-                for row in self.rows:
-                    self.writer.writerow(row)
+            new = [k for k in row.keys() if k not in self.seen]
+            if new:
+                # append new columns for now, we fix the header on close
+                self.head.extend(new)
+                self.fields.extend(new)
+                self.seen.update(new)
+                self.dirty = True
+                self.writer = csv.DictWriter(self.f, self.fields)
+            self.writer.writerow(row)
 
 # A bench failure
 class BenchFailure(Exception):
@@ -749,6 +999,22 @@ class BenchFailure(Exception):
         self.stdout = stdout
         self.assert_ = assert_
 
+# State for one job, this is either a runner working through a chunk of
+# permutations, or a persistent worker with --isolate/--valgrind
+class BenchJob:
+    def __init__(self):
+        self.proc = None
+        self.out_fd = None
+        self.status_fd = None
+        self.status = b''
+        self.chunk = None
+        self.seen_perms = 0
+        self.start_time = None
+        self.last_id = None
+        self.last_stdout = bytearray()
+        self.epoch = 0
+        self.last_line = bytearray()
+
 def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
     # get expected suite/case/perm counts
     (case_suites,
@@ -757,6 +1023,13 @@ def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
         expected_perms,
         total_perms) = find_perms(runner_, ids, **args)
 
+    # if we're writing to a csv, the runner reports defines inline with
+    # --status-format=kv, we just need to keep track of them for failures
+    #
+    # note power-loss cycles don't affect defines, so these are keyed by
+    # case:perm
+    perm_defines = {}
+
     passed_suite_perms = co.defaultdict(lambda: 0)
     passed_case_perms = co.defaultdict(lambda: 0)
     passed_perms = 0
@@ -766,178 +1039,325 @@ def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
     failures = []
     killed = False
 
-    pattern = re.compile('^(?:'
-            '(?P<op>running|finished|skipped|powerloss)'
-                ' (?P<id>(?P<case>[^:]+)[^\s]*)'
-                '(?: (?P<readed>\d+))?'
-                '(?: (?P<proged>\d+))?'
-                '(?: (?P<erased>\d+))?'
-            '|' '(?P<path>[^:]+):(?P<lineno>\d+):(?P<op_>assert):'
-                ' *(?P<message>.*)'
-        ')$')
-    locals = th.local()
-    children = set()
-
-    def run_runner(runner_, ids=[]):
-        nonlocal passed_suite_perms
-        nonlocal passed_case_perms
-        nonlocal passed_perms
-        nonlocal readed
-        nonlocal proged
-        nonlocal erased
-        nonlocal locals
-
-        # run the benches!
-        cmd = runner_ + ids
+    # permutations are handed out to jobs in chunks from a shared counter,
+    # so jobs that finish early steal work instead of sitting idle
+    jobs = args.get('jobs', 1)
+    isolate = args.get('isolate') or args.get('valgrind')
+    next_perm = 0
+    perm_time = 0.0
+    perm_count = 0
+
+    def next_chunk():
+        nonlocal next_perm
+
+        if next_perm >= total_perms:
+            return None
+
+        remaining = total_perms - next_perm
+        if isolate:
+            size = 1
+        elif jobs == 1:
+            size = remaining
+        else:
+            # guided scheduling, chunks shrink as we run out of work so
+            # the last jobs finish at roughly the same time
+            size = m.ceil(remaining / (2*jobs))
+            # but don't let chunks get so small runner startup
+            # dominates, aim for chunks that take at least ~100ms
+            if perm_time > 0:
+                size = max(size, m.ceil(0.1 / (perm_time/perm_count)))
+            size = min(size, remaining)
+
+        start = next_perm
+        next_perm += size
+        return start, start+size
+
+    # all runners are multiplexed in one event loop, so we don't need a
+    # thread per job
+    sel = selectors.DefaultSelector()
+    jobs_ = [BenchJob() for _ in range(jobs)]
+    dirty = False
+
+    def stdout_lines(stdout):
+        return stdout.decode(errors='replace').splitlines(keepends=True)[
+            -(args.get('context', 5) + 1):]
+
+    def start_proc(job, cmd, **kwargs):
         if args.get('verbose'):
             print(' '.join(shlex.quote(c) for c in cmd))
-
-        mpty, spty = pty.openpty()
-        proc = sp.Popen(cmd, stdout=spty, stderr=spty, close_fds=False)
-        os.close(spty)
-        children.add(proc)
-        mpty = os.fdopen(mpty, 'r', 1)
-
-        last_id = None
-        last_stdout = co.deque(maxlen=args.get('context', 5) + 1)
-        last_assert = None
-        try:
-            while True:
-                # parse a line for state changes
-                try:
-                    line = mpty.readline()
-                except OSError as e:
-                    if e.errno != errno.EIO:
-                        raise
-                    break
-                if not line:
-                    break
-                last_stdout.append(line)
-                if stdout_:
+        job.proc, job.out_fd, job.status_fd = spawn_runner(cmd, **kwargs)
+        job.status = b''
+        sel.register(job.out_fd, selectors.EVENT_READ, (job, 'stdout'))
+        sel.register(job.status_fd, selectors.EVENT_READ, (job, 'status'))
+
+    def stop_proc(job):
+        if job.proc is None:
+            return
+        if job.proc.stdin:
+            try:
+                job.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for fd in [job.out_fd, job.status_fd]:
+            if fd in sel.get_map():
+                sel.unregister(fd)
+            os.close(fd)
+        job.proc.wait()
+        returncode = job.proc.returncode
+        job.proc = None
+        return returncode
+
+    def kill_all():
+        for job in jobs_:
+            if job.proc:
+                if isolate:
+                    # workers fork for each request, so kill the whole
+                    # process group, otherwise the forked child keeps our
+                    # pipes open until it finishes
                     try:
-                        stdout_.write(line)
-                        stdout_.flush()
-                    except BrokenPipeError:
+                        os.killpg(job.proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
                         pass
-
-                m = pattern.match(line)
-                if m:
-                    op = m.group('op') or m.group('op_')
-                    if op == 'running':
-                        locals.seen_perms += 1
-                        last_id = m.group('id')
-                        last_stdout.clear()
-                        last_assert = None
-                    elif op == 'finished':
-                        case = m.group('case')
-                        suite = case_suites[case]
-                        readed_ = int(m.group('readed'))
-                        proged_ = int(m.group('proged'))
-                        erased_ = int(m.group('erased'))
-                        passed_suite_perms[suite] += 1
-                        passed_case_perms[case] += 1
-                        passed_perms += 1
-                        readed += readed_
-                        proged += proged_
-                        erased += erased_
-                        if output_:
-                            # get defines and write to csv
-                            defines = find_defines(
-                                runner_, m.group('id'), **args)
-                            output_.writerow({
-                                'suite': suite,
-                                'case': case,
-                                'bench_readed': readed_,
-                                'bench_proged': proged_,
-                                'bench_erased': erased_,
-                                **defines})
-                    elif op == 'skipped':
-                        locals.seen_perms += 1
-                    elif op == 'assert':
-                        last_assert = (
-                            m.group('path'),
-                            int(m.group('lineno')),
-                            m.group('message'))
-                        # go ahead and kill the process, aborting takes a while
-                        if args.get('keep_going'):
-                            proc.kill()
-        except KeyboardInterrupt:
-            raise BenchFailure(last_id, 1, list(last_stdout))
-        finally:
-            children.remove(proc)
-            mpty.close()
-
-        proc.wait()
-        if proc.returncode != 0:
-            raise BenchFailure(
-                last_id,
-                proc.returncode,
-                list(last_stdout),
-                last_assert)
-
-    def run_job(runner_, ids=[], start=None, step=None):
-        nonlocal failures
+                else:
+                    job.proc.kill()
+
+    def start_chunk(job):
+        # find more work for this job
+        if job.chunk is None and not killed:
+            job.chunk = next_chunk()
+        if job.chunk is None or killed:
+            job.chunk = None
+            stop_proc(job)
+            return
+        start, stop = job.chunk
+
+        # each chunk runs in a fresh process, or a fresh fork of our worker,
+        # so any output from here on belongs to this chunk
+        job.epoch += 1
+        job.seen_perms = 0
+        job.start_time = time.time()
+        job.last_id = None
+        job.last_stdout.clear()
+
+        if isolate:
+            # with --isolate/--valgrind every permutation needs its own
+            # process, instead of exec-ing a new runner for each one, we
+            # keep a worker per job that forks for each request
+            if job.proc is None:
+                cmd = runner_ + ['--worker'] + ids
+                if output_:
+                    cmd.append('--status-format=kv')
+                start_proc(job, cmd, stdin=sp.PIPE, text=True,
+                    start_new_session=True)
+            try:
+                job.proc.stdin.write('%d,%d\n' % (start, stop))
+                job.proc.stdin.flush()
+            except BrokenPipeError:
+                # worker was killed, we'll notice when its status closes
+                pass
+        else:
+            # run the benches!
+            cmd = runner_ + ['-s%s,%s' % (start, stop)]
+            if output_:
+                cmd.append('--status-format=kv')
+            start_proc(job, cmd + ids)
+
+    def finish_chunk(job, returncode):
+        nonlocal dirty
         nonlocal killed
-        nonlocal locals
-
-        start = start or 0
-        step = step or 1
-        while start < total_perms:
-            job_runner = runner_.copy()
-            if args.get('isolate') or args.get('valgrind'):
-                job_runner.append('-s%s,%s,%s' % (start, start+step, step))
-            else:
-                job_runner.append('-s%s,,%s' % (start, step))
+        nonlocal perm_time
+        nonlocal perm_count
+
+        dirty = True
+        start, stop = job.chunk
+        if returncode == 0:
+            assert job.seen_perms > 0
+            perm_time += time.time() - job.start_time
+            perm_count += job.seen_perms
+
+            start += job.seen_perms
+            job.chunk = (start, stop) if start < stop else None
+            return
+
+        # killed after another failure, or before any permutation started?
+        # there's nothing to report
+        if killed and (failures or job.last_id is None):
+            job.chunk = None
+            return
+
+        # only show output from the failing permutation, the runner marks
+        # where each permutation starts with a running line in stdout
+        stdout = job.last_stdout
+        i = stdout.rfind(b'\nrunning ')
+        if i >= 0 or stdout.startswith(b'running '):
+            j = stdout.find(b'\n', i+1)
+            stdout = stdout[j+1:] if j >= 0 else b''
+        stdout = stdout_lines(stdout)
+        failure = BenchFailure(
+            job.last_id,
+            returncode,
+            stdout,
+            find_assert(stdout))
+
+        # keep track of failures, but don't write rows for permutations
+        # we killed
+        if output_ and not killed:
+            case, _ = failure.id.split(':', 1)
+            suite = case_suites[case]
+            # get defines and write to csv, these are usually reported
+            # when the permutation starts running, but if we never saw
+            # that we need to ask the runner
+            id = ':'.join(failure.id.split(':', 2)[:2])
+            defines = perm_defines.get(id)
+            if defines is None:
+                defines = find_defines(runner_, [id], **args)
+            output_.writerow({
+                'suite': suite,
+                'case': case,
+                **defines})
+
+        # multiple failures?
+        if failures and not args.get('keep_going'):
+            job.chunk = None
+            return
+
+        failures.append(failure)
+
+        if args.get('keep_going') and not killed:
+            # resume after failed bench
+            assert job.seen_perms > 0
+            start += job.seen_perms
+            job.chunk = (start, stop) if start < stop else None
+        else:
+            # stop other benches
+            killed = True
+            job.chunk = None
+            kill_all()
+
+    def read_stdout(job):
+        # returns None if there's nothing to read, False on EOF
+        if job.out_fd not in sel.get_map():
+            return False
+        try:
+            data = os.read(job.out_fd, 65536)
+        except BlockingIOError:
+            return None
+        if not data:
+            sel.unregister(job.out_fd)
+            return False
+
+        job.last_stdout.extend(data)
+        if len(job.last_stdout) > 2*65536:
+            del job.last_stdout[:-65536]
+
+        # go ahead and kill the process, aborting takes a while,
+        # workers fork so we can't kill just this permutation
+        if (b':assert:' in data
+                and args.get('keep_going')
+                and not isolate):
+            job.proc.kill()
+
+        # only copy complete lines so parallel jobs don't interleave
+        # mid-line
+        if stdout_:
+            job.last_line.extend(data)
+            i = job.last_line.rfind(b'\n')
+            if i >= 0:
+                write_stdout(job.last_line[:i+1].decode(errors='replace'))
+                del job.last_line[:i+1]
+        return True
+
+    def write_stdout(s):
+        try:
+            stdout_.write(s)
+            stdout_.flush()
+        except BrokenPipeError:
+            pass
 
-            try:
-                # run the benches
-                locals.seen_perms = 0
-                run_runner(job_runner, ids)
-                assert locals.seen_perms > 0
-                start += locals.seen_perms*step
-
-            except BenchFailure as failure:
-                # keep track of failures
+    def read_status(job):
+        nonlocal passed_perms
+        nonlocal readed
+        nonlocal proged
+        nonlocal erased
+        nonlocal dirty
+
+        data = os.read(job.status_fd, 4096)
+        if not data:
+            # runner exited, pick up any output it left behind
+            while read_stdout(job):
+                pass
+            if stdout_ and job.last_line:
+                write_stdout(job.last_line.decode(errors='replace'))
+                job.last_line.clear()
+            returncode = stop_proc(job)
+            # if a worker exits early something went very wrong, make
+            # sure this is reported as a failure
+            if isolate and returncode == 0:
+                returncode = -1
+            finish_chunk(job, returncode)
+            start_chunk(job)
+            return
+
+        job.status += data
+        *records, job.status = job.status.split(b'\n')
+        for record in records:
+            status = parse_status(record.decode(errors='replace'))
+            if not status:
+                continue
+            op, id, fields = status
+            dirty = True
+
+            # stdout and status are separate pipes with no ordering
+            # between them, but the runner flushes stdout before each
+            # status record, so draining stdout here means any output
+            # before this record is already in our buffer
+            while read_stdout(job):
+                pass
+
+            # keep status lines in our stdout log, these are useful for
+            # figuring out which output is which, note running lines are
+            # already in stdout
+            if stdout_ and op not in {'running', 'exited'}:
+                write_stdout('%s %s\n' % (
+                    op,
+                    record[1:].decode(errors='replace')))
+
+            if op == 'running':
+                job.seen_perms += 1
+                job.last_id = id
+                if output_:
+                    perm_defines[':'.join(id.split(':', 2)[:2])] = fields
+            elif op == 'finished':
+                case = id.split(':', 1)[0]
+                suite = case_suites[case]
+                readed_ = int(fields.pop('readed'))
+                proged_ = int(fields.pop('proged'))
+                erased_ = int(fields.pop('erased'))
+                passed_suite_perms[suite] += 1
+                passed_case_perms[case] += 1
+                passed_perms += 1
+                readed += readed_
+                proged += proged_
+                erased += erased_
                 if output_:
-                    case, _ = failure.id.split(':', 1)
-                    suite = case_suites[case]
-                    # get defines and write to csv
-                    defines = find_defines(runner_, failure.id, **args)
+                    # defines are reported inline, write to csv
                     output_.writerow({
                         'suite': suite,
                         'case': case,
-                        **defines})
-
-                # race condition for multiple failures?
-                if failures and not args.get('keep_going'):
-                    break
-
-                failures.append(failure)
-
-                if args.get('keep_going') and not killed:
-                    # resume after failed bench
-                    assert locals.seen_perms > 0
-                    start += locals.seen_perms*step
-                    continue
-                else:
-                    # stop other benches
-                    killed = True
-                    for child in children.copy():
-                        child.kill()
-                    break
-
-
-    # parallel jobs?
-    runners = []
-    if 'jobs' in args:
-        for job in range(args['jobs']):
-            runners.append(th.Thread(
-                target=run_job, args=(runner_, ids, job, args['jobs']),
-                daemon=True))
-    else:
-        runners.append(th.Thread(
-            target=run_job, args=(runner_, ids, None, None),
-            daemon=True))
+                        'bench_readed': readed_,
+                        'bench_proged': proged_,
+                        'bench_erased': erased_,
+                        **fields})
+            elif op == 'skipped':
+                job.seen_perms += 1
+            elif op == 'exited':
+                if stdout_ and job.last_line:
+                    write_stdout(job.last_line.decode(errors='replace'))
+                    job.last_line.clear()
+                finish_chunk(job, int(id))
+                start_chunk(job)
+                # nothing should follow until our next request
+                break
 
     def print_update(done):
         if not args.get('verbose') and (args['color'] or done):
@@ -970,23 +1390,52 @@ def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
                 '\x1b[?7h' if not done else '\n'))
             sys.stdout.flush()
 
-    for r in runners:
-        r.start()
+    for job in jobs_:
+        start_chunk(job)
 
+    # only redraw when something changes, and at most every 10ms
+    last_update = 0
     try:
-        while any(r.is_alive() for r in runners):
-            time.sleep(0.01)
-            print_update(False)
-    except KeyboardInterrupt:
-        # this is handled by the runner threads, we just
-        # need to not abort here
-        killed = True
+        while sel.get_map():
+            timeout = None
+            if dirty:
+                timeout = max(0, last_update+0.01 - time.time())
+            try:
+                events = sel.select(timeout)
+            except KeyboardInterrupt:
+                # the runners see this too, except for workers which are in
+                # their own session, we just need to make sure they stop and
+                # not abort here
+                killed = True
+                kill_all()
+                continue
+
+            epochs = {key.fd: key.data[0].epoch for key, _ in events}
+            for key, _ in events:
+                # skip events for runners we've already cleaned up
+                if sel.get_map().get(key.fd) is not key:
+                    continue
+                job, kind = key.data
+                # skip stale events if this job has moved on to a new chunk
+                if job.epoch != epochs[key.fd]:
+                    continue
+                if kind == 'stdout':
+                    read_stdout(job)
+                else:
+                    read_status(job)
+
+            if dirty and time.time() >= last_update+0.01:
+                print_update(False)
+                dirty = False
+                last_update = time.time()
     finally:
+        # make sure nothing is left running if something went wrong
+        kill_all()
+        for job in jobs_:
+            stop_proc(job)
+        sel.close()
         print_update(True)
 
-    for r in runners:
-        r.join()
-
     return (
         expected_perms,
         passed_perms,
@@ -1026,8 +1475,11 @@ def run(runner, bench_ids=[], **args):
         trace = openio(args['trace'], 'w', 1)
     output = None
     if args.get('output'):
+        # find permutation defines up front so we know our columns before
+        # we start streaming results
+        defines = find_defines(runner_, bench_ids, **args)
         output = BenchOutput(args['output'],
-            ['suite', 'case'],
+            ['suite', 'case'] + list(defines.keys()),
             ['bench_readed', 'bench_proged', 'bench_erased'])
 
     # measure runtime
@@ -1105,7 +1557,7 @@ def run(runner, bench_ids=[], **args):
 
         # get some extra info from runner
         path, lineno = find_path(runner_, failure.id, **args)
-        defines = find_defines(runner_, failure.id, **args)
+        defines = find_defines(runner_, [failure.id], **args)
 
         # show summary of failure
         print('%s%s:%d:%sfailure:%s %s%s failed' % (
@@ -1292,6 +1744,11 @@ if __name__ == "__main__":
     bench_parser.add_argument(
         '--trace-freq',
         help="Sample trace output at this frequency in hz.")
+    bench_parser.add_argument(
+        '--trace-binary',
+        action='store_true',
+        help="Write block device operations to the trace in a compact "
+            "binary format.")
     bench_parser.add_argument(
         '-O', '--stdout',
         help="Direct stdout to this file. Note stderr is already merged here.")
@@ -1373,7 +1830,8 @@ if __name__ == "__main__":
     bench_parser.add_argument(
         '-p', '--perf',
         help="Run under Linux's perf to sample performance counters, writing "
-            "samples to this file.")
+            "samples to this file. A trailing slash writes samples to "
+            "separate files in this directory instead.")
     bench_parser.add_argument(
         '--perf-freq',
         help="perf sampling frequency. This is passed directly to the perf "
@@ -1419,6 +1877,9 @@ if __name__ == "__main__":
     comp_parser.add_argument(
         '-o', '--output',
         help="Output file.")
+    comp_parser.add_argument(
+        '--cache',
+        help="Directory to cache parsed bench suites in.")
 
     # runner/bench_paths overlap, so need to do some munging here
     args = parser.parse_intermixed_args()
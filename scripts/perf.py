@@ -16,22 +16,28 @@ import csv
 import errno
 import fcntl
 import functools as ft
+import hashlib
+import html
+import io
 import itertools as it
 import math as m
+import mmap
 import multiprocessing as mp
 import os
+import pickle
 import re
 import shlex
 import shutil
+import struct
 import subprocess as sp
 import tempfile
 import zipfile
-
-# TODO support non-zip perf results?
+import zlib
 
 
 PERF_PATH = ['perf']
-PERF_EVENTS = 'cycles,branch-misses,branches,cache-misses,cache-references'
+PERF_EVENTS = ('cycles,instructions,branch-misses,branches,'
+    'cache-misses,cache-references')
 PERF_FREQ = 100
 OBJDUMP_PATH = ['objdump']
 THRESHOLD = (0.5, 0.85)
@@ -112,40 +118,223 @@ class Int(co.namedtuple('Int', 'x')):
     def __sub__(self, other):
         return self.__class__(self.x - other.x)
 
-    def __mul__(self, other):
-        return self.__class__(self.x * other.x)
+# ratio fields, a/b
+#
+# these keep both the numerator and denominator around so they can be
+# summed when folding
+class Ratio(co.namedtuple('Ratio', 'a,b')):
+    __slots__ = ()
+    def __new__(cls, a=0, b=None):
+        if isinstance(a, Ratio) and b is None:
+            return a
+        if isinstance(a, str) and b is None:
+            a, b = a.split('/', 1)
+        if b is None:
+            b = a
+        return super().__new__(cls, Int(a), Int(b))
+
+    def __str__(self):
+        return '%s/%s' % (self.a, self.b)
+
+    def __float__(self):
+        return self.a.x/self.b.x if self.b.x else 0.0
+
+    none = '%7s' % '-'
+    def table(self):
+        return '%7.2f' % float(self)
+
+    diff_none = '%7s' % '-'
+    diff_table = table
+
+    def diff_diff(self, other):
+        new = float(self) if self else 0.0
+        old = float(other) if other else 0.0
+        return '%+7.2f' % (new - old)
+
+    def ratio(self, other):
+        new = float(self) if self else 0.0
+        old = float(other) if other else 0.0
+        if not old and not new:
+            return 0.0
+        elif not old:
+            return 1.0
+        else:
+            return (new-old) / old
+
+    def __add__(self, other):
+        return self.__class__(self.a + other.a, self.b + other.b)
+
+    def __lt__(self, other):
+        return (float(self), self.a.x) < (float(other), other.a.x)
+
+    def __gt__(self, other):
+        return self.__class__.__lt__(other, self)
+
+    def __le__(self, other):
+        return not self.__gt__(other)
+
+    def __ge__(self, other):
+        return not self.__lt__(other)
+
+# rate fields, a/b shown as a percentage
+class Rate(Ratio):
+    __slots__ = ()
+    def table(self):
+        return '%6.1f%%' % (100*float(self))
+
+    diff_table = table
+
+    def diff_diff(self, other):
+        new = float(self) if self else 0.0
+        old = float(other) if other else 0.0
+        return '%+6.1f%%' % (100*(new - old))
+
+    # rates are already relative, so just report the change
+    def ratio(self, other):
+        new = float(self) if self else 0.0
+        old = float(other) if other else 0.0
+        return new - old
 
 # perf results
 class PerfResult(co.namedtuple('PerfResult', [
         'file', 'function', 'line',
-        'cycles', 'bmisses', 'branches', 'cmisses', 'caches',
+        'cycles', 'instrs', 'bmisses', 'branches', 'cmisses', 'caches',
+        'l1misses', 'l1loads',
+        'ipc', 'bmrate', 'cmrate', 'l1rate',
         'children'])):
     _by = ['file', 'function', 'line']
-    _fields = ['cycles', 'bmisses', 'branches', 'cmisses', 'caches']
-    _sort = ['cycles', 'bmisses', 'cmisses', 'branches', 'caches']
+    # measured fields, the rest are derived from these
+    _counts = ['cycles', 'instrs', 'bmisses', 'branches', 'cmisses', 'caches',
+        'l1misses', 'l1loads']
+    _fields = _counts + ['ipc', 'bmrate', 'cmrate', 'l1rate']
+    _sort = ['cycles', 'instrs', 'bmisses', 'cmisses', 'l1misses',
+        'branches', 'caches', 'l1loads',
+        'ipc', 'bmrate', 'cmrate', 'l1rate']
     _types = {
-        'cycles': Int,
+        'cycles': Int, 'instrs': Int,
         'bmisses': Int, 'branches': Int,
-        'cmisses': Int, 'caches': Int}
+        'cmisses': Int, 'caches': Int,
+        'l1misses': Int, 'l1loads': Int,
+        'ipc': Ratio,
+        'bmrate': Rate, 'cmrate': Rate, 'l1rate': Rate}
 
     __slots__ = ()
     def __new__(cls, file='', function='', line=0,
-            cycles=0, bmisses=0, branches=0, cmisses=0, caches=0,
+            cycles=0, instrs=0, bmisses=0, branches=0, cmisses=0, caches=0,
+            l1misses=0, l1loads=0,
+            ipc=None, bmrate=None, cmrate=None, l1rate=None,
             children=[]):
+        cycles, instrs = Int(cycles), Int(instrs)
+        bmisses, branches = Int(bmisses), Int(branches)
+        cmisses, caches = Int(cmisses), Int(caches)
+        l1misses, l1loads = Int(l1misses), Int(l1loads)
         return super().__new__(cls, file, function, int(Int(line)),
-            Int(cycles), Int(bmisses), Int(branches), Int(cmisses), Int(caches),
+            cycles, instrs, bmisses, branches, cmisses, caches,
+            l1misses, l1loads,
+            # derive ratios, unless they were provided, say from a CSV file
+            Ratio(ipc) if ipc is not None
+                else Ratio(instrs, cycles),
+            Rate(bmrate) if bmrate is not None
+                else Rate(bmisses, branches),
+            Rate(cmrate) if cmrate is not None
+                else Rate(cmisses, caches),
+            Rate(l1rate) if l1rate is not None
+                else Rate(l1misses, l1loads),
             children)
 
     def __add__(self, other):
         return PerfResult(self.file, self.function, self.line,
             self.cycles + other.cycles,
+            self.instrs + other.instrs,
             self.bmisses + other.bmisses,
             self.branches + other.branches,
             self.cmisses + other.cmisses,
             self.caches + other.caches,
+            self.l1misses + other.l1misses,
+            self.l1loads + other.l1loads,
+            self.ipc + other.ipc,
+            self.bmrate + other.bmrate,
+            self.cmrate + other.cmrate,
+            self.l1rate + other.l1rate,
             self.children + other.children)
 
 
+# a compact call-trie, frames are interned as integer ids and samples with
+# the same call-stack are merged, so we only need to propagate measurements
+# once per unique call-stack
+class PerfTrie:
+    def __init__(self):
+        self.frames = []
+        self.ids = {}
+        self.stacks = {}
+
+    def intern(self, frame):
+        id = self.ids.get(frame)
+        if id is None:
+            id = len(self.frames)
+            self.frames.append(frame)
+            self.ids[frame] = id
+        return id
+
+    def add(self, stack, field, n):
+        counts = self.stacks.get(stack)
+        if counts is None:
+            counts = [0]*len(PerfResult._counts)
+            self.stacks[stack] = counts
+        counts[field] += n
+
+    def merge(self, other):
+        # remap other's frame ids into ours
+        ids = [self.intern(frame) for frame in other.frames]
+        for stack, counts_ in other.stacks.items():
+            stack = tuple(ids[id] for id in stack)
+            counts = self.stacks.get(stack)
+            if counts is None:
+                self.stacks[stack] = list(counts_)
+            else:
+                for i, n in enumerate(counts_):
+                    counts[i] += n
+
+    def folded(self, field):
+        # merge stacks by function, outermost frames first
+        i = PerfResult._counts.index(field)
+        folded = {}
+        for stack, counts in self.stacks.items():
+            if counts[i]:
+                names = tuple(self.frames[id][1] for id in reversed(stack))
+                folded[names] = folded.get(names, 0) + counts[i]
+        return folded
+
+    def to_results(self, *,
+            depth=1):
+        # tail-recursively propagate measurements
+        trie = {}
+        for stack, counts in self.stacks.items():
+            for i in range(len(stack)):
+                node = trie
+                for j in range(i, max(i-depth, -1), -1):
+                    # propagate
+                    id = stack[j]
+                    if id not in node:
+                        node[id] = ([0]*len(counts), {})
+                    counts_, children = node[id]
+                    for k, n in enumerate(counts):
+                        counts_[k] += n
+
+                    # recurse
+                    node = children
+
+        # rearrange results into result type
+        def to_results(node):
+            results = []
+            for id, (counts, children) in node.items():
+                results.append(PerfResult(*self.frames[id], *counts,
+                    children=to_results(children)))
+            return results
+
+        return to_results(trie)
+
+
 def openio(path, mode='r', buffering=-1):
     # allow '-' for stdin/stdout
     if path == '-':
@@ -156,7 +345,8 @@ def openio(path, mode='r', buffering=-1):
     else:
         return open(path, mode, buffering)
 
-# run perf as a subprocess, storing measurements into a zip file
+# run perf as a subprocess, storing measurements into a zip file, or a
+# directory if output ends with a slash
 def record(command, *,
         output=None,
         perf_freq=PERF_FREQ,
@@ -164,31 +354,28 @@ def record(command, *,
         perf_events=PERF_EVENTS,
         perf_path=PERF_PATH,
         **args):
+    # writing into a directory? each process gets its own perf file, so
+    # perf can write there directly and we don't need any locking
+    if output.endswith('/') or os.path.isdir(output):
+        os.makedirs(output, exist_ok=True)
+        fd, name = tempfile.mkstemp(dir=output, prefix='perf.')
+        os.close(fd)
+        return record_perf(command, name,
+            perf_freq=perf_freq,
+            perf_period=perf_period,
+            perf_events=perf_events,
+            perf_path=perf_path,
+            **args)
+
     # create a temporary file for perf to write to, as far as I can tell
     # this is strictly needed because perf's pipe-mode only works with stdout
     with tempfile.NamedTemporaryFile('rb') as f:
-        # figure out our perf invocation
-        perf = perf_path + list(filter(None, [
-            'record',
-            '-F%s' % perf_freq
-                if perf_freq is not None
-                and perf_period is None else None,
-            '-c%s' % perf_period
-                if perf_period is not None else None,
-            '-B',
-            '-g',
-            '--all-user',
-            '-e%s' % perf_events,
-            '-o%s' % f.name]))
-
-        # run our command
-        try:
-            if args.get('verbose'):
-                print(' '.join(shlex.quote(c) for c in perf + command))
-            err = sp.call(perf + command, close_fds=False)
-
-        except KeyboardInterrupt:
-            err = errno.EOWNERDEAD
+        err = record_perf(command, f.name,
+            perf_freq=perf_freq,
+            perf_period=perf_period,
+            perf_events=perf_events,
+            perf_path=perf_path,
+            **args)
 
         # synchronize access
         z = os.open(output, os.O_RDWR | os.O_CREAT)
@@ -202,38 +389,229 @@ def record(command, *,
                 with z.open('perf.%d' % os.getpid(), 'w') as g:
                     shutil.copyfileobj(f, g)
 
+                # and any markers
+                if os.path.exists(f.name + '.markers'):
+                    z.write(f.name + '.markers',
+                        'perf.%d.markers' % os.getpid())
+                    os.remove(f.name + '.markers')
+
     # forward the return code
     return err
 
+def record_perf(command, path, *,
+        perf_freq=PERF_FREQ,
+        perf_period=None,
+        perf_events=PERF_EVENTS,
+        perf_path=PERF_PATH,
+        **args):
+    # figure out our perf invocation
+    perf = perf_path + list(filter(None, [
+        'record',
+        '-F%s' % perf_freq
+            if perf_freq is not None
+            and perf_period is None else None,
+        '-c%s' % perf_period
+            if perf_period is not None else None,
+        '-B',
+        '-g',
+        '--all-user',
+        # timestamp samples with the same clock the bench-runner uses for
+        # its markers
+        '--clockid=monotonic',
+        '-e%s' % perf_events,
+        '-o%s' % path]))
+
+    # the bench-runner logs BENCH_START/BENCH_STOP timestamps here, if
+    # it's not a bench-runner this is just ignored
+    env = dict(os.environ, PERF_MARKERS=path + '.markers')
+
+    # run our command
+    try:
+        if args.get('verbose'):
+            print(' '.join(shlex.quote(c) for c in perf + command))
+        err = sp.call(perf + command, env=env, close_fds=False)
+
+    except KeyboardInterrupt:
+        err = errno.EOWNERDEAD
+
+    return err
 
-# try to only process each dso onceS
+
+# try to only process each dso once
+#
+# only processes that need the same dso wait on each other, everyone
+# else is free to process other dsos in parallel
 #
 # note this only caches with the non-keyword arguments
 def multiprocessing_cache(f):
     local_cache = {}
     manager = mp.Manager()
     global_cache = manager.dict()
-    lock = mp.Lock()
+    pending = manager.dict()
+    cond = mp.Condition()
 
     def multiprocessing_cache(*args, **kwargs):
         # check local cache?
         if args in local_cache:
             return local_cache[args]
-        # check global cache?
-        with lock:
+        # check global cache? if another process is already working on
+        # this we wait for it to finish
+        with cond:
+            cond.wait_for(lambda:
+                args in global_cache or args not in pending)
             if args in global_cache:
                 v = global_cache[args]
                 local_cache[args] = v
                 return v
-            # fall back to calling the function
+            pending[args] = True
+
+        # fall back to calling the function, note we don't hold the
+        # lock here
+        try:
             v = f(*args, **kwargs)
             global_cache[args] = v
-            local_cache[args] = v
-            return v
+        finally:
+            with cond:
+                del pending[args]
+                cond.notify_all()
+        local_cache[args] = v
+        return v
 
     return multiprocessing_cache
 
+# find the GNU build-id of an ELF file, if it has one
+def elf_build_id(path):
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != b'\x7fELF':
+                return None
+            e = '<' if ident[5] == 1 else '>'
+            if ident[4] == 2:
+                # 64-bit
+                f.seek(0x28)
+                shoff, = struct.unpack(e+'Q', f.read(8))
+                f.seek(0x3a)
+                shentsize, shnum = struct.unpack(e+'HH', f.read(4))
+                sh = e+'IIQQQQ'
+            else:
+                # 32-bit
+                f.seek(0x20)
+                shoff, = struct.unpack(e+'I', f.read(4))
+                f.seek(0x2e)
+                shentsize, shnum = struct.unpack(e+'HH', f.read(4))
+                sh = e+'IIIIII'
+
+            for i in range(shnum):
+                f.seek(shoff + i*shentsize)
+                _, type, _, _, off, size = struct.unpack(
+                    sh, f.read(struct.calcsize(sh)))
+                # only look in SHT_NOTE sections
+                if type != 7:
+                    continue
+
+                f.seek(off)
+                notes = f.read(size)
+                j = 0
+                while j+12 <= len(notes):
+                    namesz, descsz, ntype = struct.unpack(
+                        e+'III', notes[j:j+12])
+                    j += 12
+                    name = notes[j:j+namesz]
+                    j += (namesz+3) & ~3
+                    desc = notes[j:j+descsz]
+                    j += (descsz+3) & ~3
+                    # NT_GNU_BUILD_ID
+                    if name == b'GNU\0' and ntype == 3:
+                        return desc.hex()
+    except (OSError, struct.error):
+        pass
+    return None
+
+# find the PT_LOAD segments of an ELF file, we need these to map file
+# offsets to addresses
+def elf_loads(path):
+    loads = []
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != b'\x7fELF':
+                return loads
+            e = '<' if ident[5] == 1 else '>'
+            if ident[4] == 2:
+                # 64-bit
+                f.seek(0x20)
+                phoff, = struct.unpack(e+'Q', f.read(8))
+                f.seek(0x36)
+                phentsize, phnum = struct.unpack(e+'HH', f.read(4))
+                for i in range(phnum):
+                    f.seek(phoff + i*phentsize)
+                    type, _, off, vaddr, _, filesz = struct.unpack(
+                        e+'IIQQQQ', f.read(40))
+                    # PT_LOAD
+                    if type == 1:
+                        loads.append((off, vaddr, filesz))
+            else:
+                # 32-bit
+                f.seek(0x1c)
+                phoff, = struct.unpack(e+'I', f.read(4))
+                f.seek(0x2a)
+                phentsize, phnum = struct.unpack(e+'HH', f.read(4))
+                for i in range(phnum):
+                    f.seek(phoff + i*phentsize)
+                    type, off, vaddr, _, filesz = struct.unpack(
+                        e+'IIIII', f.read(20))
+                    # PT_LOAD
+                    if type == 1:
+                        loads.append((off, vaddr, filesz))
+    except (OSError, struct.error):
+        pass
+    return loads
+
+# cache a dso's symbols/lines on disk, keyed by the dso's path, mtime,
+# and build-id, this lets repeated runs skip objdump entirely
+def dso_cache(f):
+    def dso_cache(obj_path, *, cache=None, **args):
+        if not cache:
+            return f(obj_path, **args)
+
+        try:
+            st = os.stat(obj_path)
+        except OSError:
+            return f(obj_path, **args)
+        path = os.path.abspath(obj_path)
+        key = (path, st.st_mtime_ns, st.st_size, elf_build_id(obj_path),
+            # relative paths in debug-info depend on the cwd
+            os.getcwd())
+        cache_path = os.path.join(cache, '%s.%s.syms' % (
+            os.path.basename(path),
+            hashlib.sha1(path.encode()).hexdigest()[:16]))
+
+        try:
+            with open(cache_path, 'rb') as f_:
+                key_, v = pickle.load(f_)
+            if key_ == key:
+                return v
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        v = f(obj_path, **args)
+
+        # write to a temporary file first, other processes may be
+        # reading this
+        os.makedirs(cache, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb',
+                dir=cache,
+                prefix=os.path.basename(cache_path)+'.',
+                delete=False) as f_:
+            pickle.dump((key, v), f_)
+        os.replace(f_.name, cache_path)
+        return v
+
+    return dso_cache
+
 @multiprocessing_cache
+@dso_cache
 def collect_syms_and_lines(obj_path, *,
         objdump_path=None,
         **args):
@@ -384,12 +762,13 @@ def collect_syms_and_lines(obj_path, *,
     return syms, sym_at, lines, line_at
 
 
-def collect_decompressed(path, *,
+# parse samples from perf script's text output
+#
+# this yields (event, period, pid, time, frames) tuples, where time is in
+# nanoseconds and frames are (dso, sym, off, addr) tuples with runtime
+# addresses
+def collect_perf_script(path, events, *,
         perf_path=PERF_PATH,
-        sources=None,
-        everything=False,
-        propagate=0,
-        depth=1,
         **args):
     sample_pattern = re.compile(
         '(?P<comm>\w+)'
@@ -401,16 +780,11 @@ def collect_decompressed(path, *,
         '\s+(?P<addr>\w+)'
         '\s+(?P<sym>[^\s\+]+)(?:\+(?P<off>\w+))?'
         '\s+\((?P<dso>[^\)]+)\)')
-    events = {
-        'cycles':           'cycles',
-        'branch-misses':    'bmisses',
-        'branches':         'branches',
-        'cache-misses':     'cmisses',
-        'cache-references': 'caches'}
 
     # note perf_path may contain extra args
     cmd = perf_path + [
         'script',
+        '--ns',
         '-i%s' % path]
     if args.get('verbose'):
         print(' '.join(shlex.quote(c) for c in cmd))
@@ -424,35 +798,16 @@ def collect_decompressed(path, *,
     last_filtered = False
     last_event = ''
     last_period = 0
-    last_stack = []
-    deltas = co.defaultdict(lambda: {})
-    syms_ = co.defaultdict(lambda: {})
-    at_cache = {}
-    results = {}
-
-    def commit():
-        # tail-recursively propagate measurements
-        for i in range(len(last_stack)):
-            results_ = results
-            for j in reversed(range(i+1)):
-                if i+1-j > depth:
-                    break
-
-                # propagate
-                name = last_stack[j]
-                if name not in results_:
-                    results_[name] = (co.defaultdict(lambda: 0), {})
-                results_[name][0][last_event] += last_period
-
-                # recurse
-                results_ = results_[name][1]
-
+    last_pid = 0
+    last_time = None
+    last_frames = []
     for line in proc.stdout:
         # we need to process a lot of data, so wait to use regex as late
         # as possible
         if not line.startswith('\t'):
             if last_filtered:
-                commit()
+                yield (last_event, last_period, last_pid, last_time,
+                    last_frames)
             last_filtered = False
 
             if line:
@@ -461,136 +816,471 @@ def collect_decompressed(path, *,
                     last_filtered = True
                     last_event = m.group('event')
                     last_period = int(m.group('period'), 0)
-                    last_stack = []
+                    last_pid = int(m.group('pid'), 0)
+                    # parse time as fixed-point to avoid float rounding
+                    secs, _, frac = m.group('time').partition('.')
+                    last_time = (int(secs)*1000*1000*1000
+                        + int(frac[:9].ljust(9, '0')))
+                    last_frames = []
 
         elif last_filtered:
             m = frame_pattern.match(line)
             if m:
-                # filter out internal/kernel functions
-                if not everything and (
-                        m.group('sym').startswith('__')
-                        or m.group('sym').startswith('0')
-                        or m.group('sym').startswith('-')
-                        or m.group('sym').startswith('[')
-                        or m.group('dso').startswith('/usr/lib')):
-                    continue
+                last_frames.append((
+                    m.group('dso'),
+                    m.group('sym'),
+                    int(m.group('off'), 0) if m.group('off') else 0,
+                    int(m.group('addr'), 16)))
+    if last_filtered:
+        yield (last_event, last_period, last_pid, last_time,
+            last_frames)
+
+    proc.wait()
+    if proc.returncode != 0:
+        if not args.get('verbose'):
+            for line in proc.stderr:
+                sys.stdout.write(line)
+        sys.exit(-1)
+
+# decode samples directly from a perf.data file, this avoids the cost of
+# perf script formatting every sample as text only for us to parse it
+# again
+#
+# this yields the same (event, period, pid, time, frames) tuples as
+# collect_perf_script, but addresses are already resolved to addresses in
+# each dso, so no ASLR guessing is needed
+#
+# start/stop limit samples to records that start in that byte range, this
+# lets multiple processes split up a single perf.data file, though note
+# each process still needs to replay any mmap/fork records before start
+#
+# returns None if we don't understand the file, in which case we should
+# fall back to perf script
+def collect_perf_data(path, events, *,
+        start=None,
+        stop=None,
+        everything=False,
+        **args):
+    # perf_event_attr type+config => event name
+    event_names = {
+        (0, 0): 'cycles',
+        (0, 1): 'instructions',
+        (0, 2): 'cache-references',
+        (0, 3): 'cache-misses',
+        (0, 4): 'branches',
+        (0, 5): 'branch-misses',
+        (3, 0x00000): 'L1-dcache-loads',
+        (3, 0x10000): 'L1-dcache-load-misses'}
+
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+
+    # we only understand little-endian, non-pipe-mode files
+    if len(data) < 104 or data[:8] != b'PERFILE2':
+        return None
+    (attr_size, attrs_off, attrs_size,
+        data_off, data_size) = struct.unpack_from('<QQQQQ', data, 16)
+
+    # find our events, we need the ids to map samples to events
+    ids = {}
+    sample_types = set()
+    names = []
+    for off in range(attrs_off, attrs_off+attrs_size, attr_size+16):
+        type, _, config, _, sample_type = struct.unpack_from(
+            '<IIQQQ', data, off)
+        name = event_names.get((type, config))
+        names.append(name)
+        sample_types.add(sample_type)
+        ids_off, ids_size = struct.unpack_from('<QQ', data, off+attr_size)
+        for id_off in range(ids_off, ids_off+ids_size, 8):
+            id, = struct.unpack_from('<Q', data, id_off)
+            ids[id] = name
+
+    # we need a consistent sample layout with callchains and periods, and
+    # can't handle PERF_SAMPLE_READ
+    if len(sample_types) != 1:
+        return None
+    sample_type, = sample_types
+    if (not sample_type & 0x20
+            or not sample_type & 0x100
+            or sample_type & 0x10):
+        return None
+
+    # find field offsets in PERF_RECORD_SAMPLE
+    off = 8
+    id_off = None
+    pid_off = None
+    time_off = None
+    # PERF_SAMPLE_IDENTIFIER
+    if sample_type & 0x10000:
+        id_off = off
+        off += 8
+    for bit in [0x1, 0x2, 0x4, 0x8, 0x40, 0x200, 0x80, 0x100]:
+        if sample_type & bit:
+            # PERF_SAMPLE_TID
+            if bit == 0x2:
+                pid_off = off
+            # PERF_SAMPLE_TIME
+            elif bit == 0x4:
+                time_off = off
+            # PERF_SAMPLE_ID
+            elif bit == 0x40 and id_off is None:
+                id_off = off
+            # PERF_SAMPLE_PERIOD
+            elif bit == 0x100:
+                period_off = off
+            off += 8
+    callchain_off = off
+    if pid_off is None or (id_off is None and len(names) > 1):
+        return None
+
+    # this is the part that actually does the work
+    def samples():
+        # per-process maps, sorted by address
+        maps = co.defaultdict(list)
+        loads = {}
+        sym_ats = {}
+        frame_cache = {}
+
+        def resolve(pid, ip):
+            maps_ = maps.get(pid, [])
+            i = bisect.bisect(maps_, ip, key=lambda x: x[0])
+            if i == 0 or ip >= maps_[i-1][1]:
+                return None
+            start, _, pgoff, dso = maps_[i-1]
+
+            # filter out internal/kernel/libc dsos early, this avoids
+            # needing symbols for them
+            if not everything and (
+                    dso.startswith('[')
+                    or dso.startswith('/usr/lib')):
+                return None
+
+            # cached?
+            off = ip - start + pgoff
+            if (dso, off) in frame_cache:
+                return frame_cache[(dso, off)]
+
+            # map to an address in the dso
+            if dso not in loads:
+                loads[dso] = elf_loads(dso)
+            for load_off, load_vaddr, load_size in loads[dso]:
+                if off >= load_off and off < load_off+load_size:
+                    addr = off - load_off + load_vaddr
+                    break
+            else:
+                addr = off
+
+            # and find the symbol
+            if dso not in sym_ats:
+                _, sym_ats[dso], _, _ = collect_syms_and_lines(dso, **args)
+            sym_at = sym_ats[dso]
+            i = bisect.bisect(sym_at, addr, key=lambda x: x[0])
+            if i > 0 and addr < sym_at[i-1][0] + sym_at[i-1][2]:
+                sym_addr, sym, _ = sym_at[i-1]
+                frame = dso, sym, addr - sym_addr, addr
+            else:
+                frame = dso, '[unknown]', 0, addr
+            frame_cache[(dso, off)] = frame
+            return frame
+
+        off = data_off
+        data_end = min(data_off+data_size, len(data))
+        end = min(stop, data_end) if stop is not None else data_end
+        while off < end and off+8 <= data_end:
+            type, misc, size = struct.unpack_from('<IHH', data, off)
+            if size < 8 or off+size > data_end:
+                break
+
+            # PERF_RECORD_SAMPLE, skipping samples before our range
+            if type == 9 and start is not None and off < start:
+                pass
+
+            elif type == 9:
+                if id_off is not None:
+                    id, = struct.unpack_from('<Q', data, off+id_off)
+                    event = ids.get(id)
+                else:
+                    event = names[0]
+                if event in events:
+                    pid, = struct.unpack_from('<I', data, off+pid_off)
+                    period, = struct.unpack_from('<Q', data, off+period_off)
+                    if time_off is not None:
+                        time, = struct.unpack_from('<Q', data, off+time_off)
+                    else:
+                        time = None
+                    nr, = struct.unpack_from('<Q', data, off+callchain_off)
+                    frames = []
+                    for ip in struct.unpack_from('<%dQ' % nr, data,
+                            off+callchain_off+8):
+                        # skip PERF_CONTEXT_* markers
+                        if ip >= 0xfffffffffffff001:
+                            continue
+                        frame = resolve(pid, ip)
+                        if frame:
+                            frames.append(frame)
+                    yield event, period, pid, time, frames
+
+            # PERF_RECORD_MMAP/PERF_RECORD_MMAP2
+            elif type == 1 or type == 10:
+                pid, _, addr, len_, pgoff = struct.unpack_from(
+                    '<IIQQQ', data, off+8)
+                name_off = off+40 if type == 1 else off+72
+                dso = bytes(data[name_off:data.find(b'\0', name_off, off+size)]
+                    ).decode('utf8', errors='replace')
+                # new maps replace any maps they overlap
+                maps[pid] = [map for map in maps[pid]
+                    if map[1] <= addr or map[0] >= addr+len_]
+                bisect.insort(maps[pid], (addr, addr+len_, pgoff, dso),
+                    key=lambda x: x[0])
+
+            # PERF_RECORD_COMM, with PERF_RECORD_MISC_COMM_EXEC
+            elif type == 3 and misc & 0x2000:
+                pid, tid = struct.unpack_from('<II', data, off+8)
+                if pid == tid:
+                    maps[pid] = []
+
+            # PERF_RECORD_FORK, new processes inherit their parent's maps
+            elif type == 7:
+                pid, ppid = struct.unpack_from('<II', data, off+8)
+                if pid != ppid:
+                    maps[pid] = list(maps.get(ppid, []))
+
+            off += size
+
+    return samples()
+
+# parse BENCH_START/BENCH_STOP markers logged by the bench-runner
+#
+# this returns a dict of pid => sorted list of (start, stop) windows
+def collect_markers(f):
+    windows = co.defaultdict(list)
+    starts = {}
+    for line in f:
+        try:
+            pid, op, time = line.split()
+            pid, time = int(pid), int(time)
+        except ValueError:
+            continue
+
+        if op == 'start':
+            starts[pid] = time
+        elif op == 'stop' and pid in starts:
+            windows[pid].append((starts.pop(pid), time))
+
+    # a start without a stop is still running
+    for pid, start in starts.items():
+        windows[pid].append((start, m.inf))
 
-                dso = m.group('dso')
-                sym = m.group('sym')
-                off = int(m.group('off'), 0) if m.group('off') else 0
-                addr_ = int(m.group('addr'), 16)
-
-                # get the syms/lines for the dso, this is cached
-                syms, sym_at, lines, line_at = collect_syms_and_lines(
-                    dso,
-                    **args)
-
-                # ASLR is tricky, we have symbols+offsets, but static symbols
-                # means we may have multiple options for each symbol.
-                #
-                # To try to solve this, we use previous seen symbols to build
-                # confidence for the correct ASLR delta. This means we may
-                # guess incorrectly for early symbols, but this will only affect
-                # a few samples.
-                if sym in syms:
-                    sym_addr_ = addr_ - off
-
-                    # track possible deltas?
-                    for sym_addr, size in syms[sym]:
-                        delta = sym_addr - sym_addr_
-                        if delta not in deltas[dso]:
-                            deltas[dso][delta] = sum(
-                                abs(a_+delta - a)
-                                for s, (a_, _) in syms_[dso].items()
-                                for a, _ in syms[s])
-                    for delta in deltas[dso].keys():
-                        deltas[dso][delta] += abs(sym_addr_+delta - sym_addr)
-                    syms_[dso][sym] = sym_addr_, size
-
-                    # guess the best delta
-                    delta, _ = min(deltas[dso].items(),
-                        key=lambda x: (x[1], x[0]))
-                    addr = addr_ + delta
-
-                    # cached?
-                    if (dso,addr) in at_cache:
-                        cached = at_cache[(dso,addr)]
-                        if cached is None:
-                            # cache says to skip
+    for windows_ in windows.values():
+        windows_.sort()
+    return windows
+
+def collect_decompressed(path, *,
+        start=None,
+        stop=None,
+        markers=None,
+        phase=None,
+        perf_script=False,
+        sources=None,
+        everything=False,
+        propagate=0,
+        **args):
+    events = {
+        'cycles':                   'cycles',
+        'instructions':             'instrs',
+        'branch-misses':            'bmisses',
+        'branches':                 'branches',
+        'cache-misses':             'cmisses',
+        'cache-references':         'caches',
+        'L1-dcache-load-misses':    'l1misses',
+        'L1-dcache-loads':          'l1loads'}
+
+    # try to decode perf.data ourselves, falling back to perf script
+    samples = None
+    aslr = False
+    if not perf_script:
+        samples = collect_perf_data(path, events,
+            start=start,
+            stop=stop,
+            everything=everything,
+            **args)
+    if samples is None:
+        # perf script can't be split up, so only the first range does
+        # anything here
+        if start:
+            return PerfTrie()
+        samples = collect_perf_script(path, events, **args)
+        aslr = True
+
+    deltas = {}
+    votes = co.defaultdict(lambda: co.defaultdict(lambda: 0))
+    best = {}
+    voted = set()
+    at_cache = {}
+    trie = PerfTrie()
+    fields = {k: PerfResult._counts.index(v) for k, v in events.items()}
+
+    for event, period, pid, time, frames in samples:
+        # only keep samples inside or outside of our measured windows?
+        if phase is not None:
+            inside = False
+            if markers is not None and time is not None:
+                windows = markers.get(pid, [])
+                i = bisect.bisect(windows, time, key=lambda x: x[0])
+                inside = i > 0 and time < windows[i-1][1]
+            if inside != (phase == 'bench'):
+                continue
+
+        stack = []
+        for dso, sym, off, addr_ in frames:
+            # filter out internal/kernel functions
+            if not everything and (
+                    sym.startswith('__')
+                    or sym.startswith('0')
+                    or sym.startswith('-')
+                    or sym.startswith('[')
+                    or dso.startswith('/usr/lib')):
+                continue
+
+            # get the syms/lines for the dso, this is cached
+            syms, sym_at, lines, line_at = collect_syms_and_lines(
+                dso,
+                **args)
+
+            # ASLR is tricky, we have symbols+offsets, but static symbols
+            # means we may have multiple options for each symbol.
+            #
+            # Fortunately most symbols are unique, and any unique symbol
+            # gives us the exact ASLR delta for its dso. Until we find
+            # one, each distinct symbol+address votes for the deltas it
+            # could imply, and we go with the most popular delta. This
+            # means we may guess incorrectly for early symbols, but this
+            # will only affect a few samples.
+            if sym in syms:
+                sym_addr_ = addr_ - off
+
+                if not aslr:
+                    delta = 0
+                elif dso in deltas:
+                    delta = deltas[dso]
+                elif len(syms[sym]) == 1:
+                    (sym_addr, _), = syms[sym]
+                    delta = sym_addr - sym_addr_
+                    deltas[dso] = delta
+                else:
+                    # only vote once per symbol+address
+                    if (dso, sym, sym_addr_) not in voted:
+                        voted.add((dso, sym, sym_addr_))
+                        for sym_addr, _ in syms[sym]:
+                            delta = sym_addr - sym_addr_
+                            votes[dso][delta] += 1
+                            # ties go to the smallest delta
+                            best_votes, best_delta = best.get(dso,
+                                (0, m.inf))
+                            if (votes[dso][delta] > best_votes
+                                    or (votes[dso][delta] == best_votes
+                                        and delta < best_delta)):
+                                best[dso] = votes[dso][delta], delta
+                    _, delta = best[dso]
+                addr = addr_ + delta
+
+                # cached?
+                if (dso,addr) in at_cache:
+                    cached = at_cache[(dso,addr)]
+                    if cached is None:
+                        # cache says to skip
+                        continue
+                    file, line = cached
+                else:
+                    # find file+line
+                    i = bisect.bisect(line_at, addr, key=lambda x: x[0])
+                    if i > 0:
+                        _, file, line = line_at[i-1]
+                    else:
+                        file, line = re.sub('(\.o)?$', '.c', dso, 1), 0
+
+                    # ignore filtered sources
+                    if sources is not None:
+                        if not any(
+                                os.path.abspath(file) == os.path.abspath(s)
+                                for s in sources):
+                            at_cache[(dso,addr)] = None
                             continue
-                        file, line = cached
                     else:
-                        # find file+line
-                        i = bisect.bisect(line_at, addr, key=lambda x: x[0])
-                        if i > 0:
-                            _, file, line = line_at[i-1]
-                        else:
-                            file, line = re.sub('(\.o)?$', '.c', dso, 1), 0
-
-                        # ignore filtered sources
-                        if sources is not None:
-                            if not any(
-                                    os.path.abspath(file) == os.path.abspath(s)
-                                    for s in sources):
-                                at_cache[(dso,addr)] = None
-                                continue
-                        else:
-                            # default to only cwd
-                            if not everything and not os.path.commonpath([
-                                    os.getcwd(),
-                                    os.path.abspath(file)]) == os.getcwd():
-                                at_cache[(dso,addr)] = None
-                                continue
-
-                        # simplify path
-                        if os.path.commonpath([
+                        # default to only cwd
+                        if not everything and not os.path.commonpath([
                                 os.getcwd(),
                                 os.path.abspath(file)]) == os.getcwd():
-                            file = os.path.relpath(file)
-                        else:
-                            file = os.path.abspath(file)
+                            at_cache[(dso,addr)] = None
+                            continue
 
-                        at_cache[(dso,addr)] = file, line
-                else:
-                    file, line = re.sub('(\.o)?$', '.c', dso, 1), 0
+                    # simplify path
+                    if os.path.commonpath([
+                            os.getcwd(),
+                            os.path.abspath(file)]) == os.getcwd():
+                        file = os.path.relpath(file)
+                    else:
+                        file = os.path.abspath(file)
 
-                last_stack.append((file, sym, line))
+                    at_cache[(dso,addr)] = file, line
+            else:
+                file, line = re.sub('(\.o)?$', '.c', dso, 1), 0
 
-                # stop propogating?
-                if propagate and len(last_stack) >= propagate:
-                    commit()
-                    last_filtered = False
-    if last_filtered:
-        commit()
+            stack.append(trie.intern((file, sym, line)))
 
-    proc.wait()
-    if proc.returncode != 0:
-        if not args.get('verbose'):
-            for line in proc.stderr:
-                sys.stdout.write(line)
-        sys.exit(-1)
+            # stop propogating?
+            if propagate and len(stack) >= propagate:
+                break
 
-    # rearrange results into result type
-    def to_results(results):
-        results_ = []
-        for name, (r, children) in results.items():
-            results_.append(PerfResult(*name,
-                **{events[k]: v for k, v in r.items()},
-                children=to_results(children)))
-        return results_
+        if stack:
+            trie.add(tuple(stack), fields[event], period)
 
-    return to_results(results)
+    return trie
+
+def collect_job(path, i, start=None, stop=None, **args):
+    # perf files in a directory can be read in place
+    if i is None:
+        markers = None
+        if os.path.exists(path + '.markers'):
+            with open(path + '.markers') as f:
+                markers = collect_markers(f)
+        return collect_decompressed(path,
+            start=start,
+            stop=stop,
+            markers=markers,
+            **args)
 
-def collect_job(path, i, **args):
     # decompress into a temporary file, this is to work around
     # some limitations of perf
     with zipfile.ZipFile(path) as z:
+        markers = None
+        if i.filename + '.markers' in z.namelist():
+            with io.TextIOWrapper(z.open(i.filename + '.markers')) as f:
+                markers = collect_markers(f)
+
         with z.open(i) as f:
             with tempfile.NamedTemporaryFile('wb') as g:
                 shutil.copyfileobj(f, g)
                 g.flush()
 
-                return collect_decompressed(g.name, **args)
+                return collect_decompressed(g.name, markers=markers, **args)
+
+def collect_has_markers(path, i):
+    if i is None:
+        if not os.path.exists(path + '.markers'):
+            return False
+        with open(path + '.markers') as f:
+            return bool(collect_markers(f))
+
+    with zipfile.ZipFile(path) as z:
+        if i.filename + '.markers' not in z.namelist():
+            return False
+        with io.TextIOWrapper(z.open(i.filename + '.markers')) as f:
+            return bool(collect_markers(f))
 
 def starapply(args):
     f, args, kwargs = args
@@ -605,26 +1295,68 @@ def collect(perf_paths, *,
 
     records = []
     for path in perf_paths:
-        # each .perf file is actually a zip file containing perf files from
-        # multiple runs
-        with zipfile.ZipFile(path) as z:
-            records.extend((path, i) for i in z.infolist())
+        # each .perf file is actually a zip file or directory containing
+        # perf files from multiple runs
+        if os.path.isdir(path):
+            records.extend((os.path.join(path, name), None)
+                for name in sorted(os.listdir(path))
+                if name.startswith('perf.')
+                    and not name.endswith('.markers'))
+        else:
+            with zipfile.ZipFile(path) as z:
+                records.extend((path, i) for i in z.infolist()
+                    if not i.filename.endswith('.markers'))
+
+    # --phase needs markers, without any every sample would be filtered out
+    if args.get('phase') and not any(
+            collect_has_markers(path, i) for path, i in records):
+        print('error: no BENCH_START/BENCH_STOP markers found for --phase, '
+            'were these recorded with the bench-runner?')
+        sys.exit(-1)
 
     # we're dealing with a lot of data but also surprisingly
     # parallelizable
+    trie = PerfTrie()
     if jobs is not None:
-        results = []
-        with mp.Pool(jobs) as p:
-            for results_ in p.imap_unordered(
-                    starapply,
-                    ((collect_job, (path, i), args) for path, i in records)):
-                results.extend(results_)
+        with tempfile.TemporaryDirectory() as tmp:
+            # try to split up files so that even a single large recording
+            # can be processed in parallel
+            #
+            # this looks naive, since we're splitting up perf files by
+            # bytes, but we find proper record boundaries in
+            # collect_perf_data
+            sizes = [os.path.getsize(path) if i is None else i.file_size
+                for path, i in records]
+            perjob = max(m.ceil(sum(sizes) / jobs), 1)
+            ranges = []
+            for k, ((path, i), size) in enumerate(zip(records, sizes)):
+                if size <= perjob:
+                    ranges.append((path, i, None, None))
+                    continue
+
+                # zip members need to be decompressed before we can split
+                # them, along with any markers
+                if i is not None:
+                    tmp_ = os.path.join(tmp, str(k))
+                    with zipfile.ZipFile(path) as z:
+                        if i.filename + '.markers' in z.namelist():
+                            z.extract(i.filename + '.markers', tmp_)
+                        path = z.extract(i, tmp_)
+
+                ranges.extend((path, None, j, j+perjob)
+                    for j in range(0, size, perjob))
+
+            with mp.Pool(jobs) as p:
+                for trie_ in p.imap_unordered(
+                        starapply,
+                        ((collect_job, (path, i, start, stop), args)
+                            for path, i, start, stop in ranges)):
+                    trie.merge(trie_)
     else:
-        results = []
         for path, i in records:
-            results.extend(collect_job(path, i, **args))
+            trie.merge(collect_job(path, i, **args))
 
-    return results
+    return trie
 
 
 def fold(Result, results, *,
@@ -671,6 +1403,83 @@ def fold(Result, results, *,
 
     return folded
 
+# write Brendan Gregg style folded stacks, one stack per line
+def write_folded(path, folded):
+    with openio(path, 'w') as f:
+        for names, n in sorted(folded.items()):
+            f.write('%s %d\n' % (';'.join(names), n))
+
+# write a self-contained SVG flamegraph
+def write_flamegraph(path, folded, *,
+        title='',
+        width=1200):
+    frame_height = 16
+    font_size = 12
+    font_width = 0.59*font_size
+    pad = 10
+
+    # build a tree of frames
+    tree = {}
+    for names, n in folded.items():
+        node = tree
+        for name in names:
+            if name not in node:
+                node[name] = [0, {}]
+            node[name][0] += n
+            node = node[name][1]
+
+    def depth_of(node):
+        return max((1+depth_of(children) for _, children in node.values()),
+            default=0)
+    depth = depth_of(tree)
+    total = sum(n for n, _ in tree.values())
+    height = (depth+1)*frame_height + 2*pad + 2*font_size
+    scale = (width-2*pad) / total if total else 0
+
+    with openio(path, 'w') as f:
+        f.write('<?xml version="1.0" standalone="no"?>\n')
+        f.write('<svg version="1.1" width="%d" height="%d" '
+            'xmlns="http://www.w3.org/2000/svg" '
+            'font-family="Verdana" font-size="%d">\n' % (
+                width, height, font_size))
+        f.write('<rect x="0" y="0" width="100%" height="100%" '
+            'fill="#f8f8f8"/>\n')
+        f.write('<text x="%d" y="%d" text-anchor="middle" '
+            'font-size="%d">%s</text>\n' % (
+                width//2, pad+font_size, font_size+4, html.escape(title)))
+
+        # draw frames bottom-up, callees sit on top of their callers
+        def draw(node, x, d):
+            for name, (n, children) in sorted(node.items()):
+                w = n*scale
+                # skip frames too small to see
+                if w >= 0.1:
+                    y = height - pad - (d+1)*frame_height
+                    # warm colors, but stable for each function
+                    h = zlib.crc32(name.encode())
+                    f.write('<g><title>%s (%d, %.2f%%)</title>'
+                        '<rect x="%.1f" y="%d" width="%.1f" height="%d" '
+                        'rx="2" fill="rgb(%d,%d,%d)"/>' % (
+                            html.escape(name), n, 100*n/total,
+                            pad + x*scale, y, w, frame_height-1,
+                            205 + h%50, (h>>8)%230, (h>>16)%55))
+                    # only label frames that fit at least a few characters
+                    chars = int((w-6) / font_width)
+                    if chars >= 3:
+                        label = (name if len(name) <= chars
+                            else name[:chars-2]+'..')
+                        f.write('<text x="%.1f" y="%d">%s</text>' % (
+                            pad + x*scale + 3,
+                            y + frame_height - 4,
+                            html.escape(label)))
+                    f.write('</g>\n')
+                    draw(children, x, d+1)
+                x += n
+
+        draw(tree, 0, 0)
+        f.write('</svg>\n')
+
+
 def table(Result, results, diff_results=None, *,
         by=None,
         fields=None,
@@ -1015,11 +1824,184 @@ def annotate(Result, results, *,
                 print(line)
 
 
+# regularized incomplete beta function, we need this for the t-distribution
+def betainc(a, b, x):
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+
+    # continued fraction, converges quickly for x < (a+1)/(a+b+2)
+    def betacf(a, b, x):
+        tiny = 1e-300
+        c = 1.0
+        d = 1.0 - (a+b)*x/(a+1)
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        h = d
+        for i in range(1, 300):
+            # even step
+            aa = i*(b-i)*x / ((a+2*i-1)*(a+2*i))
+            d = 1.0 + aa*d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + aa/c
+            c = c if abs(c) > tiny else tiny
+            h *= d*c
+            # odd step
+            aa = -(a+i)*(a+b+i)*x / ((a+2*i)*(a+2*i+1))
+            d = 1.0 + aa*d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + aa/c
+            c = c if abs(c) > tiny else tiny
+            h *= d*c
+            if abs(d*c - 1.0) < 1e-12:
+                break
+        return h
+
+    front = m.exp(m.lgamma(a+b) - m.lgamma(a) - m.lgamma(b)
+        + a*m.log(x) + b*m.log(1-x))
+    if x < (a+1)/(a+b+2):
+        return front*betacf(a, b, x)/a
+    else:
+        return 1.0 - front*betacf(b, a, 1-x)/b
+
+# Welch's t-test, returns the difference in means, a confidence interval
+# for the difference, and a two-sided p-value
+def welch(xs, ys, *,
+        confidence=0.95):
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    vx = sum((x-mx)**2 for x in xs) / (len(xs)-1)
+    vy = sum((y-my)**2 for y in ys) / (len(ys)-1)
+    diff = my - mx
+    se2 = vx/len(xs) + vy/len(ys)
+    if se2 == 0:
+        return diff, (diff, diff), 0.0 if diff else 1.0
+
+    # Welch-Satterthwaite degrees of freedom
+    se = m.sqrt(se2)
+    df = se2**2 / (
+        (vx/len(xs))**2/(len(xs)-1)
+        + (vy/len(ys))**2/(len(ys)-1))
+
+    def p_of(t):
+        return betainc(df/2, 0.5, df/(df + t*t))
+
+    # find the critical t by bisection, p_of is monotonic
+    lo, hi = 0.0, 1.0
+    while p_of(hi) > 1-confidence:
+        hi *= 2
+    for _ in range(100):
+        mid = (lo+hi) / 2
+        if p_of(mid) > 1-confidence:
+            lo = mid
+        else:
+            hi = mid
+
+    return diff, (diff - hi*se, diff + hi*se), p_of(diff/se)
+
+# compare runs against baseline runs, where each perf file is one run, and
+# only report statistically significant changes
+def significance(perf_paths, baseline_paths, *,
+        by=None,
+        fields=None,
+        defines=None,
+        branches=False,
+        caches=False,
+        confidence=0.95,
+        all=False,
+        **args):
+    if len(perf_paths) < 2 or len(baseline_paths) < 2:
+        print('error: need at least 2 runs and 2 baseline runs?')
+        sys.exit(-1)
+
+    by = by if by is not None else ['function']
+    field = (fields[0] if fields is not None
+        else 'cycles' if not branches and not caches
+        else 'bmisses' if branches
+        else 'cmisses')
+    if field not in PerfResult._counts:
+        print('error: can\'t compare derived field %r, try comparing '
+            'the fields it\'s derived from?' % field)
+        sys.exit(-1)
+
+    # keep per-run totals
+    def collect_runs(paths):
+        runs = []
+        for path in paths:
+            results = collect([path], **args).to_results()
+            results = fold(PerfResult, results, by=by, defines=defines)
+            runs.append({
+                ','.join(str(getattr(r, k) or '') for k in by):
+                    int(getattr(r, field))
+                for r in results})
+        return runs
+
+    runs = collect_runs(perf_paths)
+    baseline_runs = collect_runs(baseline_paths)
+
+    # test each name
+    tests = []
+    for name in sorted(set(it.chain.from_iterable(
+            run.keys() for run in runs + baseline_runs))):
+        xs = [run.get(name, 0) for run in baseline_runs]
+        ys = [run.get(name, 0) for run in runs]
+        diff, (lo, hi), p = welch(xs, ys, confidence=confidence)
+        old = sum(xs) / len(xs)
+        tests.append((name, old, old+diff, diff, lo, hi, p))
+
+    # most significant first
+    tests.sort(key=lambda r: (r[6], -abs(r[3])))
+
+    # we're testing a lot of functions at once, so control the false
+    # discovery rate with Benjamini-Hochberg, otherwise ~5% of unchanged
+    # functions would be flagged
+    k = max((i+1 for i, t in enumerate(tests)
+            if t[6] <= (i+1)/len(tests) * (1-confidence)),
+        default=0)
+
+    rows = []
+    regressions = 0
+    for i, (name, old, new, diff, lo, hi, p) in enumerate(tests):
+        significant = i < k
+        if significant and diff > 0:
+            regressions += 1
+        if significant or all:
+            rows.append((name, old, new, diff, lo, hi, p, significant))
+
+    if not args.get('quiet'):
+        def pct(x, old):
+            return '%+.1f%%' % (100*x/old) if old else '%+d' % x
+
+        lines = [['%s (%d runs vs %d)' % (
+                ','.join(by), len(runs), len(baseline_runs)),
+            'old', 'new', 'diff',
+            '%d%% ci' % round(100*confidence), 'p', '']]
+        for name, old, new, diff, lo, hi, p, significant in rows:
+            lines.append([name,
+                '%d' % round(old),
+                '%d' % round(new),
+                pct(diff, old),
+                '%s..%s' % (pct(lo, old), pct(hi, old)),
+                '%.2g' % p,
+                '*' if significant else ''])
+
+        widths = [max(len(line[i]) for line in lines)
+            for i in range(len(lines[0]))]
+        for line in lines:
+            print(('%-*s  %s' % (
+                widths[0], line[0],
+                ' '.join('%*s' % (w, x)
+                    for w, x in zip(widths[1:], line[1:])))).rstrip())
+
+    # exit non-zero on any significant regressions, this is useful for CI
+    return 1 if regressions else 0
+
 def report(perf_paths, *,
         by=None,
         fields=None,
         defines=None,
         sort=None,
+        ipc=False,
         branches=False,
         caches=False,
         **args):
@@ -1035,9 +2017,26 @@ def report(perf_paths, *,
     if args.get('depth') == 0:
         args['depth'] = m.inf
 
+    # comparing runs statistically?
+    if args.get('baseline'):
+        return significance(perf_paths, args.pop('baseline'),
+            by=by,
+            fields=fields,
+            defines=defines,
+            branches=branches,
+            caches=caches,
+            **args)
+
+    # folded stacks need the raw call-stacks
+    if (args.get('folded') or args.get('flamegraph')) and args.get('use'):
+        print('error: can\'t find call-stacks in a CSV file?')
+        sys.exit(-1)
+
     # find sizes
+    trie = None
     if not args.get('use', None):
-        results = collect(perf_paths, **args)
+        trie = collect(perf_paths, **args)
+        results = trie.to_results(depth=args.get('depth', 1))
     else:
         results = []
         with openio(args['use']) as f:
@@ -1083,6 +2082,22 @@ def report(perf_paths, *,
                     | {'perf_'+k: getattr(r, k) for k in (
                         fields if fields is not None else PerfResult._fields)})
 
+    # write folded stacks or a flamegraph?
+    if args.get('folded') or args.get('flamegraph'):
+        field = (fields[0] if fields is not None
+            else 'cycles' if not branches and not caches
+            else 'bmisses' if branches
+            else 'cmisses')
+        if field not in PerfResult._counts:
+            print('error: can\'t fold derived field %r?' % field)
+            sys.exit(-1)
+        folded = trie.folded(field)
+        if args.get('folded'):
+            write_folded(args['folded'], folded)
+        if args.get('flamegraph'):
+            write_flamegraph(args['flamegraph'], folded,
+                title=field)
+
     # find previous results?
     if args.get('diff'):
         diff_results = []
@@ -1121,9 +2136,10 @@ def report(perf_paths, *,
                 diff_results if args.get('diff') else None,
                 by=by if by is not None else ['function'],
                 fields=fields if fields is not None
+                    else ['cycles', 'instrs', 'ipc'] if ipc
                     else ['cycles'] if not branches and not caches
-                    else ['bmisses', 'branches'] if branches
-                    else ['cmisses', 'caches'],
+                    else ['bmisses', 'branches', 'bmrate'] if branches
+                    else ['cmisses', 'caches', 'cmrate'],
                 sort=sort,
                 **args)
 
@@ -1156,7 +2172,7 @@ if __name__ == "__main__":
     parser.add_argument(
         'perf_paths',
         nargs=nargs,
-        help="Input *.perf files.")
+        help="Input *.perf files or directories.")
     parser.add_argument(
         '-v', '--verbose',
         action='store_true',
@@ -1174,6 +2190,19 @@ if __name__ == "__main__":
     parser.add_argument(
         '-d', '--diff',
         help="Specify CSV file to diff against.")
+    parser.add_argument(
+        '--baseline',
+        action='append',
+        help="Baseline *.perf file to compare against. Each input and "
+            "baseline *.perf file is treated as one run, and only "
+            "statistically significant changes are reported, using Welch's "
+            "t-test with Benjamini-Hochberg correction. Exits non-zero if "
+            "anything got significantly worse. Can be repeated, needs at "
+            "least 2 runs of each.")
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        help="Confidence level for --baseline. Defaults to 0.95.")
     parser.add_argument(
         '-a', '--all',
         action='store_true',
@@ -1228,14 +2257,18 @@ if __name__ == "__main__":
         '--everything',
         action='store_true',
         help="Include builtin and libc specific symbols.")
+    parser.add_argument(
+        '--ipc',
+        action='store_true',
+        help="Show instructions and instructions per cycle.")
     parser.add_argument(
         '--branches',
         action='store_true',
-        help="Show branches and branch misses.")
+        help="Show branches, branch misses, and the branch miss rate.")
     parser.add_argument(
         '--caches',
         action='store_true',
-        help="Show cache accesses and cache misses.")
+        help="Show cache accesses, cache misses, and the cache miss rate.")
     parser.add_argument(
         '-P', '--propagate',
         type=lambda x: int(x, 0),
@@ -1248,6 +2281,14 @@ if __name__ == "__main__":
         const=0,
         help="Depth of function calls to show. 0 shows all calls but may not "
             "terminate!")
+    parser.add_argument(
+        '--folded',
+        help="Write folded call-stacks to this file, one stack per line, "
+            "compatible with flamegraph.pl. Counts the first field shown.")
+    parser.add_argument(
+        '--flamegraph',
+        help="Write an SVG flamegraph to this file. Counts the first "
+            "field shown.")
     parser.add_argument(
         '-A', '--annotate',
         action='store_true',
@@ -1280,11 +2321,27 @@ if __name__ == "__main__":
         type=lambda x: int(x, 0),
         const=0,
         help="Number of processes to use. 0 spawns one process per core.")
+    parser.add_argument(
+        '--cache',
+        help="Directory to cache symbols and line info in, keyed by each "
+            "binary's path, mtime, and build-id.")
     parser.add_argument(
         '--perf-path',
         type=lambda x: x.split(),
         help="Path to the perf executable, may include flags. "
             "Defaults to %r." % PERF_PATH)
+    parser.add_argument(
+        '--phase',
+        choices=['bench', 'setup'],
+        help="Only include samples inside (bench) or outside (setup) of "
+            "BENCH_START/BENCH_STOP windows. This relies on markers the "
+            "bench-runner logs while recording.")
+    parser.add_argument(
+        '--perf-script',
+        action='store_true',
+        help="Decode perf.data files with perf script instead of our "
+            "builtin decoder. We fall back to perf script anyways if we "
+            "can't decode a file.")
     parser.add_argument(
         '--objdump-path',
         type=lambda x: x.split(),
@@ -1305,7 +2362,9 @@ if __name__ == "__main__":
     record_parser.add_argument(
         '-o', '--output',
         help="Output file. Uses flock to synchronize. This is stored as a "
-            "zip-file of multiple perf results.")
+            "zip-file of multiple perf results. If this ends with a slash, "
+            "perf results are instead written to separate files in this "
+            "directory, which avoids the copy and the lock.")
     record_parser.add_argument(
         '--perf-freq',
         help="perf sampling frequency. This is passed directly to perf. "
@@ -1315,7 +2374,10 @@ if __name__ == "__main__":
         help="perf sampling period. This is passed directly to perf.")
     record_parser.add_argument(
         '--perf-events',
-        help="perf events to record. This is passed directly to perf. "
+        help="perf events to record. This is passed directly to perf, "
+            "though we only report cycles, instructions, branches, "
+            "branch-misses, cache-references, cache-misses, "
+            "L1-dcache-loads, and L1-dcache-load-misses. "
             "Defaults to %r." % PERF_EVENTS)
     record_parser.add_argument(
         '--perf-path',
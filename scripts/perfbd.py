@@ -15,13 +15,20 @@ import bisect
 import collections as co
 import csv
 import functools as ft
+import html
+import io
 import itertools as it
 import math as m
+import mmap
 import multiprocessing as mp
 import os
+import queue as qu
 import re
 import shlex
+import struct
 import subprocess as sp
+import threading as th
+import zlib
 
 
 OBJDUMP_PATH = ['objdump']
@@ -103,45 +110,327 @@ class Int(co.namedtuple('Int', 'x')):
     def __sub__(self, other):
         return self.__class__(self.x - other.x)
 
-    def __mul__(self, other):
-        return self.__class__(self.x * other.x)
-
 # perf results
 class PerfBdResult(co.namedtuple('PerfBdResult', [
-        'file', 'function', 'line',
+        'file', 'function', 'line', 'block',
         'readed', 'proged', 'erased',
+        'reads', 'progs', 'erases',
+        'time',
         'children'])):
-    _by = ['file', 'function', 'line']
-    _fields = ['readed', 'proged', 'erased']
-    _sort = ['erased', 'proged', 'readed']
-    _types = {'readed': Int, 'proged': Int, 'erased': Int}
+    _by = ['file', 'function', 'line', 'block']
+    # measured fields, time is modelled from these
+    _counts = ['readed', 'proged', 'erased', 'reads', 'progs', 'erases']
+    _fields = _counts + ['time']
+    _sort = ['time', 'erased', 'proged', 'readed', 'erases', 'progs', 'reads']
+    _types = {
+        'readed': Int, 'proged': Int, 'erased': Int,
+        'reads': Int, 'progs': Int, 'erases': Int,
+        'time': Int}
 
     __slots__ = ()
-    def __new__(cls, file='', function='', line=0,
+    def __new__(cls, file='', function='', line=0, block=None,
             readed=0, proged=0, erased=0,
+            reads=0, progs=0, erases=0,
+            time=None,
             children=[]):
         return super().__new__(cls, file, function, int(Int(line)),
+            Int(block) if block is not None else None,
             Int(readed), Int(proged), Int(erased),
+            Int(reads), Int(progs), Int(erases),
+            Int(time) if time is not None else None,
             children)
 
     def __add__(self, other):
-        return PerfBdResult(self.file, self.function, self.line,
+        return PerfBdResult(self.file, self.function, self.line, self.block,
             self.readed + other.readed,
             self.proged + other.proged,
             self.erased + other.erased,
+            self.reads + other.reads,
+            self.progs + other.progs,
+            self.erases + other.erases,
+            self.time + other.time
+                if self.time is not None and other.time is not None
+                else None,
             self.children + other.children)
 
+# modelled device time in ns, where model is a (per-op, per-byte) cost in
+# seconds for each of read/prog/erase
+def model_time(model, readed, proged, erased, reads, progs, erases):
+    return round(1e9*sum(
+        int(ops)*op + int(bytes)*byte
+        for (op, byte), ops, bytes in zip(
+            model,
+            [reads, progs, erases],
+            [readed, proged, erased])))
+
+# apply a latency model to results, recursively
+def model_results(model, results):
+    return [r._replace(
+            time=Int(model_time(model,
+                *(getattr(r, k) for k in PerfBdResult._counts))),
+            children=model_results(model, r.children))
+        for r in results]
+
+
+# a compact call-trie, frames are interned as integer ids and operations
+# with the same call-stack are merged, so we only need to propagate
+# measurements once per unique call-stack
+#
+# if we're tracking blocks, operations are merged per call-stack and block
+class PerfBdTrie:
+    def __init__(self):
+        self.frames = []
+        self.ids = {}
+        self.stacks = {}
+
+    def intern(self, frame):
+        id = self.ids.get(frame)
+        if id is None:
+            id = len(self.frames)
+            self.frames.append(frame)
+            self.ids[frame] = id
+        return id
+
+    # add an operation of n bytes, field is one of read/prog/erase
+    def add(self, stack, field, n, block=None):
+        counts = self.stacks.get((stack, block))
+        if counts is None:
+            counts = [0]*len(PerfBdResult._counts)
+            self.stacks[(stack, block)] = counts
+        counts[field] += n
+        counts[3+field] += 1
+
+    # find a field from a stack's counts, time needs a latency model
+    @staticmethod
+    def getter(field, model=None):
+        if field == 'time':
+            return lambda counts: model_time(model, *counts)
+        i = PerfBdResult._counts.index(field)
+        return lambda counts: counts[i]
+
+    def merge(self, other):
+        # remap other's frame ids into ours
+        ids = [self.intern(frame) for frame in other.frames]
+        for (stack, block), counts_ in other.stacks.items():
+            stack = tuple(ids[id] for id in stack)
+            counts = self.stacks.get((stack, block))
+            if counts is None:
+                self.stacks[(stack, block)] = list(counts_)
+            else:
+                for i, n in enumerate(counts_):
+                    counts[i] += n
+
+    def folded(self, field, *,
+            model=None):
+        # merge stacks by function, outermost frames first
+        get = self.getter(field, model)
+        folded = {}
+        for (stack, _), counts in self.stacks.items():
+            n = get(counts)
+            if n:
+                names = tuple(self.frames[id][1] for id in reversed(stack))
+                folded[names] = folded.get(names, 0) + n
+        return folded
+
+    def blocks(self, field, *,
+            model=None,
+            defines=None):
+        # merge stacks by block, optionally only including call-stacks
+        # that pass through a matching frame
+        get = self.getter(field, model)
+
+        # filter by matching defines
+        def match(file, function, line, block):
+            r = {'file': file, 'function': function, 'line': line,
+                'block': block}
+            return all(str(r[k]) in vs for k, vs in defines)
+
+        blocks = {}
+        for (stack, block), counts in self.stacks.items():
+            n = get(counts)
+            if block is None or not n:
+                continue
+
+            if defines is not None:
+                if not any(match(*self.frames[id], block) for id in stack):
+                    continue
+
+            blocks[block] = blocks.get(block, 0) + n
+        return blocks
+
+    def to_results(self, *,
+            depth=1):
+        # tail-recursively propagate measurements
+        trie = {}
+        for (stack, block), counts in self.stacks.items():
+            for i in range(len(stack)):
+                node = trie
+                for j in range(i, max(i-depth, -1), -1):
+                    # propagate
+                    id = (stack[j], block)
+                    if id not in node:
+                        node[id] = ([0]*len(counts), {})
+                    counts_, children = node[id]
+                    for k, n in enumerate(counts):
+                        counts_[k] += n
+
+                    # recurse
+                    node = children
+
+        # rearrange results into result type
+        def to_results(node):
+            results = []
+            for (id, block), (counts, children) in node.items():
+                results.append(PerfBdResult(*self.frames[id], block, *counts,
+                    children=to_results(children)))
+            return results
+
+        return to_results(trie)
+
 
 def openio(path, mode='r', buffering=-1):
     # allow '-' for stdin/stdout
     if path == '-':
-        if mode == 'r':
+        if 'r' in mode:
             return os.fdopen(os.dup(sys.stdin.fileno()), mode, buffering)
         else:
             return os.fdopen(os.dup(sys.stdout.fileno()), mode, buffering)
     else:
         return open(path, mode, buffering)
 
+# binary block device traces, these are written by the test/bench runners
+# with --trace-binary and are much faster to parse than text
+#
+# each record is a native-endian header:
+#
+# [ 'b' | 'd' | op  |  0  |  block  |   off   |  size   |  count  | anchor ]
+#
+# followed by count 64-bit backtrace addresses, where op is one of 'c'
+# (create, block=block_count, size=block_size), 'r', 'p', or 'e', and
+# anchor is the runtime address of lfs_emubd_read
+BD_TRACE = struct.Struct('=2scxIIIIQ')
+BD_TRACE_OPS = {b'c', b'r', b'p', b'e'}
+
+def bd_trace_valid(data, off=0):
+    return (data[off:off+2] == b'bd'
+        and data[off+2:off+3] in BD_TRACE_OPS
+        and data[off+3:off+4] == b'\0')
+
+def bd_trace_isbinary(f):
+    # note the 0 byte never shows up in text traces
+    return bd_trace_valid(f.peek(BD_TRACE.size))
+
+# find the next record in the middle of a trace, we don't have a perfect
+# delimiter, so also check that the following record looks valid
+def bd_trace_resync(data, off):
+    while True:
+        off = data.find(b'bd', off)
+        if off < 0:
+            return len(data)
+        if bd_trace_valid(data, off) and off+BD_TRACE.size <= len(data):
+            count, = struct.unpack_from('=I', data, off+16)
+            next = off + BD_TRACE.size + 8*count
+            if next >= len(data) or bd_trace_valid(data, next):
+                return off
+        off += 1
+
+# unpack records starting before end, returning the offset we stopped at
+def bd_trace_unpack(data, off, end):
+    while off < end and off+BD_TRACE.size <= len(data):
+        if not bd_trace_valid(data, off):
+            off = bd_trace_resync(data, off+1)
+            continue
+
+        _, op, block, off_, size, count, anchor = BD_TRACE.unpack_from(
+            data, off)
+        next = off + BD_TRACE.size + 8*count
+        if next > len(data):
+            break
+        addrs = struct.unpack_from('=%dQ' % count, data, off+BD_TRACE.size)
+        yield op, block, off_, size, anchor, addrs
+        off = next
+
+    return off
+
+# iterate over (op, block, off, size, anchor, addrs) records in a binary
+# trace
+def bd_trace_records(f):
+    # mmap if we can, this avoids copies
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        data = None
+
+    if data is not None:
+        with data:
+            yield from bd_trace_unpack(data, 0, len(data))
+        return
+
+    # otherwise we're streaming, so parse what we can as data comes in
+    buf = b''
+    while True:
+        chunk = f.read1(1024*1024)
+        if not chunk:
+            break
+        buf += chunk
+        off = yield from bd_trace_unpack(buf, 0, len(buf))
+        buf = buf[off:]
+
+# split a trace into record-aligned (start, stop) ranges of roughly size
+# bytes, this lets us process a trace in parallel without splitting a
+# backtrace across jobs
+#
+# if eof=False, the trace may continue, so any trailing partial record is
+# left out
+def bd_trace_chunks(data, size, *, eof=True):
+    start = 0
+
+    # binary traces? walk the records, this is exact
+    if bd_trace_valid(data):
+        off = 0
+        while off+BD_TRACE.size <= len(data):
+            if not bd_trace_valid(data, off):
+                off = bd_trace_resync(data, off+1)
+                continue
+            count, = struct.unpack_from('=I', data, off+16)
+            next = off + BD_TRACE.size + 8*count
+            if next > len(data):
+                break
+            off = next
+
+            if off-start >= size:
+                yield start, off
+                start = off
+
+        stop = len(data) if eof else off
+        if stop > start:
+            yield start, stop
+        return
+
+    # text traces? records start at any line that isn't a backtrace frame
+    while start+size < len(data):
+        i = data.find(b'\n', start+size-1)
+        while i >= 0 and data[i+1:i+2] == b'\t':
+            i = data.find(b'\n', i+1)
+        # note we need the next line to know where the record ends
+        if i < 0 or i+1 >= len(data):
+            break
+        yield start, i+1
+        start = i+1
+
+    if eof:
+        stop = len(data)
+    else:
+        stop = start
+        i = data.rfind(b'\n', start, len(data)-1)
+        while i >= 0:
+            if data[i+1:i+2] != b'\t':
+                stop = i+1
+                break
+            i = data.rfind(b'\n', start, i)
+    if stop > start:
+        yield start, stop
+
 def collect_syms_and_lines(obj_path, *,
         objdump_path=None,
         **args):
@@ -293,10 +582,11 @@ def collect_syms_and_lines(obj_path, *,
 
 
 def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
+        data=None,
         sources=None,
         everything=False,
         propagate=0,
-        depth=1,
+        blocks=False,
         **args):
     trace_pattern = re.compile(
         '^(?P<file>[^:]*):(?P<line>[0-9]+):trace:\s*(?P<prefix>[^\s]*?bd_)(?:'
@@ -324,13 +614,13 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
     last_file = None
     last_line = None
     last_sym = None
-    last_readed = 0
-    last_proged = 0
-    last_erased = 0
+    last_field = 0
+    last_size = 0
+    last_block = None
     last_stack = []
     last_delta = None
     at_cache = {}
-    results = {}
+    trie = PerfBdTrie()
 
     def commit():
         # fallback to just capturing top-level measurements
@@ -361,45 +651,125 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
             else:
                 file = os.path.abspath(file)
 
-            results[(file, sym, line)] = (
-                last_readed,
-                last_proged,
-                last_erased,
-                {})
+            trie.add((trie.intern((file, sym, line)),),
+                last_field, last_size, last_block)
         else:
-            # tail-recursively propagate measurements
-            for i in range(len(last_stack)):
-                results_ = results
-                for j in reversed(range(i+1)):
-                    if i+1-j > depth:
-                        break
+            trie.add(tuple(last_stack), last_field, last_size, last_block)
+
+    # map an address, after reversing ASLR, to a (file, sym, line) frame,
+    # returns None if the frame should be skipped
+    def resolve(addr):
+        # cached?
+        if addr in at_cache:
+            return at_cache[addr]
+
+        # find sym
+        i = bisect.bisect(sym_at, addr, key=lambda x: x[0])
+        # check that we're actually in the sym's size
+        if i > 0 and addr < sym_at[i-1][0] + sym_at[i-1][2]:
+            _, sym, _ = sym_at[i-1]
+        else:
+            sym = hex(addr)
+
+        # filter out internal/unknown functions
+        if not everything and (
+                sym.startswith('__')
+                or sym.startswith('0')
+                or sym.startswith('-')
+                or sym == '_start'):
+            at_cache[addr] = None
+            return None
+
+        # find file+line
+        i = bisect.bisect(line_at, addr, key=lambda x: x[0])
+        if i > 0:
+            _, file, line = line_at[i-1]
+        elif len(last_stack) == 0:
+            file, line = last_file, last_line
+        else:
+            file, line = re.sub('(\.o)?$', '.c', obj_path, 1), 0
+
+        # ignore filtered sources
+        if sources is not None:
+            if not any(
+                    os.path.abspath(file)
+                        == os.path.abspath(s)
+                    for s in sources):
+                at_cache[addr] = None
+                return None
+        else:
+            # default to only cwd
+            if not everything and not os.path.commonpath([
+                    os.getcwd(),
+                    os.path.abspath(file)]) == os.getcwd():
+                at_cache[addr] = None
+                return None
+
+        # simplify path
+        if os.path.commonpath([
+                os.getcwd(),
+                os.path.abspath(file)]) == os.getcwd():
+            file = os.path.relpath(file)
+        else:
+            file = os.path.abspath(file)
+
+        at_cache[addr] = file, sym, line
+        return file, sym, line
+
+    # only parsing a record-aligned range? read it into memory, these
+    # should be small
+    if data is None and (start is not None or stop is not None):
+        with openio(path, 'rb') as f:
+            f.seek(start or 0)
+            data = f.read(stop-(start or 0) if stop is not None else -1)
+
+    with (io.BufferedReader(io.BytesIO(data)) if data is not None
+            else openio(path, 'rb')) as f:
+        # binary traces? these are much faster to parse
+        if bd_trace_isbinary(f):
+            # binary traces don't include file+line info, so use each op's
+            # function in emubd as a reference point
+            refs = {}
+            for op, sym, field in [
+                    (b'r', 'lfs_emubd_read', 0),
+                    (b'p', 'lfs_emubd_prog', 1),
+                    (b'e', 'lfs_emubd_erase', 2)]:
+                if sym in syms:
+                    addr, _ = min(syms[sym])
+                    i = bisect.bisect(line_at, addr, key=lambda x: x[0])
+                    if i > 0:
+                        _, file, line = line_at[i-1]
+                        refs[op] = file, sym, line, field
+
+            # each record's anchor tells us how to reverse ASLR
+            anchor_addr = (min(syms['lfs_emubd_read'])[0]
+                if 'lfs_emubd_read' in syms else None)
+
+            for op, block, _, size, anchor, addrs in bd_trace_records(f):
+                if op not in refs:
+                    continue
+                last_file, last_sym, last_line, last_field = refs[op]
+                last_size = size
+                last_block = block if blocks else None
+                last_stack = []
+
+                if anchor_addr is not None:
+                    for addr_ in addrs:
+                        frame = resolve(addr_ + anchor_addr - anchor)
+                        if frame is None:
+                            continue
+                        last_stack.append(trie.intern(frame))
 
-                    # propagate
-                    name = last_stack[j]
-                    if name in results_:
-                        r, p, e, children = results_[name]
-                    else:
-                        r, p, e, children = 0, 0, 0, {}
-                    results_[name] = (
-                        r+last_readed,
-                        p+last_proged,
-                        e+last_erased,
-                        children)
+                        # stop propagating?
+                        if propagate and len(last_stack) >= propagate:
+                            break
 
-                    # recurse
-                    results_ = results_[name][-1]
-
-    with openio(path) as f:
-        # try to jump to middle of file? need step out of utf8-safe mode and
-        # then resync up with the next newline to avoid parsing half a line
-        if start is not None and start > 0:
-            fd = f.fileno()
-            os.lseek(fd, start, os.SEEK_SET)
-            while os.read(fd, 1) not in {b'\n', b'\r', b''}:
-                pass
-            f = os.fdopen(fd)
-
-        for line in f:
+                commit()
+
+            return trie
+
+        # otherwise parse as text
+        for line in io.TextIOWrapper(f):
             # we have a lot of data, try to take a few shortcuts,
             # string search is much faster than regex so try to use
             # regex as late as possible.
@@ -408,11 +778,6 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
                     commit()
                 last_filtered = False
 
-                # done processing our slice?
-                if stop is not None:
-                    if os.lseek(f.fileno(), 0, os.SEEK_CUR) > stop:
-                        break
-
                 if 'trace' in line and 'bd' in line:
                     m = trace_pattern.match(line)
                     if m:
@@ -420,21 +785,27 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
                         last_file = os.path.abspath(m.group('file'))
                         last_line = int(m.group('line'), 0)
                         last_sym = m.group('prefix')
-                        last_readed = 0
-                        last_proged = 0
-                        last_erased = 0
                         last_stack = []
                         last_delta = None
 
                         if m.group('read'):
                             last_sym += m.group('read')
-                            last_readed += int(m.group('read_size'))
+                            last_field = 0
+                            last_size = int(m.group('read_size'))
+                            if blocks:
+                                last_block = int(m.group('read_block'), 0)
                         elif m.group('prog'):
                             last_sym += m.group('prog')
-                            last_proged += int(m.group('prog_size'))
+                            last_field = 1
+                            last_size = int(m.group('prog_size'))
+                            if blocks:
+                                last_block = int(m.group('prog_block'), 0)
                         elif m.group('erase'):
                             last_sym += m.group('erase')
-                            last_erased += int(m.group('erase_size'))
+                            last_field = 2
+                            last_size = int(m.group('erase_size'))
+                            if blocks:
+                                last_block = int(m.group('erase_block'), 0)
 
             elif last_filtered:
                 m = frame_pattern.match(line)
@@ -456,69 +827,10 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
                             last_filtered = False
                             continue
 
-                    addr = addr_ + last_delta
-
-                    # cached?
-                    if addr in at_cache:
-                        cached = at_cache[addr]
-                        if cached is None:
-                            # cache says to skip
-                            continue
-                        file, sym, line = cached
-                    else:
-                        # find sym
-                        i = bisect.bisect(sym_at, addr, key=lambda x: x[0])
-                        # check that we're actually in the sym's size
-                        if i > 0 and addr < sym_at[i-1][0] + sym_at[i-1][2]:
-                            _, sym, _ = sym_at[i-1]
-                        else:
-                            sym = hex(addr)
-
-                        # filter out internal/unknown functions
-                        if not everything and (
-                                sym.startswith('__')
-                                or sym.startswith('0')
-                                or sym.startswith('-')
-                                or sym == '_start'):
-                            at_cache[addr] = None
-                            continue
-
-                        # find file+line
-                        i = bisect.bisect(line_at, addr, key=lambda x: x[0])
-                        if i > 0:
-                            _, file, line = line_at[i-1]
-                        elif len(last_stack) == 0:
-                            file, line = last_file, last_line
-                        else:
-                            file, line = re.sub('(\.o)?$', '.c', obj_path, 1), 0
-
-                        # ignore filtered sources
-                        if sources is not None:
-                            if not any(
-                                    os.path.abspath(file)
-                                        == os.path.abspath(s)
-                                    for s in sources):
-                                at_cache[addr] = None
-                                continue
-                        else:
-                            # default to only cwd
-                            if not everything and not os.path.commonpath([
-                                    os.getcwd(),
-                                    os.path.abspath(file)]) == os.getcwd():
-                                at_cache[addr] = None
-                                continue
-
-                        # simplify path
-                        if os.path.commonpath([
-                                os.getcwd(),
-                                os.path.abspath(file)]) == os.getcwd():
-                            file = os.path.relpath(file)
-                        else:
-                            file = os.path.abspath(file)
-
-                        at_cache[addr] = file, sym, line
-
-                    last_stack.append((file, sym, line))
+                    frame = resolve(addr_ + last_delta)
+                    if frame is None:
+                        continue
+                    last_stack.append(trie.intern(frame))
 
                     # stop propagating?
                     if propagate and len(last_stack) >= propagate:
@@ -527,23 +839,24 @@ def collect_job(path, start, stop, syms, sym_at, lines, line_at, *,
         if last_filtered:
             commit()
 
-    # rearrange results into result type
-    def to_results(results):
-        results_ = []
-        for name, (r, p, e, children) in results.items():
-            results_.append(PerfBdResult(*name,
-                r, p, e,
-                children=to_results(children)))
-        return results_
-
-    return to_results(results)
+    return trie
 
 def starapply(args):
     f, args, kwargs = args
     return f(*args, **kwargs)
 
+# symbol tables are large, so send these to each worker once instead of
+# with every chunk
+def collect_init(syms, sym_at, lines, line_at):
+    global collect_syms
+    collect_syms = syms, sym_at, lines, line_at
+
+def collect_chunk(path, start, stop, data=None, **args):
+    return collect_job(path, start, stop, *collect_syms, data=data, **args)
+
 def collect(obj_path, trace_paths, *,
         jobs=None,
+        chunk_size=None,
         **args):
     # automatic job detection?
     if jobs == 0:
@@ -553,45 +866,83 @@ def collect(obj_path, trace_paths, *,
     syms, sym_at, lines, line_at = collect_syms_and_lines(obj_path, **args)
 
     if jobs is not None:
-        # try to split up files so that even single files can be processed
-        # in parallel
-        #
-        # this looks naive, since we're splitting up text files by bytes, but
-        # we do proper backtrace delimination in collect_job
-        trace_ranges = []
-        for path in trace_paths:
-            if path == '-':
-                trace_ranges.append([(None, None)])
-                continue
-
-            size = os.path.getsize(path)
-            if size == 0:
-                trace_ranges.append([(None, None)])
-                continue
-
-            perjob = m.ceil(size // jobs)
-            trace_ranges.append([(i, i+perjob) for i in range(0, size, perjob)])
+        # split up traces into record-aligned chunks, we want more chunks
+        # than jobs so uneven chunks don't leave jobs idle
+        def chunk_size_(size=None):
+            if chunk_size is not None:
+                return chunk_size
+            # streams have unknown size, so just pick something reasonable
+            if size is None:
+                return 1024*1024
+            return max(m.ceil(size / (8*jobs)), 64*1024)
+
+        # limit chunks in flight, otherwise the pool will happily read all
+        # of stdin into memory
+        inflight = th.Semaphore(4*jobs)
+
+        # stdin can't be split up ahead of time, so read it in a background
+        # thread and pass chunks to the pool as they become available
+        def stream(path, queue):
+            with openio(path, 'rb') as f:
+                size = chunk_size_()
+                buf = b''
+                while True:
+                    data = f.read(size)
+                    buf += data
+                    stop = 0
+                    for start, stop in bd_trace_chunks(buf, size,
+                            eof=not data):
+                        queue.put(buf[start:stop])
+                    buf = buf[stop:]
+                    if not data:
+                        break
+            queue.put(None)
+
+        def chunks():
+            for path in trace_paths:
+                if path == '-':
+                    queue = qu.Queue(4*jobs)
+                    th.Thread(target=stream, args=(path, queue),
+                        daemon=True).start()
+                    while True:
+                        data = queue.get()
+                        if data is None:
+                            break
+                        inflight.acquire()
+                        yield path, None, None, data
+                    continue
 
-        results = []
-        with mp.Pool(jobs) as p:
-            for results_ in p.imap_unordered(
+                with openio(path, 'rb') as f:
+                    try:
+                        data = mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+                    except ValueError:
+                        # empty file
+                        continue
+                    with data:
+                        ranges = list(bd_trace_chunks(data,
+                            chunk_size_(len(data))))
+                for start, stop in ranges:
+                    inflight.acquire()
+                    yield path, start, stop, None
+
+        trie = PerfBdTrie()
+        with mp.Pool(jobs, collect_init, (syms, sym_at, lines, line_at)) as p:
+            for trie_ in p.imap_unordered(
                     starapply,
-                    ((collect_job, (path, start, stop,
-                        syms, sym_at, lines, line_at),
-                        args)
-                        for path, ranges in zip(trace_paths, trace_ranges)
-                        for start, stop in ranges)):
-                results.extend(results_)
+                    ((collect_chunk, (path, start, stop, data), args)
+                        for path, start, stop, data in chunks())):
+                trie.merge(trie_)
+                inflight.release()
 
     else:
-        results = []
+        trie = PerfBdTrie()
         for path in trace_paths:
-            results.extend(collect_job(path, None, None,
+            trie.merge(collect_job(path, None, None,
                 syms, sym_at, lines, line_at,
                 **args))
 
-    return results
-
+    return trie
 
 def fold(Result, results, *,
         by=None,
@@ -609,7 +960,7 @@ def fold(Result, results, *,
     if defines is not None:
         results_ = []
         for r in results:
-            if all(getattr(r, k) in vs for k, vs in defines):
+            if all(str(getattr(r, k)) in vs for k, vs in defines):
                 results_.append(r)
         results = results_
 
@@ -637,6 +988,105 @@ def fold(Result, results, *,
 
     return folded
 
+# write Brendan Gregg style folded stacks, one stack per line
+def write_folded(path, folded):
+    with openio(path, 'w') as f:
+        for names, n in sorted(folded.items()):
+            f.write('%s %d\n' % (';'.join(names), n))
+
+# write a self-contained SVG flamegraph
+def write_flamegraph(path, folded, *,
+        title='',
+        width=1200):
+    frame_height = 16
+    font_size = 12
+    font_width = 0.59*font_size
+    pad = 10
+
+    # build a tree of frames
+    tree = {}
+    for names, n in folded.items():
+        node = tree
+        for name in names:
+            if name not in node:
+                node[name] = [0, {}]
+            node[name][0] += n
+            node = node[name][1]
+
+    def depth_of(node):
+        return max((1+depth_of(children) for _, children in node.values()),
+            default=0)
+    depth = depth_of(tree)
+    total = sum(n for n, _ in tree.values())
+    height = (depth+1)*frame_height + 2*pad + 2*font_size
+    scale = (width-2*pad) / total if total else 0
+
+    with openio(path, 'w') as f:
+        f.write('<?xml version="1.0" standalone="no"?>\n')
+        f.write('<svg version="1.1" width="%d" height="%d" '
+            'xmlns="http://www.w3.org/2000/svg" '
+            'font-family="Verdana" font-size="%d">\n' % (
+                width, height, font_size))
+        f.write('<rect x="0" y="0" width="100%" height="100%" '
+            'fill="#f8f8f8"/>\n')
+        f.write('<text x="%d" y="%d" text-anchor="middle" '
+            'font-size="%d">%s</text>\n' % (
+                width//2, pad+font_size, font_size+4, html.escape(title)))
+
+        # draw frames bottom-up, callees sit on top of their callers
+        def draw(node, x, d):
+            for name, (n, children) in sorted(node.items()):
+                w = n*scale
+                # skip frames too small to see
+                if w >= 0.1:
+                    y = height - pad - (d+1)*frame_height
+                    # warm colors, but stable for each function
+                    h = zlib.crc32(name.encode())
+                    f.write('<g><title>%s (%d, %.2f%%)</title>'
+                        '<rect x="%.1f" y="%d" width="%.1f" height="%d" '
+                        'rx="2" fill="rgb(%d,%d,%d)"/>' % (
+                            html.escape(name), n, 100*n/total,
+                            pad + x*scale, y, w, frame_height-1,
+                            205 + h%50, (h>>8)%230, (h>>16)%55))
+                    # only label frames that fit at least a few characters
+                    chars = int((w-6) / font_width)
+                    if chars >= 3:
+                        label = (name if len(name) <= chars
+                            else name[:chars-2]+'..')
+                        f.write('<text x="%.1f" y="%d">%s</text>' % (
+                            pad + x*scale + 3,
+                            y + frame_height - 4,
+                            html.escape(label)))
+                    f.write('</g>\n')
+                    draw(children, x, d+1)
+                x += n
+
+        draw(tree, 0, 0)
+        f.write('</svg>\n')
+
+
+# print a histogram of operations per block
+def histogram(blocks, *,
+        field='',
+        width=80,
+        **_):
+    name_width = max(it.chain([5], (len(str(b)) for b in blocks)))
+    n_width = max(it.chain([7, len(field)],
+        (len(str(n)) for n in blocks.values())))
+    bar_width = max(width - name_width - n_width - 4, 1)
+    max_n = max(blocks.values(), default=0)
+
+    print('%-*s  %*s' % (name_width, 'block', n_width, field))
+    for block, n in sorted(blocks.items()):
+        # use partial blocks for a bit more resolution
+        w = round(8*bar_width * n/max_n)
+        print('%-*s  %*d  %s%s' % (
+            name_width, block, n_width, n,
+            '█'*(w//8),
+            ' ▏▎▍▌▋▊▉'[w%8] if w%8 else ''))
+    print('%-*s  %*d' % (name_width, 'TOTAL', n_width, sum(blocks.values())))
+
+
 def table(Result, results, diff_results=None, *,
         by=None,
         fields=None,
@@ -1015,9 +1465,59 @@ def report(obj_path='', trace_paths=[], *,
     if args.get('depth') == 0:
         args['depth'] = m.inf
 
+    # model device time? each op costs a fixed time + a time per byte
+    model = None
+    if (args.get('read_sleep')
+            or args.get('prog_sleep')
+            or args.get('erase_sleep')):
+        model = [
+            args.get('read_sleep') or (0, 0),
+            args.get('prog_sleep') or (0, 0),
+            args.get('erase_sleep') or (0, 0)]
+
+    # with a model, default to sorting by modelled time
+    if model and sort is None:
+        sort = [('time', False)]
+
+    # figure out which fields to show
+    fields_ = (fields if fields is not None
+        else (['reads', 'progs', 'erases'] if args.get('ops')
+                else ['readed', 'proged', 'erased'])
+            + (['time'] if model else []))
+    field = (fields[0] if fields is not None
+        else 'time' if model
+        else 'erases' if args.get('ops')
+        else 'erased')
+
+    # time needs a latency model
+    if (field == 'time'
+            and not model
+            and (args.get('folded')
+                or args.get('flamegraph')
+                or args.get('histogram'))):
+        print('error: no latency model for time, '
+            'try --read-sleep/--prog-sleep/--erase-sleep?')
+        sys.exit(-1)
+
+    # folded stacks and histograms need the raw call-stacks
+    if ((args.get('folded')
+                or args.get('flamegraph')
+                or args.get('histogram'))
+            and args.get('use')):
+        print('error: can\'t find call-stacks in a CSV file?')
+        sys.exit(-1)
+
+    # only track blocks if we need to, this can make the trie much larger
+    blocks = bool(
+        'block' in (by or [])
+            or any(k == 'block' for k, _ in defines or [])
+            or args.get('histogram'))
+
     # find sizes
+    trie = None
     if not args.get('use', None):
-        results = collect(obj_path, trace_paths, **args)
+        trie = collect(obj_path, trace_paths, blocks=blocks, **args)
+        results = trie.to_results(depth=args.get('depth', 1))
     else:
         results = []
         with openio(args['use']) as f:
@@ -1035,6 +1535,10 @@ def report(obj_path='', trace_paths=[], *,
                 except TypeError:
                     pass
 
+    # find modelled time
+    if model:
+        results = model_results(model, results)
+
     # fold
     results = fold(PerfBdResult, results, by=by, defines=defines)
 
@@ -1050,18 +1554,30 @@ def report(obj_path='', trace_paths=[], *,
 
     # write results to CSV
     if args.get('output'):
+        # only include blocks if we tracked them
+        by_ = (by if by is not None
+            else [k for k in PerfBdResult._by if k != 'block' or blocks])
         with openio(args['output'], 'w') as f:
             writer = csv.DictWriter(f,
-                (by if by is not None else PerfBdResult._by)
+                by_
                 + ['perfbd_'+k for k in (
                     fields if fields is not None else PerfBdResult._fields)])
             writer.writeheader()
             for r in results:
                 writer.writerow(
-                    {k: getattr(r, k) for k in (
-                        by if by is not None else PerfBdResult._by)}
+                    {k: getattr(r, k) for k in by_}
                     | {'perfbd_'+k: getattr(r, k) for k in (
-                        fields if fields is not None else PerfBdResult._fields)})
+                        fields if fields is not None
+                            else PerfBdResult._fields)})
+
+    # write folded stacks or a flamegraph?
+    if args.get('folded') or args.get('flamegraph'):
+        folded = trie.folded(field, model=model)
+        if args.get('folded'):
+            write_folded(args['folded'], folded)
+        if args.get('flamegraph'):
+            write_flamegraph(args['flamegraph'], folded,
+                title=field)
 
     # find previous results?
     if args.get('diff'):
@@ -1085,12 +1601,22 @@ def report(obj_path='', trace_paths=[], *,
         except FileNotFoundError:
             pass
 
+        # find modelled time, note we use the same model so results are
+        # comparable
+        if model:
+            diff_results = model_results(model, diff_results)
+
         # fold
         diff_results = fold(PerfBdResult, diff_results, by=by, defines=defines)
 
     # print table
     if not args.get('quiet'):
-        if (args.get('annotate')
+        if args.get('histogram'):
+            # print a histogram of blocks
+            histogram(trie.blocks(field, model=model, defines=defines),
+                field=field,
+                **args)
+        elif (args.get('annotate')
                 or args.get('threshold')
                 or args.get('read_threshold')
                 or args.get('prog_threshold')
@@ -1102,7 +1628,7 @@ def report(obj_path='', trace_paths=[], *,
             table(PerfBdResult, results,
                 diff_results if args.get('diff') else None,
                 by=by if by is not None else ['function'],
-                fields=fields,
+                fields=fields_,
                 sort=sort,
                 **args)
 
@@ -1186,6 +1712,26 @@ if __name__ == "__main__":
         nargs='?',
         action=AppendSort,
         help="Sort by this field, but backwards.")
+    parser.add_argument(
+        '--ops',
+        action='store_true',
+        help="Show operation counts instead of bytes.")
+    parser.add_argument(
+        '--read-sleep',
+        type=lambda x: (lambda o, b=0: (float(o), float(b)))(*x.split(',', 1)),
+        help="Model reads as taking this many seconds, optionally followed "
+            "by seconds per byte, and show the modelled device time in ns. "
+            "Accepts the same per-op delay as bench.py --read-sleep.")
+    parser.add_argument(
+        '--prog-sleep',
+        type=lambda x: (lambda o, b=0: (float(o), float(b)))(*x.split(',', 1)),
+        help="Model progs as taking this many seconds, optionally followed "
+            "by seconds per byte.")
+    parser.add_argument(
+        '--erase-sleep',
+        type=lambda x: (lambda o, b=0: (float(o), float(b)))(*x.split(',', 1)),
+        help="Model erases as taking this many seconds, optionally followed "
+            "by seconds per byte.")
     parser.add_argument(
         '-Y', '--summary',
         action='store_true',
@@ -1212,6 +1758,20 @@ if __name__ == "__main__":
         const=0,
         help="Depth of function calls to show. 0 shows all calls but may not "
             "terminate!")
+    parser.add_argument(
+        '--folded',
+        help="Write folded call-stacks to this file, one stack per line, "
+            "compatible with flamegraph.pl. Counts the first field shown.")
+    parser.add_argument(
+        '--flamegraph',
+        help="Write an SVG flamegraph to this file. Counts the first "
+            "field shown.")
+    parser.add_argument(
+        '--histogram',
+        action='store_true',
+        help="Show a histogram of operations per block, for the first "
+            "field. Combine with -D to only include call-stacks through "
+            "a given function.")
     parser.add_argument(
         '-A', '--annotate',
         action='store_true',
@@ -1253,7 +1813,8 @@ if __name__ == "__main__":
         '-W', '--width',
         type=lambda x: int(x, 0),
         default=80,
-        help="Assume source is styled with this many columns. Defaults to 80.")
+        help="Assume source is styled with this many columns. Also the "
+            "width of --histogram. Defaults to 80.")
     parser.add_argument(
         '--color',
         choices=['never', 'always', 'auto'],
@@ -1265,6 +1826,11 @@ if __name__ == "__main__":
         type=lambda x: int(x, 0),
         const=0,
         help="Number of processes to use. 0 spawns one process per core.")
+    parser.add_argument(
+        '--chunk-size',
+        type=lambda x: int(x, 0),
+        help="Size of record-aligned chunks to split traces into with -j. "
+            "Defaults to ~8 chunks per process.")
     parser.add_argument(
         '--objdump-path',
         type=lambda x: x.split(),
@@ -11,17 +11,21 @@
 
 import collections as co
 import csv
-import errno
 import glob
+import hashlib
+import io
 import itertools as it
 import math as m
+import multiprocessing as mp
 import os
-import pty
+import pickle
 import re
+import selectors
 import shlex
 import shutil
 import signal
 import subprocess as sp
+import tempfile
 import threading as th
 import time
 import toml
@@ -45,6 +49,44 @@ def openio(path, mode='r', buffering=-1):
     else:
         return open(path, mode, buffering)
 
+# permutations are kept as a list of products, one per set of defines,
+# this lets us count and index permutations without materializing
+# every combination
+class TestPermutations:
+    def __init__(self):
+        self.products = []
+
+    def append(self, defines):
+        # defines is a list of (name, values) pairs
+        self.products.append(defines)
+
+    def __len__(self):
+        return sum(m.prod(len(vs) for _, vs in defines)
+            for defines in self.products)
+
+    def __iter__(self):
+        for defines in self.products:
+            for perm in it.product(*(
+                    [(k, v) for v in vs]
+                    for k, vs in defines)):
+                yield dict(perm)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        for defines in self.products:
+            n = m.prod(len(vs) for _, vs in defines)
+            if i < n:
+                # decode i as a mixed-radix number, the last define
+                # changes fastest, matching it.product
+                perm = []
+                for k, vs in reversed(defines):
+                    i, j = divmod(i, len(vs))
+                    perm.append((k, vs[j]))
+                return dict(reversed(perm))
+            i -= n
+        raise IndexError('permutation index out of range')
+
 class TestCase:
     # create a TestCase object from a config
     def __init__(self, config, args={}):
@@ -65,7 +107,7 @@ class TestCase:
 
         # figure out defines and build possible permutations
         self.defines = set()
-        self.permutations = []
+        self.permutations = TestPermutations()
 
         # defines can be a dict or a list or dicts
         suite_defines = config.pop('suite_defines', {})
@@ -131,9 +173,9 @@ class TestCase:
             self.defines |= suite_defines_.keys()
             for defines_ in defines:
                 self.defines |= defines_.keys()
-                self.permutations.extend(dict(perm) for perm in it.product(*(
-                    [(k, v) for v in parse_define(vs)]
-                    for k, vs in sorted((suite_defines_ | defines_).items()))))
+                self.permutations.append([
+                    (k, list(parse_define(vs)))
+                    for k, vs in sorted((suite_defines_ | defines_).items())])
 
         for k in config.keys():
             print('%swarning:%s in %s, found unused key %r' % (
@@ -230,6 +272,111 @@ class TestSuite:
 
 
 
+# parsed suites are cached keyed by a hash of the toml file and this
+# script, toml parsing dominates compile time otherwise
+def load_suite(path, args={}):
+    cache_path = None
+    if args.get('cache'):
+        name = os.path.basename(path)
+        if name.endswith('.toml'):
+            name = name[:-len('.toml')]
+        cache_path = os.path.join(args['cache'], '%s.t.suite' % name)
+
+        hash = hashlib.sha1()
+        for path_ in [__file__, path]:
+            hash.update(path_.encode())
+            with open(path_, 'rb') as f:
+                hash.update(f.read())
+        hash = hash.hexdigest()
+
+        try:
+            with open(cache_path, 'rb') as f:
+                hash_, suite = pickle.load(f)
+            if hash_ == hash:
+                return suite
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    suite = TestSuite(path, args)
+
+    if cache_path:
+        # write to a temporary file first, other compiles may be loading
+        # the same suite in parallel
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb',
+                dir=os.path.dirname(cache_path) or '.',
+                prefix=os.path.basename(cache_path)+'.',
+                delete=False) as f:
+            pickle.dump((hash, suite), f)
+        os.replace(f.name, cache_path)
+
+    return suite
+
+def load_suites(paths, **args):
+    # parse suites in parallel?
+    jobs = args.get('jobs', 1)
+    if jobs == 0:
+        jobs = len(os.sched_getaffinity(0))
+    if jobs > 1 and len(paths) > 1:
+        with mp.Pool(min(jobs, len(paths))) as p:
+            return p.starmap(load_suite,
+                [(path, args) for path in paths])
+    else:
+        return [load_suite(path, args) for path in paths]
+
+
+# hash everything that can change the generated source, including this
+# script, so we can skip regenerating sources when nothing changed
+def compile_hash(paths, **args):
+    hash = hashlib.sha1()
+    hash.update(repr(sys.argv[1:]).encode())
+    for path in [__file__] + paths + (
+            [args['source']] if args.get('source') else []):
+        hash.update(path.encode())
+        with open(path, 'rb') as f:
+            hash.update(f.read())
+    return hash.hexdigest()
+
+def compile_cached(path, hash):
+    # the hash is stored in the header of the generated source
+    try:
+        with open(path) as f:
+            for line in it.islice(f, 8):
+                if line == '// input hash: %s\n' % hash:
+                    return True
+    except FileNotFoundError:
+        pass
+    return False
+
+def compile_write(path, source):
+    if path == '-':
+        with openio(path, 'w') as f:
+            f.write(source)
+        return
+
+    # if only the hash changed, we still update the hash but leave the
+    # mtime alone, this keeps make from rebuilding anything that depends
+    # on the generated source
+    def strip_hash(source):
+        return [line for line in source.splitlines()
+            if not line.startswith('// input hash: ')]
+
+    try:
+        with open(path) as f:
+            old = f.read()
+        st = os.stat(path)
+    except FileNotFoundError:
+        old = None
+
+    if old == source:
+        return
+
+    with openio(path, 'w') as f:
+        f.write(source)
+
+    if old is not None and strip_hash(old) == strip_hash(source):
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
 def compile(test_paths, **args):
     # find .toml files
     paths = []
@@ -244,8 +391,15 @@ def compile(test_paths, **args):
         print('no test suites found in %r?' % test_paths)
         sys.exit(-1)
 
+    # nothing changed since we last generated our output?
+    hash = None
+    if args.get('output', '-') != '-':
+        hash = compile_hash(paths, **args)
+        if compile_cached(args['output'], hash):
+            return
+
     # load the suites
-    suites = [TestSuite(path, args) for path in paths]
+    suites = load_suites(paths, **args)
     suites.sort(key=lambda s: s.name)
 
     # check for name conflicts, these will cause ambiguity problems later
@@ -286,7 +440,7 @@ def compile(test_paths, **args):
 
     # write generated test source
     if 'output' in args:
-        with openio(args['output'], 'w') as f:
+        with io.StringIO() as f:
             _write = f.write
             def write(s):
                 f.lineno += s.count('\n')
@@ -303,6 +457,9 @@ def compile(test_paths, **args):
             f.writeln("//")
             f.writeln("// %s" % ' '.join(sys.argv))
             f.writeln("//")
+            if hash is not None:
+                f.writeln("// input hash: %s" % hash)
+                f.writeln("//")
             f.writeln()
 
             # include test_runner.h in every generated file
@@ -507,6 +664,9 @@ def compile(test_paths, **args):
                                     f.writeln('#endif')
                                 f.writeln()
 
+            # only write if something changed
+            compile_write(args['output'], f.getvalue())
+
 def find_runner(runner, **args):
     cmd = runner.copy()
 
@@ -551,6 +711,8 @@ def find_runner(runner, **args):
         cmd.append('--trace-period=%s' % args['trace_period'])
     if args.get('trace_freq'):
         cmd.append('--trace-freq=%s' % args['trace_freq'])
+    if args.get('trace_binary'):
+        cmd.append('--trace-binary')
     if args.get('read_sleep'):
         cmd.append('--read-sleep=%s' % args['read_sleep'])
     if args.get('prog_sleep'):
@@ -590,6 +752,8 @@ def find_perms(runner_, ids=[], **args):
     expected_case_perms = co.defaultdict(lambda: 0)
     expected_perms = 0
     total_perms = 0
+    # steps per case, in the order the runner steps through them
+    case_steps = []
 
     # query cases from the runner
     cmd = runner_ + ['--list-cases'] + ids
@@ -614,6 +778,7 @@ def find_perms(runner_, ids=[], **args):
             expected_case_perms[m.group('case')] += filtered
             expected_perms += filtered
             total_perms += perms
+            case_steps.append((m.group('case'), perms))
     proc.wait()
     if proc.returncode != 0:
         if not args.get('verbose'):
@@ -661,7 +826,8 @@ def find_perms(runner_, ids=[], **args):
         expected_suite_perms,
         expected_case_perms,
         expected_perms,
-        total_perms)
+        total_perms,
+        case_steps)
 
 def find_path(runner_, id, **args):
     path = None
@@ -694,9 +860,9 @@ def find_path(runner_, id, **args):
 
     return path
 
-def find_defines(runner_, id, **args):
+def find_defines(runner_, ids=[], **args):
     # query permutation defines from runner
-    cmd = runner_ + ['--list-permutation-defines', id]
+    cmd = runner_ + ['--list-permutation-defines'] + ids
     if args.get('verbose'):
         print(' '.join(shlex.quote(c) for c in cmd))
     proc = sp.Popen(cmd,
@@ -722,41 +888,165 @@ def find_defines(runner_, id, **args):
 
     return defines
 
+# parse a status record from the runner's status fd, returning op, id, and
+# any key=value fields, or None if the record isn't understood
+#
+# ops are shortened to their first letter on the status fd
+STATUS_OPS = {
+    'r': 'running',
+    'f': 'finished',
+    's': 'skipped',
+    'p': 'powerloss',
+    'e': 'exited'}
+
+def parse_status(record):
+    op = STATUS_OPS.get(record[:1])
+    if op is None:
+        return None
+    fields_ = record[1:].split()
+    if not fields_:
+        return None
+    fields = {}
+    for field in fields_[1:]:
+        k, eq, v = field.partition('=')
+        if not eq:
+            return None
+        fields[k] = v
+    return op, fields_[0], fields
+
+# find the last assert in some runner output, we only need to look for these
+# after a failure
+ASSERT_PATTERN = re.compile(
+    '^(?P<path>[^:]+):(?P<lineno>\d+):assert: *(?P<message>.*)$')
+
+def find_assert(lines):
+    for line in reversed(lines):
+        if ':assert:' in line:
+            m = ASSERT_PATTERN.match(line.rstrip('\n'))
+            if m:
+                return (
+                    m.group('path'),
+                    int(m.group('lineno')),
+                    m.group('message'))
+    return None
+
+# spawn a runner with stdout/stderr merged into one pipe and status
+# reported on a separate pipe
+#
+# the status pipe needs to be inheritable, so we serialize spawns to keep
+# it from leaking into other runners
+spawn_lock = th.Lock()
+
+def spawn_runner(cmd, **kwargs):
+    out_r, out_w = os.pipe()
+    status_r, status_w = os.pipe()
+    with spawn_lock:
+        os.set_inheritable(status_w, True)
+        try:
+            proc = sp.Popen(cmd + ['--status-fd=%d' % status_w],
+                stdout=out_w,
+                stderr=out_w,
+                close_fds=False,
+                **kwargs)
+        finally:
+            os.close(out_w)
+            os.close(status_w)
+    # we read stdout whenever it's available, and drain it before some
+    # status records, so this must not block
+    os.set_blocking(out_r, False)
+    return proc, out_r, status_r
+
 
-# Thread-safe CSV writer
+# Thread-safe streaming CSV writer
+#
+# Rows are written out immediately and not kept in memory, so the expected
+# columns should be provided up front. If a row introduces a new column, we
+# append it to the on-disk columns and rewrite the file once on close.
 class TestOutput:
     def __init__(self, path, head=None, tail=None):
-        self.f = openio(path, 'w+', 1)
+        self.path = path
+        self.f = openio(path, 'w', 1)
         self.lock = th.Lock()
         self.head = head or []
         self.tail = tail or []
-        self.writer = csv.DictWriter(self.f, self.head + self.tail)
-        self.rows = []
+        self.fields = self.head + self.tail
+        self.seen = set(self.fields)
+        self.dirty = False
+        self.writer = csv.DictWriter(self.f, self.fields)
+        self.writer.writeheader()
 
     def close(self):
         self.f.close()
 
+        # found new columns? rewrite the file with the correct header
+        if self.dirty and self.path != '-':
+            dir = os.path.dirname(self.path) or '.'
+            with open(self.path) as rf, \
+                    tempfile.NamedTemporaryFile('w',
+                        dir=dir, delete=False) as wf:
+                reader = csv.reader(rf)
+                # skip the old header
+                next(reader)
+                writer = csv.DictWriter(wf, self.head + self.tail)
+                writer.writeheader()
+                for row in reader:
+                    # rows written before a column was found are shorter
+                    writer.writerow(dict(zip(self.fields, row)))
+            shutil.copymode(self.path, wf.name)
+            os.replace(wf.name, self.path)
+
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        self.f.close()
+        self.close()
 
     def writerow(self, row):
         with self.lock:
-            self.rows.append(row)
-            if all(k in self.head or k in self.tail for k in row.keys()):
-                # can simply append
-                self.writer.writerow(row)
-            else:
-                # need to rewrite the file
-                self.head.extend(row.keys() - (self.head + self.tail))
-                self.f.seek(0)
-                self.f.truncate()
-                self.writer = csv.DictWriter(self.f, self.head + self.tail)
-                self.writer.writeheader()
-                for row in self.rows:
-                    self.writer.writerow(row)
+            new = [k for k in row.keys() if k not in self.seen]
+            if new:
+                # append new columns for now, we fix the header on close
+                self.head.extend(new)
+                self.fields.extend(new)
+                self.seen.update(new)
+                self.dirty = True
+                self.writer = csv.DictWriter(self.f, self.fields)
+            self.writer.writerow(row)
+
+# Permutation runtimes from previous runs
+#
+# These are only used for scheduling, so a missing or stale file is
+# harmless, we just lose the ordering hints.
+# timings map each permutation id to its runtime summed over all of its
+# steps (power-loss scenarios), and the number of steps
+def load_timings(path):
+    timings = {}
+    try:
+        with openio(path) as f:
+            for row in csv.DictReader(f):
+                try:
+                    timings[row['id']] = (
+                        float(row['test_time']),
+                        int(row.get('test_steps') or 1))
+                except (KeyError, TypeError, ValueError):
+                    pass
+    except FileNotFoundError:
+        pass
+    return timings
+
+def save_timings(path, timings):
+    # write to a temporary file first so a killed run doesn't leave us
+    # with a truncated database
+    dir = os.path.dirname(path) or '.'
+    with tempfile.NamedTemporaryFile('w', dir=dir, delete=False) as f:
+        writer = csv.DictWriter(f, ['id', 'test_time', 'test_steps'])
+        writer.writeheader()
+        for id, (time_, steps) in sorted(timings.items()):
+            writer.writerow({
+                'id': id,
+                'test_time': '%.6f' % time_,
+                'test_steps': steps})
+    os.replace(f.name, path)
 
 # A test failure
 class TestFailure(Exception):
@@ -766,13 +1056,45 @@ class TestFailure(Exception):
         self.stdout = stdout
         self.assert_ = assert_
 
-def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
+# State for one job, this is either a runner working through a chunk of
+# permutations, or a persistent worker with --isolate/--valgrind
+class TestJob:
+    def __init__(self):
+        self.proc = None
+        self.out_fd = None
+        self.status_fd = None
+        self.status = b''
+        self.chunk = None
+        self.seen_perms = 0
+        self.start_time = None
+        self.last_id = None
+        self.last_time = None
+        self.last_stdout = bytearray()
+        self.epoch = 0
+        self.last_line = bytearray()
+
+def run_stage(name, runner_, ids, stdout_, trace_, output_, timings_,
+        **args):
     # get expected suite/case/perm counts
     (case_suites,
         expected_suite_perms,
         expected_case_perms,
         expected_perms,
-        total_perms) = find_perms(runner_, ids, **args)
+        total_perms,
+        case_steps) = find_perms(runner_, ids, **args)
+
+    # measured runtime of each permutation, note this includes all
+    # power-loss scenarios of the permutation, so also keep track of how
+    # many steps that was
+    perm_times = co.defaultdict(lambda: 0.0)
+    perm_steps = co.defaultdict(lambda: 0)
+
+    # if we're writing to a csv, the runner reports defines inline with
+    # --status-format=kv, we just need to keep track of them for failures
+    #
+    # note power-loss cycles don't affect defines, so these are keyed by
+    # case:perm
+    perm_defines = {}
 
     passed_suite_perms = co.defaultdict(lambda: 0)
     passed_case_perms = co.defaultdict(lambda: 0)
@@ -781,169 +1103,367 @@ def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
     failures = []
     killed = False
 
-    pattern = re.compile('^(?:'
-            '(?P<op>running|finished|skipped|powerloss) '
-                '(?P<id>(?P<case>[^:]+)[^\s]*)'
-            '|' '(?P<path>[^:]+):(?P<lineno>\d+):(?P<op_>assert):'
-                ' *(?P<message>.*)'
-        ')$')
-    locals = th.local()
-    children = set()
-
-    def run_runner(runner_, ids=[]):
-        nonlocal passed_suite_perms
-        nonlocal passed_case_perms
-        nonlocal passed_perms
-        nonlocal powerlosses
-        nonlocal locals
+    # permutations are handed out to jobs in chunks from a shared queue of
+    # step ranges, so jobs that finish early steal work instead of sitting
+    # idle
+    jobs = args.get('jobs', 1)
+    isolate = args.get('isolate') or args.get('valgrind')
+    remaining_perms = total_perms
+    perm_time = 0.0
+    perm_count = 0
+
+    # seed our runtime estimate with previous runs, so chunks are a
+    # reasonable size before any of our own measurements come in
+    #
+    # note chunks are measured in steps, not permutations
+    if timings_:
+        for id, (time_, steps) in timings_.items():
+            if id.split(':', 1)[0] in expected_case_perms:
+                perm_time += time_
+                perm_count += steps
+
+    # hand out the longest cases first, so a long case doesn't end up
+    # running alone at the end of the stage, cases we have no history for
+    # may be long, so they go first
+    ranges = []
+    step = 0
+    for case, steps in case_steps:
+        ranges.append((case, step, step+steps))
+        step += steps
+
+    if timings_:
+        case_times = co.defaultdict(lambda: 0.0)
+        for id, (time_, _) in timings_.items():
+            case_times[id.split(':', 1)[0]] += time_
+        ranges.sort(
+            key=lambda r: case_times.get(r[0], m.inf),
+            reverse=True)
+
+    # merge ranges that are still contiguous, so chunks can span cases
+    pending = co.deque()
+    for _, start, stop in ranges:
+        if start == stop:
+            continue
+        if pending and pending[-1][1] == start:
+            pending[-1][1] = stop
+        else:
+            pending.append([start, stop])
 
-        # run the tests!
-        cmd = runner_ + ids
-        if args.get('verbose'):
-            print(' '.join(shlex.quote(c) for c in cmd))
+    def next_chunk():
+        nonlocal remaining_perms
 
-        mpty, spty = pty.openpty()
-        proc = sp.Popen(cmd, stdout=spty, stderr=spty, close_fds=False)
-        os.close(spty)
-        children.add(proc)
-        mpty = os.fdopen(mpty, 'r', 1)
+        if not pending:
+            return None
 
-        last_id = None
-        last_stdout = co.deque(maxlen=args.get('context', 5) + 1)
-        last_assert = None
-        try:
-            while True:
-                # parse a line for state changes
-                try:
-                    line = mpty.readline()
-                except OSError as e:
-                    if e.errno != errno.EIO:
-                        raise
-                    break
-                if not line:
-                    break
-                last_stdout.append(line)
-                if stdout_:
+        if isolate:
+            size = 1
+        elif jobs == 1:
+            size = remaining_perms
+        else:
+            # guided scheduling, chunks shrink as we run out of work so
+            # the last jobs finish at roughly the same time
+            size = m.ceil(remaining_perms / (2*jobs))
+            # but don't let chunks get so small runner startup
+            # dominates, aim for chunks that take at least ~100ms
+            if perm_time > 0:
+                size = max(size, m.ceil(0.1 / (perm_time/perm_count)))
+            size = min(size, remaining_perms)
+
+        # chunks don't span non-contiguous ranges
+        start, stop = pending[0]
+        size = min(size, stop-start)
+        if start+size < stop:
+            pending[0][0] = start+size
+        else:
+            pending.popleft()
+        remaining_perms -= size
+        return start, start+size
+
+    # all runners are multiplexed in one event loop, so we don't need a
+    # thread per job
+    sel = selectors.DefaultSelector()
+    jobs_ = [TestJob() for _ in range(jobs)]
+    dirty = False
+
+    def stdout_lines(stdout):
+        return stdout.decode(errors='replace').splitlines(keepends=True)[
+            -(args.get('context', 5) + 1):]
+
+    def start_proc(job, cmd, **kwargs):
+        if args.get('verbose'):
+            print(' '.join(shlex.quote(c) for c in cmd))
+        job.proc, job.out_fd, job.status_fd = spawn_runner(cmd, **kwargs)
+        job.status = b''
+        sel.register(job.out_fd, selectors.EVENT_READ, (job, 'stdout'))
+        sel.register(job.status_fd, selectors.EVENT_READ, (job, 'status'))
+
+    def stop_proc(job):
+        if job.proc is None:
+            return
+        if job.proc.stdin:
+            try:
+                job.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for fd in [job.out_fd, job.status_fd]:
+            if fd in sel.get_map():
+                sel.unregister(fd)
+            os.close(fd)
+        job.proc.wait()
+        returncode = job.proc.returncode
+        job.proc = None
+        return returncode
+
+    def kill_all():
+        for job in jobs_:
+            if job.proc:
+                if isolate:
+                    # workers fork for each request, so kill the whole
+                    # process group, otherwise the forked child keeps our
+                    # pipes open until it finishes
                     try:
-                        stdout_.write(line)
-                        stdout_.flush()
-                    except BrokenPipeError:
+                        os.killpg(job.proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
                         pass
-
-                m = pattern.match(line)
-                if m:
-                    op = m.group('op') or m.group('op_')
-                    if op == 'running':
-                        locals.seen_perms += 1
-                        last_id = m.group('id')
-                        last_stdout.clear()
-                        last_assert = None
-                    elif op == 'powerloss':
-                        last_id = m.group('id')
-                        powerlosses += 1
-                    elif op == 'finished':
-                        case = m.group('case')
-                        suite = case_suites[case]
-                        passed_suite_perms[suite] += 1
-                        passed_case_perms[case] += 1
-                        passed_perms += 1
-                        if output_:
-                            # get defines and write to csv
-                            defines = find_defines(
-                                runner_, m.group('id'), **args)
-                            output_.writerow({
-                                'suite': suite,
-                                'case': case,
-                                'test_passed': '1/1',
-                                **defines})
-                    elif op == 'skipped':
-                        locals.seen_perms += 1
-                    elif op == 'assert':
-                        last_assert = (
-                            m.group('path'),
-                            int(m.group('lineno')),
-                            m.group('message'))
-                        # go ahead and kill the process, aborting takes a while
-                        if args.get('keep_going'):
-                            proc.kill()
-        except KeyboardInterrupt:
-            raise TestFailure(last_id, 1, list(last_stdout))
-        finally:
-            children.remove(proc)
-            mpty.close()
-
-        proc.wait()
-        if proc.returncode != 0:
-            raise TestFailure(
-                last_id,
-                proc.returncode,
-                list(last_stdout),
-                last_assert)
-
-    def run_job(runner_, ids=[], start=None, step=None):
-        nonlocal failures
+                else:
+                    job.proc.kill()
+
+    def start_chunk(job):
+        # find more work for this job
+        if job.chunk is None and not killed:
+            job.chunk = next_chunk()
+        if job.chunk is None or killed:
+            job.chunk = None
+            stop_proc(job)
+            return
+        start, stop = job.chunk
+
+        # each chunk runs in a fresh process, or a fresh fork of our worker,
+        # so any output from here on belongs to this chunk
+        job.epoch += 1
+        job.seen_perms = 0
+        job.start_time = time.time()
+        job.last_id = None
+        job.last_stdout.clear()
+
+        if isolate:
+            # with --isolate/--valgrind every permutation needs its own
+            # process, instead of exec-ing a new runner for each one, we
+            # keep a worker per job that forks for each request
+            if job.proc is None:
+                cmd = runner_ + ['--worker'] + ids
+                if output_:
+                    cmd.append('--status-format=kv')
+                start_proc(job, cmd, stdin=sp.PIPE, text=True,
+                    start_new_session=True)
+            try:
+                job.proc.stdin.write('%d,%d\n' % (start, stop))
+                job.proc.stdin.flush()
+            except BrokenPipeError:
+                # worker was killed, we'll notice when its status closes
+                pass
+        else:
+            # run the tests!
+            cmd = runner_ + ['-s%s,%s' % (start, stop)]
+            if output_:
+                cmd.append('--status-format=kv')
+            start_proc(job, cmd + ids)
+
+    def finish_chunk(job, returncode):
+        nonlocal dirty
         nonlocal killed
-        nonlocal locals
-
-        start = start or 0
-        step = step or 1
-        while start < total_perms:
-            job_runner = runner_.copy()
-            if args.get('isolate') or args.get('valgrind'):
-                job_runner.append('-s%s,%s,%s' % (start, start+step, step))
-            else:
-                job_runner.append('-s%s,,%s' % (start, step))
+        nonlocal perm_time
+        nonlocal perm_count
+
+        dirty = True
+        start, stop = job.chunk
+        if returncode == 0:
+            assert job.seen_perms > 0
+            perm_time += time.time() - job.start_time
+            perm_count += job.seen_perms
+
+            start += job.seen_perms
+            job.chunk = (start, stop) if start < stop else None
+            return
+
+        # killed after another failure, or before any permutation started?
+        # there's nothing to report
+        if killed and (failures or job.last_id is None):
+            job.chunk = None
+            return
+
+        # only show output from the failing permutation, the runner marks
+        # where each permutation starts with a running line in stdout
+        stdout = job.last_stdout
+        i = stdout.rfind(b'\nrunning ')
+        if i >= 0 or stdout.startswith(b'running '):
+            j = stdout.find(b'\n', i+1)
+            stdout = stdout[j+1:] if j >= 0 else b''
+        stdout = stdout_lines(stdout)
+        failure = TestFailure(
+            job.last_id,
+            returncode,
+            stdout,
+            find_assert(stdout))
+
+        # keep track of failures, but don't write rows for permutations
+        # we killed
+        if output_ and not killed:
+            case, _ = failure.id.split(':', 1)
+            suite = case_suites[case]
+            # get defines and write to csv, these are usually reported
+            # when the permutation starts running, but if we never saw
+            # that we need to ask the runner
+            id = ':'.join(failure.id.split(':', 2)[:2])
+            defines = perm_defines.get(id)
+            if defines is None:
+                defines = find_defines(runner_, [id], **args)
+            output_.writerow({
+                'suite': suite,
+                'case': case,
+                'test_passed': '0/1',
+                **defines})
+
+        # multiple failures?
+        if failures and not args.get('keep_going'):
+            job.chunk = None
+            return
+
+        failures.append(failure)
+
+        if args.get('keep_going') and not killed:
+            # resume after failed test
+            assert job.seen_perms > 0
+            start += job.seen_perms
+            job.chunk = (start, stop) if start < stop else None
+        else:
+            # stop other tests
+            killed = True
+            job.chunk = None
+            kill_all()
+
+    def read_stdout(job):
+        # returns None if there's nothing to read, False on EOF
+        if job.out_fd not in sel.get_map():
+            return False
+        try:
+            data = os.read(job.out_fd, 65536)
+        except BlockingIOError:
+            return None
+        if not data:
+            sel.unregister(job.out_fd)
+            return False
+
+        job.last_stdout.extend(data)
+        if len(job.last_stdout) > 2*65536:
+            del job.last_stdout[:-65536]
+
+        # go ahead and kill the process, aborting takes a while,
+        # workers fork so we can't kill just this permutation
+        if (b':assert:' in data
+                and args.get('keep_going')
+                and not isolate):
+            job.proc.kill()
+
+        # only copy complete lines so parallel jobs don't interleave
+        # mid-line
+        if stdout_:
+            job.last_line.extend(data)
+            i = job.last_line.rfind(b'\n')
+            if i >= 0:
+                write_stdout(job.last_line[:i+1].decode(errors='replace'))
+                del job.last_line[:i+1]
+        return True
+
+    def write_stdout(s):
+        try:
+            stdout_.write(s)
+            stdout_.flush()
+        except BrokenPipeError:
+            pass
 
-            try:
-                # run the tests
-                locals.seen_perms = 0
-                run_runner(job_runner, ids)
-                assert locals.seen_perms > 0
-                start += locals.seen_perms*step
-
-            except TestFailure as failure:
-                # keep track of failures
+    def read_status(job):
+        nonlocal passed_perms
+        nonlocal powerlosses
+        nonlocal dirty
+
+        data = os.read(job.status_fd, 4096)
+        if not data:
+            # runner exited, pick up any output it left behind
+            while read_stdout(job):
+                pass
+            if stdout_ and job.last_line:
+                write_stdout(job.last_line.decode(errors='replace'))
+                job.last_line.clear()
+            returncode = stop_proc(job)
+            # if a worker exits early something went very wrong, make
+            # sure this is reported as a failure
+            if isolate and returncode == 0:
+                returncode = -1
+            finish_chunk(job, returncode)
+            start_chunk(job)
+            return
+
+        job.status += data
+        *records, job.status = job.status.split(b'\n')
+        for record in records:
+            status = parse_status(record.decode(errors='replace'))
+            if not status:
+                continue
+            op, id, fields = status
+            dirty = True
+
+            # stdout and status are separate pipes with no ordering
+            # between them, but the runner flushes stdout before each
+            # status record, so draining stdout here means any output
+            # before this record is already in our buffer
+            while read_stdout(job):
+                pass
+
+            # keep status lines in our stdout log, these are useful for
+            # figuring out which output is which, note running lines are
+            # already in stdout
+            if stdout_ and op not in {'running', 'exited'}:
+                write_stdout('%s %s\n' % (
+                    op,
+                    record[1:].decode(errors='replace')))
+
+            if op == 'running':
+                job.seen_perms += 1
+                job.last_id = id
+                job.last_time = time.time()
+                if output_:
+                    perm_defines[':'.join(id.split(':', 2)[:2])] = fields
+            elif op == 'powerloss':
+                job.last_id = id
+                powerlosses += 1
+            elif op == 'finished':
+                if job.last_time is not None:
+                    perm_times[id] += time.time() - job.last_time
+                    perm_steps[id] += 1
+                    job.last_time = None
+                case = id.split(':', 1)[0]
+                suite = case_suites[case]
+                passed_suite_perms[suite] += 1
+                passed_case_perms[case] += 1
+                passed_perms += 1
                 if output_:
-                    case, _ = failure.id.split(':', 1)
-                    suite = case_suites[case]
-                    # get defines and write to csv
-                    defines = find_defines(runner_, failure.id, **args)
+                    # defines are reported inline, write to csv
                     output_.writerow({
                         'suite': suite,
                         'case': case,
-                        'test_passed': '0/1',
-                        **defines})
-
-                # race condition for multiple failures?
-                if failures and not args.get('keep_going'):
-                    break
-
-                failures.append(failure)
-
-                if args.get('keep_going') and not killed:
-                    # resume after failed test
-                    assert locals.seen_perms > 0
-                    start += locals.seen_perms*step
-                    continue
-                else:
-                    # stop other tests
-                    killed = True
-                    for child in children.copy():
-                        child.kill()
-                    break
-
-
-    # parallel jobs?
-    runners = []
-    if 'jobs' in args:
-        for job in range(args['jobs']):
-            runners.append(th.Thread(
-                target=run_job, args=(runner_, ids, job, args['jobs']),
-                daemon=True))
-    else:
-        runners.append(th.Thread(
-            target=run_job, args=(runner_, ids, None, None),
-            daemon=True))
+                        'test_passed': '1/1',
+                        **fields})
+            elif op == 'skipped':
+                job.seen_perms += 1
+            elif op == 'exited':
+                if stdout_ and job.last_line:
+                    write_stdout(job.last_line.decode(errors='replace'))
+                    job.last_line.clear()
+                finish_chunk(job, int(id))
+                start_chunk(job)
+                # nothing should follow until our next request
+                break
 
     def print_update(done):
         if not args.get('verbose') and (args['color'] or done):
@@ -978,28 +1498,59 @@ def run_stage(name, runner_, ids, stdout_, trace_, output_, **args):
                 '\x1b[?7h' if not done else '\n'))
             sys.stdout.flush()
 
-    for r in runners:
-        r.start()
+    for job in jobs_:
+        start_chunk(job)
 
+    # only redraw when something changes, and at most every 10ms
+    last_update = 0
     try:
-        while any(r.is_alive() for r in runners):
-            time.sleep(0.01)
-            print_update(False)
-    except KeyboardInterrupt:
-        # this is handled by the runner threads, we just
-        # need to not abort here
-        killed = True
+        while sel.get_map():
+            timeout = None
+            if dirty:
+                timeout = max(0, last_update+0.01 - time.time())
+            try:
+                events = sel.select(timeout)
+            except KeyboardInterrupt:
+                # the runners see this too, except for workers which are in
+                # their own session, we just need to make sure they stop and
+                # not abort here
+                killed = True
+                kill_all()
+                continue
+
+            epochs = {key.fd: key.data[0].epoch for key, _ in events}
+            for key, _ in events:
+                # skip events for runners we've already cleaned up
+                if sel.get_map().get(key.fd) is not key:
+                    continue
+                job, kind = key.data
+                # skip stale events if this job has moved on to a new chunk
+                if job.epoch != epochs[key.fd]:
+                    continue
+                if kind == 'stdout':
+                    read_stdout(job)
+                else:
+                    read_status(job)
+
+            if dirty and time.time() >= last_update+0.01:
+                print_update(False)
+                dirty = False
+                last_update = time.time()
     finally:
+        # make sure nothing is left running if something went wrong
+        kill_all()
+        for job in jobs_:
+            stop_proc(job)
+        sel.close()
         print_update(True)
 
-    for r in runners:
-        r.join()
-
     return (
         expected_perms,
         passed_perms,
         powerlosses,
         failures,
+        perm_times,
+        perm_steps,
         killed)
 
 
@@ -1007,11 +1558,12 @@ def run(runner, test_ids=[], **args):
     # query runner for tests
     runner_ = find_runner(runner, **args)
     print('using runner: %s' % ' '.join(shlex.quote(c) for c in runner_))
-    (_,
+    (case_suites,
         expected_suite_perms,
         expected_case_perms,
         expected_perms,
-        total_perms) = find_perms(runner_, test_ids, **args)
+        total_perms,
+        _) = find_perms(runner_, test_ids, **args)
     print('found %d suites, %d cases, %d/%d permutations' % (
         len(expected_suite_perms),
         len(expected_case_perms),
@@ -1019,6 +1571,13 @@ def run(runner, test_ids=[], **args):
         total_perms))
     print()
 
+    # load permutation runtimes from previous runs
+    timings_path = None
+    timings = {}
+    if not args.get('no_timings'):
+        timings_path = args.get('timings') or '%s.timings.csv' % runner[0]
+        timings = load_timings(timings_path)
+
     # automatic job detection?
     if args.get('jobs') == 0:
         args['jobs'] = len(os.sched_getaffinity(0))
@@ -1032,27 +1591,37 @@ def run(runner, test_ids=[], **args):
         trace = openio(args['trace'], 'w', 1)
     output = None
     if args.get('output'):
+        # find permutation defines up front so we know our columns before
+        # we start streaming results
+        defines = find_defines(runner_, test_ids, **args)
         output = TestOutput(args['output'],
-            ['suite', 'case'],
+            ['suite', 'case'] + list(defines.keys()),
             ['test_passed'])
 
     # measure runtime
     start = time.time()
 
+    # figure out our stages
+    stages = (test_ids if test_ids
+        else list(expected_case_perms.keys()) if args.get('by_cases')
+        else list(expected_suite_perms.keys()) if args.get('by_suites')
+        else [None])
+
     # spawn runners
     expected = 0
     passed = 0
     powerlosses = 0
     failures = []
-    for by in (test_ids if test_ids
-            else expected_case_perms.keys() if args.get('by_cases')
-            else expected_suite_perms.keys() if args.get('by_suites')
-            else [None]):
+    perm_times = {}
+    perm_steps = {}
+    for by in stages:
         # spawn jobs for stage
         (expected_,
             passed_,
             powerlosses_,
             failures_,
+            perm_times_,
+            perm_steps_,
             killed) = run_stage(
                 by or 'tests',
                 runner_,
@@ -1060,17 +1629,35 @@ def run(runner, test_ids=[], **args):
                 stdout,
                 trace,
                 output,
+                timings,
                 **args)
         # collect passes/failures
         expected += expected_
         passed += passed_
         powerlosses += powerlosses_
         failures.extend(failures_)
+        perm_times.update(perm_times_)
+        perm_steps.update(perm_steps_)
         if (failures and not args.get('keep_going')) or killed:
             break
 
     stop = time.time()
 
+    # update our runtime database, permutations we didn't run this time
+    # keep their old runtimes
+    if timings_path and perm_times:
+        timings.update((id, (time_, perm_steps[id]))
+            for id, time_ in perm_times.items())
+        try:
+            save_timings(timings_path, timings)
+        except OSError as e:
+            print('%swarning:%s could not write %s: %s' % (
+                '\x1b[01;33m' if args['color'] else '',
+                '\x1b[m' if args['color'] else '',
+                timings_path,
+                e.strerror),
+                file=sys.stderr)
+
     if stdout:
         try:
             stdout.close()
@@ -1097,6 +1684,16 @@ def run(runner, test_ids=[], **args):
             'in %.2fs' % (stop-start)]))))
     print()
 
+    # show the slowest permutations?
+    if args.get('slowest') and perm_times:
+        print('slowest permutations:')
+        for id, time_ in sorted(
+                perm_times.items(),
+                key=lambda p: p[1],
+                reverse=True)[:args['slowest']]:
+            print('%8.2fs  %s' % (time_, id))
+        print()
+
     # print each failure
     for failure in failures:
         assert failure.id is not None, '%s broken? %r' % (
@@ -1105,7 +1702,7 @@ def run(runner, test_ids=[], **args):
 
         # get some extra info from runner
         path, lineno = find_path(runner_, failure.id, **args)
-        defines = find_defines(runner_, failure.id, **args)
+        defines = find_defines(runner_, [failure.id], **args)
 
         # show summary of failure
         print('%s%s:%d:%sfailure:%s %s%s failed' % (
@@ -1334,6 +1931,11 @@ if __name__ == "__main__":
     test_parser.add_argument(
         '--trace-freq',
         help="Sample trace output at this frequency in hz.")
+    test_parser.add_argument(
+        '--trace-binary',
+        action='store_true',
+        help="Write block device operations to the trace in a compact "
+            "binary format.")
     test_parser.add_argument(
         '-O', '--stdout',
         help="Direct stdout to this file. Note stderr is already merged here.")
@@ -1371,6 +1973,21 @@ if __name__ == "__main__":
         '-B', '--by-cases',
         action='store_true',
         help="Step through tests by case.")
+    test_parser.add_argument(
+        '--timings',
+        help="CSV file to store permutation runtimes in. These are used to "
+            "run the longest tests first. Defaults to the runner path "
+            "with .timings.csv appended.")
+    test_parser.add_argument(
+        '--no-timings',
+        action='store_true',
+        help="Don't read or write permutation runtimes.")
+    test_parser.add_argument(
+        '--slowest',
+        nargs='?',
+        type=lambda x: int(x, 0),
+        const=10,
+        help="Show the slowest permutations after running. Defaults to 10.")
     test_parser.add_argument(
         '--context',
         type=lambda x: int(x, 0),
@@ -1427,7 +2044,8 @@ if __name__ == "__main__":
     test_parser.add_argument(
         '-p', '--perf',
         help="Run under Linux's perf to sample performance counters, writing "
-            "samples to this file.")
+            "samples to this file. A trailing slash writes samples to "
+            "separate files in this directory instead.")
     test_parser.add_argument(
         '--perf-freq',
         help="perf sampling frequency. This is passed directly to the perf "
@@ -1473,6 +2091,9 @@ if __name__ == "__main__":
     comp_parser.add_argument(
         '-o', '--output',
         help="Output file.")
+    comp_parser.add_argument(
+        '--cache',
+        help="Directory to cache parsed test suites in.")
 
     # runner/test_paths overlap, so need to do some munging here
     args = parser.parse_intermixed_args()
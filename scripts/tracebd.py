@@ -9,14 +9,17 @@
 # SPDX-License-Identifier: BSD-3-Clause
 #
 
+import array
 import collections as co
 import functools as ft
 import io
 import itertools as it
 import math as m
+import mmap
 import os
 import re
 import shutil
+import struct
 import threading as th
 import time
 
@@ -44,13 +47,91 @@ CHARS_BRAILLE = (
 def openio(path, mode='r', buffering=-1):
     # allow '-' for stdin/stdout
     if path == '-':
-        if mode == 'r':
+        if 'r' in mode:
             return os.fdopen(os.dup(sys.stdin.fileno()), mode, buffering)
         else:
             return os.fdopen(os.dup(sys.stdout.fileno()), mode, buffering)
     else:
         return open(path, mode, buffering)
 
+# binary block device traces, these are written by the test/bench runners
+# with --trace-binary and are much faster to parse than text
+#
+# each record is a native-endian header:
+#
+# [ 'b' | 'd' | op  |  0  |  block  |   off   |  size   |  count  | anchor ]
+#
+# followed by count 64-bit backtrace addresses, where op is one of 'c'
+# (create, block=block_count, size=block_size), 'r', 'p', or 'e', and
+# anchor is the runtime address of lfs_emubd_read
+BD_TRACE = struct.Struct('=2scxIIIIQ')
+BD_TRACE_OPS = {b'c', b'r', b'p', b'e'}
+
+def bd_trace_valid(data, off=0):
+    return (data[off:off+2] == b'bd'
+        and data[off+2:off+3] in BD_TRACE_OPS
+        and data[off+3:off+4] == b'\0')
+
+def bd_trace_isbinary(f):
+    # note the 0 byte never shows up in text traces
+    return bd_trace_valid(f.peek(BD_TRACE.size))
+
+# find the next record in the middle of a trace, we don't have a perfect
+# delimiter, so also check that the following record looks valid
+def bd_trace_resync(data, off):
+    while True:
+        off = data.find(b'bd', off)
+        if off < 0:
+            return len(data)
+        if bd_trace_valid(data, off) and off+BD_TRACE.size <= len(data):
+            count, = struct.unpack_from('=I', data, off+16)
+            next = off + BD_TRACE.size + 8*count
+            if next >= len(data) or bd_trace_valid(data, next):
+                return off
+        off += 1
+
+# unpack records starting before end, returning the offset we stopped at
+def bd_trace_unpack(data, off, end):
+    while off < end and off+BD_TRACE.size <= len(data):
+        if not bd_trace_valid(data, off):
+            off = bd_trace_resync(data, off+1)
+            continue
+
+        _, op, block, off_, size, count, anchor = BD_TRACE.unpack_from(
+            data, off)
+        next = off + BD_TRACE.size + 8*count
+        if next > len(data):
+            break
+        addrs = struct.unpack_from('=%dQ' % count, data, off+BD_TRACE.size)
+        yield op, block, off_, size, anchor, addrs
+        off = next
+
+    return off
+
+# iterate over (op, block, off, size, anchor, addrs) records in a binary
+# trace
+def bd_trace_records(f):
+    # mmap if we can, this avoids copies
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        data = None
+
+    if data is not None:
+        with data:
+            yield from bd_trace_unpack(data, 0, len(data))
+        return
+
+    # otherwise we're streaming, so parse what we can as data comes in
+    buf = b''
+    while True:
+        chunk = f.read1(1024*1024)
+        if not chunk:
+            break
+        buf += chunk
+        off = yield from bd_trace_unpack(buf, 0, len(buf))
+        buf = buf[off:]
+
 class LinesIO:
     def __init__(self, maxlen=None):
         self.maxlen = maxlen
@@ -338,66 +419,94 @@ class Block(int):
         return c
 
 
+# block device state, stored as columns, a bytearray of read/prog/erase
+# flags and an array of wear counters, so ops can update whole slices at
+# once instead of rebuilding a Block per cell
 class Bd:
+    # translate tables for updating flags
+    READ = bytes(i | 1 for i in range(256))
+    PROG = bytes(i | 2 for i in range(256))
+    ERASE = bytes(i | 4 for i in range(256))
+
     def __init__(self, *,
             size=1,
             count=1,
             width=None,
             height=1,
-            blocks=None):
+            flags=None,
+            wear=None):
         if width is None:
             width = count
 
-        if blocks is None:
-            self.blocks = [Block() for _ in range(width*height)]
+        if flags is None:
+            self.flags = bytearray(width*height)
         else:
-            self.blocks = blocks
+            self.flags = flags
+        if wear is None:
+            self.wear = array.array('I', [0])*(width*height)
+        else:
+            self.wear = wear
         self.size = size
         self.count = count
         self.width = width
         self.height = height
+        self._blocks = None
 
-    def _op(self, f, block=None, off=None, size=None):
+    # Block views of our state, only built when we need to draw
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = [Block(f, wear=w)
+                for f, w in zip(self.flags, self.wear)]
+        return self._blocks
+
+    def _range(self, block=None, off=None, size=None):
         if block is None:
-            range_ = range(len(self.blocks))
-        else:
-            if off is None:
-                off, size = 0, self.size
-            elif size is None:
-                off, size = 0, off
+            return 0, len(self.flags)
 
-            # update our geometry? this will do nothing if we haven't changed
+        if off is None:
+            off, size = 0, self.size
+        elif size is None:
+            off, size = 0, off
+
+        # update our geometry? only if we need to, this is a hot path
+        if off+size > self.size or block >= self.count:
             self.resize(
                 size=max(self.size, off+size),
                 count=max(self.count, block+1))
 
-            # map to our block space
-            start = (block*self.size + off) / (self.size*self.count)
-            stop = (block*self.size + off+size) / (self.size*self.count)
-
-            range_ = range(
-                m.floor(start*len(self.blocks)),
-                m.ceil(stop*len(self.blocks)))
-
-        # apply the op
-        for i in range_:
-            self.blocks[i] = f(self.blocks[i])
+        # map to our block space
+        total = self.size*self.count
+        return (
+            m.floor((block*self.size + off) * len(self.flags) / total),
+            m.ceil((block*self.size + off+size) * len(self.flags) / total))
 
     def read(self, block=None, off=None, size=None):
-        self._op(Block.read, block, off, size)
+        start, stop = self._range(block, off, size)
+        self.flags[start:stop] = self.flags[start:stop].translate(Bd.READ)
+        self._blocks = None
 
     def prog(self, block=None, off=None, size=None):
-        self._op(Block.prog, block, off, size)
+        start, stop = self._range(block, off, size)
+        self.flags[start:stop] = self.flags[start:stop].translate(Bd.PROG)
+        self._blocks = None
 
     def erase(self, block=None, off=None, size=None):
-        self._op(Block.erase, block, off, size)
+        start, stop = self._range(block, off, size)
+        self.flags[start:stop] = self.flags[start:stop].translate(Bd.ERASE)
+        self.wear[start:stop] = array.array('I',
+            [w+1 for w in self.wear[start:stop]])
+        self._blocks = None
 
     def clear(self, block=None, off=None, size=None):
-        self._op(Block.clear, block, off, size)
+        start, stop = self._range(block, off, size)
+        self.flags[start:stop] = bytes(stop-start)
+        self._blocks = None
 
     def copy(self):
         return Bd(
-            blocks=self.blocks.copy(),
+            flags=self.flags.copy(),
+            wear=array.array('I', self.wear),
             size=self.size,
             count=self.count,
             width=self.width,
@@ -419,33 +528,47 @@ class Bd:
                 and height == self.height):
             return
 
-        # transform our blocks
-        blocks = []
-        for x in range(width*height):
-            # map from new bd space
-            start = m.floor(x * (size*count)/(width*height))
-            stop = m.ceil((x+1) * (size*count)/(width*height))
-            start_block = start // size
-            start_off = start % size
-            stop_block = stop // size
-            stop_off = stop % size
-            # map to old bd space
-            start = start_block*self.size + start_off
-            stop = stop_block*self.size + stop_off
-            start = m.floor(start * len(self.blocks)/(self.size*self.count))
-            stop = m.ceil(stop * len(self.blocks)/(self.size*self.count))
-
-            # aggregate state
-            blocks.append(ft.reduce(
-                Block.__or__,
-                self.blocks[start:stop],
-                Block()))
-            
+        # transform our blocks, each new cell aggregates a slice of old
+        # cells, flags are or-ed and wear is max-ed
+        cells = width*height
+        if any(self.flags) or any(self.wear):
+            # map from new bd space to old bd space, note we use integer
+            # math here, this is faster and avoids rounding issues
+            cells_ = len(self.flags)
+            starts = [x*(size*count) // cells for x in range(cells)]
+            stops = [-(-(x+1)*(size*count) // cells) for x in range(cells)]
+            if size != self.size:
+                starts = [p//size*self.size + p%size for p in starts]
+                stops = [p//size*self.size + p%size for p in stops]
+            # note new cells may be past the end of our old blocks
+            starts = [min(p*cells_ // (self.size*self.count), cells_)
+                for p in starts]
+            stops = [min(-(-p*cells_ // (self.size*self.count)), cells_)
+                for p in stops]
+
+            # aggregate state, note there are at most 8 distinct flags, and
+            # most cells map to exactly one old cell
+            flags = bytearray(
+                self.flags[start] if stop-start == 1
+                    else ft.reduce(int.__or__,
+                        set(self.flags[start:stop]), 0)
+                for start, stop in zip(starts, stops))
+            wear = array.array('I', [
+                self.wear[start] if stop-start == 1
+                    else max(self.wear[start:stop], default=0)
+                for start, stop in zip(starts, stops)])
+        else:
+            # no state? skip the transform, this is common after a create
+            flags = bytearray(cells)
+            wear = array.array('I', [0])*cells
+
         self.size = size
         self.count = count
         self.width = width
         self.height = height
-        self.blocks = blocks
+        self.flags = flags
+        self.wear = wear
+        self._blocks = None
 
     def draw(self, row, *,
             read=False,
@@ -460,7 +583,7 @@ class Bd:
         # find max wear?
         max_wear = None
         if wear:
-            max_wear = max(b.wear for b in self.blocks)
+            max_wear = max(self.wear, default=0)
 
         # fold via a curve?
         if hilbert:
@@ -679,8 +802,8 @@ def main(path='-', *,
         '^(?P<file>[^:]*):(?P<line>[0-9]+):trace:.*?bd_(?:'
             '(?P<create>create\w*)\('
                 '(?:'
-                    'block_size=(?P<block_size>\w+)'
-                    '|' 'block_count=(?P<block_count>\w+)'
+                    '(?:block|erase)_size=(?P<block_size>\w+)'
+                    '|' '(?:block|erase)_count=(?P<block_count>\w+)'
                     '|' '.*?' ')*' '\)'
             '|' '(?P<read>read)\('
                 '\s*(?P<read_ctx>\w+)' '\s*,'
@@ -701,23 +824,45 @@ def main(path='-', *,
             '|' '(?P<sync>sync)\('
                 '\s*(?P<sync_ctx>\w+)' '\s*\)' ')\s*$')
     def parse(line):
-        nonlocal bd
-
         # string searching is much faster than the regex here, and this
         # actually has a big impact given how much trace output comes
         # through here
         if 'trace' not in line or 'bd' not in line:
-            return False
+            return None
         m = pattern.match(line)
         if not m:
-            return False
+            return None
 
         if m.group('create'):
-            # update our block size/count
-            size = int(m.group('block_size'), 0)
-            count = int(m.group('block_count'), 0)
+            return ('c',
+                int(m.group('block_count'), 0),
+                0,
+                int(m.group('block_size'), 0))
+        elif m.group('read'):
+            return ('r',
+                int(m.group('read_block'), 0),
+                int(m.group('read_off'), 0),
+                int(m.group('read_size'), 0))
+        elif m.group('prog'):
+            return ('p',
+                int(m.group('prog_block'), 0),
+                int(m.group('prog_off'), 0),
+                int(m.group('prog_size'), 0))
+        elif m.group('erase'):
+            return ('e',
+                int(m.group('erase_block'), 0),
+                0,
+                int(m.group('erase_size'), 0))
+        else:
+            return None
+
+    # apply an operation, note create ops are (count, 0, size)
+    def apply(op, block, off, size):
+        nonlocal bd
 
-            resize(size=size, count=count)
+        if op == 'c':
+            # update our block size/count
+            resize(size=size, count=block)
             if reset:
                 bd = Bd(
                     size=bd.size,
@@ -726,11 +871,7 @@ def main(path='-', *,
                     height=bd.height)
             return True
 
-        elif m.group('read') and read:
-            block = int(m.group('read_block'), 0)
-            off = int(m.group('read_off'), 0)
-            size = int(m.group('read_size'), 0)
-
+        elif op == 'r' and read:
             if block_stop is not None and block >= block_stop:
                 return False
             block -= block_start
@@ -743,11 +884,7 @@ def main(path='-', *,
             bd.read(block, off, size)
             return True
 
-        elif m.group('prog') and prog:
-            block = int(m.group('prog_block'), 0)
-            off = int(m.group('prog_off'), 0)
-            size = int(m.group('prog_size'), 0)
-
+        elif op == 'p' and prog:
             if block_stop is not None and block >= block_stop:
                 return False
             block -= block_start
@@ -760,10 +897,7 @@ def main(path='-', *,
             bd.prog(block, off, size)
             return True
 
-        elif m.group('erase') and (erase or wear):
-            block = int(m.group('erase_block'), 0)
-            size = int(m.group('erase_size'), 0)
-
+        elif op == 'e' and (erase or wear):
             if block_stop is not None and block >= block_stop:
                 return False
             block -= block_start
@@ -777,6 +911,17 @@ def main(path='-', *,
         else:
             return False
 
+    # read either binary or text traces
+    def records(f):
+        if bd_trace_isbinary(f):
+            for op, block, off, size, _, _ in bd_trace_records(f):
+                yield op.decode(), block, off, size
+        else:
+            for line in io.TextIOWrapper(f):
+                op = parse(line)
+                if op:
+                    yield op
+
     # print trace output
     def draw(f):
         def writeln(s=''):
@@ -832,11 +977,11 @@ def main(path='-', *,
 
     try:
         while True:
-            with openio(path) as f:
+            with openio(path, 'rb') as f:
                 changed = 0
-                for line in f:
+                for op in records(f):
                     with lock:
-                        changed += parse(line)
+                        changed += apply(*op)
 
                         # need to redraw?
                         if changed and (not coalesce or changed >= coalesce):